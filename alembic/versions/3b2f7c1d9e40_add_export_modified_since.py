@@ -0,0 +1,25 @@
+"""Add export modified since watermark
+
+Revision ID: 3b2f7c1d9e40
+Revises: 5eb8bce63d7e
+Create Date: 2026-10-16 09:12:44.218306
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b2f7c1d9e40'
+down_revision = '5eb8bce63d7e'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        'export',
+        sa.Column('modified_since', sa.DateTime(timezone=True)))
+
+
+def downgrade():
+    op.drop_column('export', 'modified_since')
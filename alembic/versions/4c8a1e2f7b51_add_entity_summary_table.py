@@ -0,0 +1,62 @@
+"""Add entity summary table
+
+Revision ID: 4c8a1e2f7b51
+Revises: 3b2f7c1d9e40
+Create Date: 2026-10-16 10:41:07.583120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c8a1e2f7b51'
+down_revision = '3b2f7c1d9e40'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from occams.models.studies import \
+    ENTITY_SUMMARY_SOURCES, create_entity_summary_triggers
+
+
+def upgrade():
+    table_name = 'entity_summary'
+
+    op.create_table(
+        table_name,
+        sa.Column(
+            'entity_id',
+            sa.BigInteger,
+            sa.ForeignKey(
+                'entity.id',
+                name='fk_%s_entity_id' % table_name,
+                ondelete='CASCADE'),
+            primary_key=True),
+        sa.Column('schema_name', sa.String, nullable=False),
+        sa.Column('state', sa.String),
+        sa.Column('patient_id', sa.Integer),
+        sa.Column('site_id', sa.Integer),
+        sa.Column('visit_id', sa.Integer),
+        sa.Column('visit_date', sa.Date),
+        sa.Column('enrollment_ids', ARRAY(sa.Integer)),
+        sa.Column('stratum_id', sa.Integer),
+        sa.Index('ix_%s_schema_name' % table_name, 'schema_name'),
+        sa.Index('ix_%s_patient_id' % table_name, 'patient_id'),
+        sa.Index('ix_%s_site_id' % table_name, 'site_id'),
+        sa.Index('ix_%s_visit_id' % table_name, 'visit_id'),
+        sa.Index('ix_%s_stratum_id' % table_name, 'stratum_id'))
+
+    connection = op.get_bind()
+    create_entity_summary_triggers(None, connection)
+    connection.execute('SELECT entity_summary_backfill()')
+
+
+def downgrade():
+    for source_name in ENTITY_SUMMARY_SOURCES:
+        op.execute(
+            'DROP TRIGGER IF EXISTS entity_summary_trigger ON %s'
+            % source_name)
+    op.execute('DROP FUNCTION IF EXISTS entity_summary_trigger()')
+    op.execute('DROP FUNCTION IF EXISTS entity_summary_backfill()')
+    op.execute('DROP FUNCTION IF EXISTS entity_summary_refresh(bigint)')
+    op.drop_table('entity_summary')
@@ -0,0 +1,50 @@
+"""Add attribute lineage table
+
+Revision ID: 5d9b2f3a8c62
+Revises: 4c8a1e2f7b51
+Create Date: 2026-10-16 14:02:51.224619
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d9b2f3a8c62'
+down_revision = '4c8a1e2f7b51'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from occams.models.schema import create_attribute_lineage_triggers
+
+
+def upgrade():
+    table_name = 'attribute_lineage'
+
+    op.create_table(
+        table_name,
+        sa.Column('schema_name', sa.String, primary_key=True),
+        sa.Column('attribute_name', sa.String(100), primary_key=True),
+        sa.Column('latest_order', sa.Integer, nullable=False),
+        sa.Column('latest_title', sa.Unicode),
+        sa.Column('type', sa.String, nullable=False),
+        sa.Column('versions', ARRAY(sa.Date), nullable=False),
+        sa.Index(
+            'ix_%s_latest_order' % table_name,
+            'schema_name', 'latest_order'))
+
+    connection = op.get_bind()
+    create_attribute_lineage_triggers(None, connection)
+    connection.execute('SELECT attribute_lineage_backfill()')
+
+
+def downgrade():
+    for table_name in ('schema', 'attribute'):
+        op.execute(
+            'DROP TRIGGER IF EXISTS attribute_lineage_trigger ON %s'
+            % table_name)
+    op.execute('DROP FUNCTION IF EXISTS attribute_lineage_trigger()')
+    op.execute('DROP FUNCTION IF EXISTS attribute_lineage_backfill()')
+    op.execute(
+        'DROP FUNCTION IF EXISTS attribute_lineage_refresh(varchar)')
+    op.drop_table('attribute_lineage')
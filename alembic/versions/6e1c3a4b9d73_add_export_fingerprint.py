@@ -0,0 +1,25 @@
+"""Add export fingerprint
+
+Revision ID: 6e1c3a4b9d73
+Revises: 5d9b2f3a8c62
+Create Date: 2026-10-16 15:02:31.904127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e1c3a4b9d73'
+down_revision = '5d9b2f3a8c62'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('export', sa.Column('fingerprint', sa.String))
+    op.create_index('ix_export_fingerprint', 'export', ['fingerprint'])
+
+
+def downgrade():
+    op.drop_index('ix_export_fingerprint', 'export')
+    op.drop_column('export', 'fingerprint')
@@ -0,0 +1,48 @@
+"""Add export file size
+
+Revision ID: 7a2d4e5f6b84
+Revises: 6e1c3a4b9d73
+Create Date: 2026-10-16 17:24:08.311942
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a2d4e5f6b84'
+down_revision = '6e1c3a4b9d73'
+branch_labels = None
+
+from alembic import op, context
+import sqlalchemy as sa
+
+import os
+
+
+def upgrade():
+    op.add_column('export', sa.Column('file_size', sa.BigInteger))
+
+    # Sizes of existing archives can only be read from the export directory
+    if context.is_offline_mode():
+        return
+
+    file_config = context.config.file_config
+    if not file_config.has_option('app:main', 'studies.export.dir'):
+        return
+
+    export_dir = os.path.normpath(
+        file_config.get('app:main', 'studies.export.dir'))
+    conn = op.get_bind()
+
+    rows = conn.execute(
+        "SELECT id, name FROM export WHERE status = 'complete'").fetchall()
+
+    for row in rows:
+        path = os.path.join(export_dir, row.name)
+        if os.path.isfile(path):
+            conn.execute(
+                sa.text('UPDATE export SET file_size = :size WHERE id = :id'),
+                id=row.id,
+                size=os.path.getsize(path))
+
+
+def downgrade():
+    op.drop_column('export', 'file_size')
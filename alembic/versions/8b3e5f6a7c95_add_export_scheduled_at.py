@@ -0,0 +1,23 @@
+"""Add export scheduled at
+
+Revision ID: 8b3e5f6a7c95
+Revises: 7a2d4e5f6b84
+Create Date: 2026-10-17 09:12:41.527308
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8b3e5f6a7c95'
+down_revision = '7a2d4e5f6b84'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('export', sa.Column('scheduled_at', sa.DateTime))
+
+
+def downgrade():
+    op.drop_column('export', 'scheduled_at')
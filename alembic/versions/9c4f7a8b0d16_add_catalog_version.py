@@ -0,0 +1,49 @@
+"""Add catalog version
+
+Revision ID: 9c4f7a8b0d16
+Revises: 8b3e5f6a7c95
+Create Date: 2026-10-17 11:27:09.318462
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c4f7a8b0d16'
+down_revision = '8b3e5f6a7c95'
+branch_labels = None
+
+from alembic import op
+import sqlalchemy as sa
+
+from occams.models.studies import create_catalog_version_triggers
+
+
+def upgrade():
+    table_name = 'catalog_version'
+
+    op.execute(sa.schema.CreateSequence(sa.Sequence('catalog_version_seq')))
+
+    op.create_table(
+        table_name,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column(
+            'version',
+            sa.BigInteger,
+            server_default=sa.text("nextval('catalog_version_seq')"),
+            nullable=False),
+        sa.CheckConstraint('id = 1', name='ck_%s_single' % table_name))
+
+    create_catalog_version_triggers(None, op.get_bind())
+
+
+def downgrade():
+    for table_name in ('schema', 'attribute', 'stratum', 'entity'):
+        op.execute(
+            'DROP TRIGGER IF EXISTS catalog_version_trigger ON %s'
+            % table_name)
+    for op_name in ('insert', 'update', 'delete'):
+        op.execute(
+            'DROP TRIGGER IF EXISTS catalog_version_%s_trigger ON context'
+            % op_name)
+    op.execute('DROP FUNCTION IF EXISTS catalog_version_trigger()')
+    op.drop_table('catalog_version')
+    op.execute(sa.schema.DropSequence(sa.Sequence('catalog_version_seq')))
@@ -76,6 +76,7 @@ def main(global_config, **settings):
 
     config.include('.assets')
     config.include('.celery')
+    config.include('.tasks')
     config.include('.models')
     config.include('.routes')
     config.include('.security')
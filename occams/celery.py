@@ -15,6 +15,7 @@ from celery import Celery
 from celery.bin import Option
 import celery.signals
 from celery.utils.log import get_task_logger
+from kombu import Queue
 import six
 from pyramid.settings import aslist
 from pyramid.paster import bootstrap
@@ -33,6 +34,20 @@ app.user_options['preload'].add(
 
 log = get_task_logger(__name__)
 
+# Exports are split into queues by estimated size so that large exports
+# cannot starve small ones, and codebooks never wait behind exports.
+# Workers consume all queues unless given specific ones with -Q
+DEFAULT_QUEUE = 'celery'
+EXPORT_QUEUE = 'export'
+LARGE_EXPORT_QUEUE = 'export.large'
+CODEBOOK_QUEUE = 'codebook'
+
+# Number of seconds the broker waits for a task to be acknowledged before
+# delivering it again. Exports are only acknowledged once they finish, so
+# that exports of lost workers are run again, so this must be longer than
+# the longest export (see ``celery.broker.visibility_timeout``)
+VISIBILITY_TIMEOUT = 43200
+
 #
 # Dedicated Celery application database session.
 # DO NOT USE THIS SESSION IN THE WSGI APP
@@ -64,9 +79,20 @@ def includeme(config):
         CELERY_RESULT_BACKEND=settings['celery.backend.url'],
         BROKER_TRANSPORT_OPTIONS={
             'fanout_prefix': True,
-            'fanout_patterns': True
+            'fanout_patterns': True,
+            'visibility_timeout': int(settings.get(
+                'celery.broker.visibility_timeout', VISIBILITY_TIMEOUT)),
         },
         CELERY_INCLUDE=aslist(settings.get('celery.include', [])),
+        CELERY_DEFAULT_QUEUE=DEFAULT_QUEUE,
+        CELERY_QUEUES=[
+            Queue(name, routing_key=name)
+            for name in (DEFAULT_QUEUE, EXPORT_QUEUE, LARGE_EXPORT_QUEUE,
+                         CODEBOOK_QUEUE)],
+        CELERY_ROUTES={
+            'make_export': {'queue': EXPORT_QUEUE},
+            'make_codebook': {'queue': CODEBOOK_QUEUE},
+        },
         CELERYBEAT_SCHEDULE=_get_schedule(settings)
     )
 
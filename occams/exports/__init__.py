@@ -5,7 +5,12 @@ This module does the actual heavy-lifting wereas the others just
 offer an interface (gui or cli, etc)
 """
 
+import hashlib
 import inspect
+import json
+import os
+import shutil
+import uuid
 
 try:
     import unicodecsv as csv
@@ -18,9 +23,10 @@ except ImportError:  # pragma: nocover
 
 from pyramid.config import aslist
 from pyramid.path import DottedNameResolver
+import six
 
 from .. import log
-from . import codebook
+from . import cache, codebook, profile, progress
 
 from .pid import PidPlan
 from .enrollment import EnrollmentPlan
@@ -64,35 +70,325 @@ def list_all(dbsession, include_rand=True, include_private=True):
     return all
 
 
-def write_data(buffer, query):
+def fingerprint(plans, **options):
+    """
+    Generates a key identifying the data an export would contain
+
+    Two exports with the same key contain the same data files, so one may
+    reuse the other's archive instead of generating its own.
+
+    Arguments:
+    plans -- the export plans
+    options -- the options passed to the plans' data queries
+
+    Returns:
+    The key string, or None if any plan's data cannot be fingerprinted
+    """
+    entries = []
+    for plan in plans:
+        plan_fingerprint = plan.fingerprint()
+        if plan_fingerprint is None:
+            return None
+        entries.append([
+            plan.name, list(map(str, plan.versions)), plan_fingerprint])
+    payload = json.dumps([
+        sorted(entries),
+        sorted((k, str(v)) for k, v in options.items()),
+    ], sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def write_data(buffer, query, batch_size=None, progress=None):
     """
     Dumps a query to a CSV file using the specified buffer
-    Each record in the query is accessed as a `namedtuple`.
+    Each record in the query is written as a plain tuple in column order.
 
-    See `namedtuple`.
+    If a batch size is specified, rows are streamed from a server-side
+    cursor in batches of that size instead of loading the entire result
+    into memory first, so that very large plans can be written in bounded
+    memory.
 
     Arguments:
     buffer -- a file object which will be used to write data contents
     query -- SQLAlchemy query that will be writen to a CSV file.
              Note that the column names will be used as the header.
+    batch_size -- (Optional) number of rows to fetch from the database
+                  at a time. (default: if None, all rows are fetched at once)
+    progress -- (Optional) a `progress.ProgressMeter` to count rows and
+                bytes written with
     """
     fieldnames = [d['name'] for d in query.column_descriptions]
-    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(r._asdict() for r in query)
+    if batch_size:
+        query = query.yield_per(batch_size)
+    if progress is not None:
+        buffer = progress.wrap(buffer)
+    writer = csv.writer(buffer)
+    writer.writerow(fieldnames)
+    if progress is None:
+        writer.writerows(query)
+    else:
+        for record in query:
+            writer.writerow(record)
+            progress.update(rows=1)
+        progress.report()
     buffer.flush()
 
 
-def write_codebook(buffer, rows):
+def iter_data(query, batch_size=None):
+    """
+    Generates a query's CSV contents in chunks, for streaming responses
+
+    Rows are fetched from a server-side cursor, so only one batch is held
+    in memory at a time.
+
+    Arguments:
+    query -- SQLAlchemy query that will be writen as CSV.
+             Note that the column names will be used as the header.
+    batch_size -- (Optional) number of rows to fetch and emit at a time
+                  (default: 1000)
+
+    Returns:
+    An iterator of CSV byte strings
+    """
+    batch_size = batch_size or 1000
+    buffer = six.BytesIO()
+    writer = csv.writer(buffer)
+    writer.writerow([d['name'] for d in query.column_descriptions])
+
+    for i, record in enumerate(query.yield_per(batch_size), 1):
+        writer.writerow(record)
+        if i % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def _render_sql(connection, cursor, query):
+    """
+    Renders a query as a SQL string with its parameters inlined
+    """
+    compiled = query.statement.compile(dialect=connection.dialect)
+    # Let the driver render the parameters as it would for execution
+    sql = cursor.mogrify(six.text_type(compiled), compiled.params)
+    if isinstance(sql, six.text_type):
+        sql = sql.encode('utf-8')
+    return sql
+
+
+def copy_data(buffer, query, batch_size=None, progress=None):
+    """
+    Dumps a query to a CSV file using PostgreSQL's COPY command
+
+    The query is compiled to SQL and executed as
+    ``COPY (SELECT ...) TO STDOUT WITH CSV HEADER``, so the rows are
+    serialized by the database and streamed as-is into the buffer, instead
+    of being loaded and re-serialized in Python.
+
+    Databases other than PostgreSQL fall back to `write_data`.
+
+    Arguments:
+    buffer -- a binary file object which will receive the CSV contents
+    query -- SQLAlchemy query that will be writen to a CSV file.
+             Note that the column names will be used as the header.
+    batch_size -- (Optional) only used when falling back to `write_data`
+    progress -- (Optional) a `progress.ProgressMeter` to count rows and
+                bytes written with. Rows are counted as output lines, so
+                values with line breaks are over-counted.
+    """
+    connection = query.session.connection()
+
+    if connection.dialect.name != 'postgresql':
+        return write_data(
+            buffer, query, batch_size=batch_size, progress=progress)
+
+    if progress is not None:
+        buffer = progress.wrap(buffer, count_rows=True)
+
+    cursor = connection.connection.cursor()
+
+    try:
+        sql = _render_sql(connection, cursor, query)
+        cursor.copy_expert(
+            b'COPY (' + sql + b') TO STDOUT WITH CSV HEADER', buffer)
+    finally:
+        cursor.close()
+
+    if progress is not None:
+        progress.report()
+
+    buffer.flush()
+
+
+def explain(query, analyze=False):
+    """
+    Generates the query planner's plan for a query
+
+    Arguments:
+    query -- SQLAlchemy query to explain
+    analyze -- (Optional) also execute the query to report actual timings
+               and buffer usage, which costs as much as running the query
+
+    Returns:
+    The JSON plan or None if the database cannot explain queries
+    """
+    connection = query.session.connection()
+
+    if connection.dialect.name != 'postgresql':
+        return None
+
+    options = b'ANALYZE, BUFFERS, FORMAT JSON' if analyze else b'FORMAT JSON'
+    cursor = connection.connection.cursor()
+
+    try:
+        sql = _render_sql(connection, cursor, query)
+        cursor.execute(b'EXPLAIN (' + options + b') ' + sql)
+        plan, = cursor.fetchone()
+    finally:
+        cursor.close()
+
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+
+    return plan
+
+
+def estimate_rows(query):
+    """
+    Estimates the number of rows a query will return
+
+    Only the query planner's estimate is used, so this is cheap enough to
+    run before every data file but may be off for complex queries.
+
+    Arguments:
+    query -- SQLAlchemy query to estimate
+
+    Returns:
+    The estimated number of rows or None if no estimate is available
+    """
+    plan = explain(query)
+
+    if plan is None:
+        return None
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def compact_data(path, shard_paths):
+    """
+    Merges incremental data files into a full data file
+
+    Shards are applied oldest to newest: every record in a shard replaces
+    all rows with the same id in the full data file (or is added if
+    it's new). Changed records are placed in id order, assuming the full
+    data file is also sorted by id. Note that deleted records are not
+    tracked by incremental exports, so they will remain in the merged file
+    until a new full export is generated.
+
+    Arguments:
+    path -- the full data file to update in-place
+    shard_paths -- the incremental data files to merge, oldest first
+
+    Raises:
+    ValueError if a shard's columns are different from the full data file
+    """
+    with open(path, 'rb') as fp:
+        header = next(csv.reader(fp))
+
+    changes = {}
+
+    for shard_path in shard_paths:
+        shard_changes = OrderedDict()
+        with open(shard_path, 'rb') as fp:
+            reader = csv.reader(fp)
+            if next(reader) != header:
+                raise ValueError(
+                    '{} has different columns than {}, a full export is '
+                    'required'.format(shard_path, path))
+            for row in reader:
+                shard_changes.setdefault(row[0], []).append(row)
+        changes.update(shard_changes)
+
+    pending = sorted(changes, key=int)
+    position = 0
+    tmp_path = path + '.tmp'
+
+    with open(path, 'rb') as src, open(tmp_path, 'w+b') as dst:
+        reader = csv.reader(src)
+        writer = csv.writer(dst)
+        writer.writerow(next(reader))
+
+        for row in reader:
+            while (position < len(pending)
+                    and int(pending[position]) <= int(row[0])):
+                writer.writerows(changes[pending[position]])
+                position += 1
+            if row[0] not in changes:
+                writer.writerow(row)
+
+        for id in pending[position:]:
+            writer.writerows(changes[id])
+
+    os.rename(tmp_path, path)
+
+    for shard_path in shard_paths:
+        os.unlink(shard_path)
+
+
+def concat_data(path, shard_paths):
+    """
+    Concatenates data file shards into a single data file
+
+    The shards are expected to be generated from consecutive id ranges of
+    the same plan, so they are simply appended in order under a single
+    header.
+
+    Arguments:
+    path -- the data file to create
+    shard_paths -- the shards to concatenate, in order
+
+    Raises:
+    ValueError if a shard's columns are different from the first shard's
+    """
+    header = None
+
+    with open(path, 'w+b') as dst:
+        for shard_path in shard_paths:
+            with open(shard_path, 'rb') as src:
+                line = src.readline()
+                if header is None:
+                    header = line
+                    dst.write(line)
+                elif line != header:
+                    raise ValueError(
+                        '{} has different columns than {}'.format(
+                            shard_path, shard_paths[0]))
+                shutil.copyfileobj(src, dst)
+
+    for shard_path in shard_paths:
+        os.unlink(shard_path)
+
+
+# Available data file writers, by name
+engines = OrderedDict([
+    ('orm', write_data),
+    ('copy', copy_data),
+])
+
+
+def write_codebook(buffer, rows, header=True):
     """
     Dumps a list of dictioanries to a CSV file using the specified buffer
 
     Arguments:
     buffer -- a file object which will be used to write data contents
     rows -- Code book rows. Seee `occams.codebook`
+    header -- (Optional) write the header row, default: True
     """
     writer = csv.DictWriter(buffer, codebook.HEADER)
-    writer.writeheader()
+    if header:
+        writer.writeheader()
 
     def choices2string(choices):
         choices = choices or []
@@ -103,3 +399,70 @@ def write_codebook(buffer, rows):
         writer.writerow(row)
 
     buffer.flush()
+
+
+def codebook_fragment(fragments_dir, plan):
+    """
+    Persists a plan's codebook rows, keyed by the revision of its codebook
+
+    The fragment is only generated if the plan has changed since it was
+    last written, previous revisions of the fragment are removed.
+
+    Arguments:
+    fragments_dir -- the directory to keep fragments in (created if missing)
+    plan -- the export plan
+
+    Returns:
+    The path to the fragment, a header-less codebook CSV file
+    """
+    if not os.path.exists(fragments_dir):
+        os.makedirs(fragments_dir)
+
+    key = hashlib.sha1(
+        json.dumps(plan.codebook_key()).encode('utf-8')).hexdigest()
+    file_name = '%s.%s.csv' % (plan.name, key)
+    path = os.path.join(fragments_dir, file_name)
+
+    if os.path.exists(path):
+        return path
+
+    staging_path = os.path.join(fragments_dir, str(uuid.uuid4()))
+    with open(staging_path, 'w+b') as fp:
+        write_codebook(fp, plan.codebook(), header=False)
+    os.rename(staging_path, path)
+
+    for name in os.listdir(fragments_dir):
+        if name != file_name \
+                and name.startswith(plan.name + '.') \
+                and name.count('.') == 2:
+            try:
+                os.unlink(os.path.join(fragments_dir, name))
+            except OSError:
+                pass
+
+    return path
+
+
+def write_codebook_fragments(buffer, fragments_dir, plans):
+    """
+    Dumps the codebook of several plans from their persisted fragments
+
+    Arguments:
+    buffer -- a file object which will be used to write data contents
+    fragments_dir -- the directory fragments are kept in
+    plans -- the export plans to include, in order
+    """
+    csv.DictWriter(buffer, codebook.HEADER).writeheader()
+
+    for plan in plans:
+        path = codebook_fragment(fragments_dir, plan)
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            # Superseded by a concurrent process, fall back to the plan
+            write_codebook(buffer, plan.codebook(), header=False)
+            continue
+        with fp:
+            shutil.copyfileobj(fp, buffer)
+
+    buffer.flush()
@@ -0,0 +1,120 @@
+"""
+Shared data file cache
+
+Generated data files are stored under a key derived from the plan, its
+export options and the current fingerprint of its data. Identical requests
+can then reuse a previous data file instead of re-querying the database.
+Least recently used files are evicted once the cache exceeds its size.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+
+class ArtifactCache(object):
+    """
+    A size-bounded, least-recently-used directory of data files
+    """
+
+    suffix = '.csv'
+
+    def __init__(self, path, max_size):
+        """
+        Parameters:
+        path -- the directory to keep data files in (created if missing)
+        max_size -- the maximum total size of the cached files, in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def key(self, plan, **options):
+        """
+        Generates the cache key of a plan's data file
+
+        Parameters:
+        plan -- the export plan
+        options -- the options passed to the plan's data query
+
+        Returns:
+        The key string, or None if the plan's data is not cacheable
+        """
+        fingerprint = plan.fingerprint()
+        if fingerprint is None:
+            return None
+        payload = json.dumps([
+            plan.name,
+            list(map(str, plan.versions)),
+            sorted((k, str(v)) for k, v in options.items()),
+            fingerprint,
+        ], sort_keys=True)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key):
+        """
+        Checks out a cached data file
+
+        The file is linked to a private path so that it remains available
+        even if the entry is evicted while it is still being used.
+
+        Parameters:
+        key -- the cache key
+
+        Returns:
+        The path to the checked out file (the caller is responsible for
+        removing it), or None if the key is not cached
+        """
+        path = self._path(key)
+        checkout_path = os.path.join(self.path, str(uuid.uuid4()))
+        try:
+            os.link(path, checkout_path)
+        except OSError:
+            return None
+        # Mark as recently used
+        os.utime(path, None)
+        return checkout_path
+
+    def put(self, key, source_path):
+        """
+        Adds a copy of a data file to the cache
+
+        Parameters:
+        key -- the cache key
+        source_path -- the generated data file
+        """
+        staging_path = os.path.join(self.path, str(uuid.uuid4()))
+        shutil.copyfile(source_path, staging_path)
+        os.rename(staging_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache fits its size
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for mtime, size, name in entries)
+
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
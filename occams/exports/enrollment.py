@@ -17,6 +17,13 @@ class EnrollmentPlan(ExportPlan):
 
     title = _(u'Enrollments')
 
+    dependencies = [
+        models.Enrollment,
+        models.Patient,
+        models.Study,
+        models.Site,
+    ]
+
     def codebook(self):
 
         return iter([
@@ -49,7 +56,8 @@ class EnrollmentPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             modified_since=None):
         session = self.dbsession
         query = (
             session.query(
@@ -76,4 +84,9 @@ class EnrollmentPlan(ExportPlan):
             .order_by(models.Enrollment.id,
                       models.Study.title,
                       models.Patient.pid))
+
+        if modified_since:
+            query = query.filter(
+                models.Enrollment.modified_at > modified_since)
+
         return query
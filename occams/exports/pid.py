@@ -31,12 +31,25 @@ class PidPlan(ExportPlan):
 
     title = _(u'Patient Identifiers')
 
+    dependencies = [
+        models.Patient,
+        models.Site,
+        models.PatientReference,
+        models.ReferenceType,
+        models.Enrollment,
+        models.Study,
+    ]
+
     @reify
     def reftypes(self):
         return list(
             self.dbsession.query(models.ReferenceType)
             .order_by(models.ReferenceType.name))
 
+    def codebook_key(self):
+        return (super(PidPlan, self).codebook_key()
+                + [[r.name for r in self.reftypes]])
+
     def codebook(self):
         name = self.name
         knowns = [
@@ -65,7 +78,8 @@ class PidPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             modified_since=None):
         session = self.dbsession
         query = (
             session.query(
@@ -113,4 +127,7 @@ class PidPlan(ExportPlan):
             )
             .order_by(models.Patient.id))
 
+        if modified_since:
+            query = query.filter(models.Patient.modified_at > modified_since)
+
         return query
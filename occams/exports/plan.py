@@ -1,3 +1,18 @@
+from collections import namedtuple
+import time
+
+from sqlalchemy import func
+
+
+# Approximate size of a plan's data file (see `ExportPlan.estimate`)
+Estimate = namedtuple('Estimate', ['rows', 'columns', 'bytes'])
+
+# Number of seconds a plan's size estimate is reused for
+ESTIMATE_TTL = 600
+
+_estimate_cache = {}
+
+
 class ExportPlan(object):
     """
     An export plan
@@ -14,6 +29,8 @@ class ExportPlan(object):
 
     versions = []           # All versions avaialble
 
+    dependencies = []       # Models the data is generated from
+
     def __init__(self, dbsession=None):
         self.dbsession = dbsession
 
@@ -30,10 +47,23 @@ class ExportPlan(object):
         """
         raise NotImplemented  # pragma: nocover
 
+    def codebook_key(self):
+        """
+        Identifies the revision of this plan's codebook
+
+        Plans with the same key are guaranteed to produce the same codebook
+        rows, so that a previously generated codebook can be reused.
+
+        Returns:
+        A JSON-serializable list
+        """
+        return [self.name, list(map(str, self.versions))]
+
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             modified_since=None):
         """
         Generate export data
 
@@ -45,12 +75,102 @@ class ExportPlan(object):
                               default: False
         ignore_private -- (Optional) De-identity private information
                           default: True
+        modified_since -- (Optional) Only include records modified after
+                          this timestamp, for incremental exports.
+                          default: None
 
         Returns:
         An iterator of row data
         """
         raise NotImplemented  # pragma: nocover
 
+    def estimate(self, **options):
+        """
+        Estimates the size of the plan's data file
+
+        Estimates come from the query planner's statistics, so they are
+        cheap but approximate. They are cached for `ESTIMATE_TTL` seconds.
+
+        Parameters:
+        options -- the options passed to `data`
+
+        Returns:
+        An `Estimate`, or None if the database cannot estimate queries
+        """
+        from . import explain  # circular
+
+        key = (
+            str(self.dbsession.bind.url),
+            self.name,
+            tuple(map(str, self.versions)),
+            tuple(sorted((k, str(v)) for k, v in options.items())))
+        now = time.time()
+
+        cached = _estimate_cache.get(key)
+        if cached is not None and now - cached[0] < ESTIMATE_TTL:
+            return cached[1]
+
+        query = self.data(**options)
+        plan = explain(query)
+
+        if plan is None:
+            estimate = None
+        else:
+            rows = int(plan[0]['Plan']['Plan Rows'])
+            estimate = Estimate(
+                rows=rows,
+                columns=len(query.column_descriptions),
+                # Plan width is the average size of a row in bytes
+                bytes=rows * int(plan[0]['Plan']['Plan Width']))
+
+        _estimate_cache[key] = (now, estimate)
+        return estimate
+
+    def id_ranges(self, count, min_size=10000):
+        """
+        Splits the plan's data into record id ranges of similar size
+
+        Used to generate a data file in parallel shards, each range is passed
+        to `data` as the ``id_range`` option. Plans that cannot be split
+        return a single unbounded range.
+
+        Parameters:
+        count -- the maximum number of ranges
+        min_size -- (Optional) the minimum number of records per range
+
+        Returns:
+        A list of (start, stop) id ranges in ascending order, where start is
+        inclusive, stop is exclusive and None means unbounded. A single
+        None entry means the plan must be generated as a whole.
+        """
+        return [None]
+
+    def fingerprint(self):
+        """
+        Summarizes the current state of the data this plan exports
+
+        Any change to the underlying records should produce a different
+        fingerprint, so that a previously generated data file can be safely
+        reused as long as the fingerprint is the same.
+
+        Returns:
+        A list of (table, row count, last modification) entries, or None if
+        the plan does not declare its dependencies (i.e. is not cacheable)
+        """
+        if not self.dependencies:
+            return None
+        return [self._table_state(self.dbsession.query(model), model)
+                for model in self.dependencies]
+
+    @staticmethod
+    def _table_state(query, model):
+        count, modified_at = (
+            query
+            .with_entities(func.count(model.id), func.max(model.modified_at))
+            .one())
+        return [model.__tablename__, count,
+                modified_at and modified_at.isoformat()]
+
     def to_json(self):
         """
         Serialize to JSON
@@ -0,0 +1,108 @@
+"""
+Data file profiling
+
+Profiles break down where the time writing a data file goes: compiling the
+plan's query, waiting on the database for rows and serializing them in
+Python. They are meant for diagnosing slow plans, not for every export,
+since the query planner's analysis executes the query a second time.
+"""
+
+from timeit import default_timer
+
+import six
+
+from .progress import ProgressMeter
+
+
+class TimedQuery(object):
+    """
+    A query proxy that accumulates the time spent fetching its rows
+    """
+
+    def __init__(self, query, clock=default_timer):
+        self.query = query
+        self.clock = clock
+        self.fetch_time = 0.0
+        self.iterated = False
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+    def yield_per(self, count):
+        self.query = self.query.yield_per(count)
+        return self
+
+    def __iter__(self):
+        self.iterated = True
+        started = self.clock()
+        rows = iter(self.query)
+        self.fetch_time += self.clock() - started
+        while True:
+            started = self.clock()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self.fetch_time += self.clock() - started
+                return
+            self.fetch_time += self.clock() - started
+            yield row
+
+
+def profile_data(buffer, query, write_data, batch_size=None, progress=None,
+                 analyze=True, clock=default_timer):
+    """
+    Writes a data file while profiling it
+
+    Arguments:
+    buffer -- a file object which will be used to write data contents
+    query -- SQLAlchemy query that will be writen to a CSV file
+    write_data -- the data file writer (see `engines`)
+    batch_size -- (Optional) number of rows to fetch at a time
+    progress -- (Optional) a `progress.ProgressMeter` to count rows and
+                bytes written with
+    analyze -- (Optional) include the query planner's analysis of the query
+    clock -- (Optional) the time source, for testing
+
+    Returns:
+    A dictionary of the profile with the following keys:
+    sql -- the generated SQL
+    compile_time -- seconds spent compiling the query
+    plan -- the ``EXPLAIN (ANALYZE, BUFFERS)`` output, if available
+    db_time -- seconds spent waiting on the database for rows
+    serialize_time -- seconds spent serializing rows in Python
+    total_time -- seconds spent writing the data file
+    rows -- number of data rows written
+    bytes -- number of bytes written
+    """
+    from . import explain  # circular
+
+    connection = query.session.connection()
+
+    started = clock()
+    compiled = query.statement.compile(dialect=connection.dialect)
+    sql = six.text_type(compiled)
+    compile_time = clock() - started
+
+    plan = explain(query, analyze=True) if analyze else None
+
+    if progress is None:
+        progress = ProgressMeter(lambda meter: None, interval=float('inf'))
+
+    timed = TimedQuery(query, clock=clock)
+    started = clock()
+    write_data(buffer, timed, batch_size=batch_size, progress=progress)
+    total_time = clock() - started
+
+    # Writers that never iterate the query leave serialization to the database
+    db_time = timed.fetch_time if timed.iterated else total_time
+
+    return {
+        'sql': sql,
+        'compile_time': compile_time,
+        'plan': plan,
+        'db_time': db_time,
+        'serialize_time': total_time - db_time,
+        'total_time': total_time,
+        'rows': progress.rows,
+        'bytes': progress.bytes,
+    }
@@ -0,0 +1,108 @@
+"""
+Data file progress tracking
+
+Data file writers report the number of rows and bytes they have written
+through a meter, which relays them to a callback at a throttled interval
+so that progress can be published without slowing down the export.
+"""
+
+from __future__ import division
+
+import time
+
+
+class ProgressMeter(object):
+    """
+    Counts the rows and bytes written to a data file
+    """
+
+    def __init__(self, callback, interval=5.0, clock=time.time):
+        """
+        Parameters:
+        callback -- called with the meter whenever progress is reported,
+                    see `pending` for the counters since the last report
+        interval -- (Optional) minimum number of seconds between reports
+        clock -- (Optional) the time source, for testing
+        """
+        self.callback = callback
+        self.interval = interval
+        self.clock = clock
+        self.rows = 0
+        self.bytes = 0
+        self.started = self._reported = clock()
+        self._reported_rows = 0
+        self._reported_bytes = 0
+
+    @property
+    def elapsed(self):
+        return max(self.clock() - self.started, 0)
+
+    @property
+    def rate(self):
+        """
+        The average number of rows written per second
+        """
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed else 0.0
+
+    @property
+    def pending(self):
+        """
+        The (rows, bytes) written since the last report
+        """
+        return (self.rows - self._reported_rows,
+                self.bytes - self._reported_bytes)
+
+    def update(self, rows=0, bytes=0):
+        """
+        Adds to the counters, reporting them if the interval has elapsed
+        """
+        self.rows += rows
+        self.bytes += bytes
+        if self.clock() - self._reported >= self.interval:
+            self.report()
+
+    def report(self):
+        """
+        Reports the current counters immediately
+        """
+        self.callback(self)
+        self._reported = self.clock()
+        self._reported_rows = self.rows
+        self._reported_bytes = self.bytes
+
+    def wrap(self, buffer, count_rows=False):
+        """
+        Wraps a file object so that the bytes written to it are counted
+
+        Parameters:
+        buffer -- the file object to wrap
+        count_rows -- (Optional) also count rows as CSV lines written after
+                      the header, for writers that only produce raw output
+        """
+        return MeteredBuffer(buffer, self, count_rows=count_rows)
+
+
+class MeteredBuffer(object):
+    """
+    A write-only file object proxy that updates a progress meter
+    """
+
+    def __init__(self, buffer, meter, count_rows=False):
+        self.buffer = buffer
+        self.meter = meter
+        self.count_rows = count_rows
+        self._header = count_rows
+
+    def write(self, data):
+        rows = 0
+        if self.count_rows:
+            rows = data.count(b'\n')
+            if self._header and rows:
+                rows -= 1
+                self._header = False
+        self.buffer.write(data)
+        self.meter.update(rows=rows, bytes=len(data))
+
+    def flush(self):
+        self.buffer.flush()
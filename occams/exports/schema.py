@@ -10,13 +10,13 @@ Also incorporates:
 
 from datetime import datetime
 from six import itervalues
-from sqlalchemy import orm, null, cast, String, literal_column
+from sqlalchemy import orm, func, null, cast, String, literal_column
 
 
 from .. import models
 from .plan import ExportPlan
 from .codebook import types, row
-from ..reporting import build_report
+from ..reporting import build_columns, build_report
 from ..utils.sql import group_concat, to_date
 
 
@@ -24,6 +24,18 @@ class SchemaPlan(ExportPlan):
 
     is_system = False
 
+    # Context records the form data is reported with
+    dependencies = [
+        models.Patient,
+        models.Site,
+        models.Enrollment,
+        models.Study,
+        models.Visit,
+        models.Cycle,
+        models.Stratum,
+        models.Arm,
+    ]
+
     @classmethod
     def from_sql(cls, dbsession, record):
         """
@@ -43,27 +55,21 @@ class SchemaPlan(ExportPlan):
         """
         Creates a plan from a schema name
         """
-        subquery = _list_schemata_info(dbsession).subquery()
-        query = dbsession.query(subquery).filter(subquery.c.name == name)
-        return cls.from_sql(dbsession, query.one())
+        for record in _list_schemata_catalog(dbsession):
+            if record.name == name:
+                return cls.from_sql(dbsession, record)
+        raise orm.exc.NoResultFound(name)
 
     @classmethod
     def list_all(cls, dbsession, include_rand=True, include_private=True):
         """
         Lists all the schema plans
         """
-        subquery = _list_schemata_info(dbsession).subquery()
-        query = dbsession.query(subquery)
-
-        if not include_rand:
-            query = query.filter(~subquery.c.has_rand)
-
-        if not include_private:
-            query = query.filter(~subquery.c.has_private)
-
-        query = query.order_by(subquery.c.title)
-
-        return [cls.from_sql(dbsession, r) for r in query]
+        return [
+            cls.from_sql(dbsession, r)
+            for r in _list_schemata_catalog(dbsession)
+            if (include_rand or not r.has_rand)
+            and (include_private or not r.has_private)]
 
     @property
     def _is_aeh_partner_form(self):
@@ -75,6 +81,11 @@ class SchemaPlan(ExportPlan):
                 'IPartnerDemographics',
                 'IPartnerDisclosure'))
 
+    def codebook_key(self):
+        # Published versions are never modified, only the system columns vary
+        return (super(SchemaPlan, self).codebook_key()
+                + [self.has_rand, self._is_aeh_partner_form])
+
     def codebook(self):
         session = self.dbsession
         knowns = [
@@ -126,31 +137,25 @@ class SchemaPlan(ExportPlan):
         for column in knowns:
             yield column
 
-        query = (
-            session.query(models.Attribute)
-            .join(models.Schema)
-            .filter(models.Schema.name == self.name)
-            .filter(models.Schema.publish_date.in_(self.versions))
-            .filter(models.Schema.retract_date == null()))
-
-        query = (
-            query.order_by(
-                models.Attribute.name,
-                models.Schema.publish_date))
+        # Share the column plans of the data file
+        attributes = sorted(
+            (attribute
+             for column in itervalues(build_columns(session, self.name))
+             for attribute in column.attributes),
+            key=lambda a: (a.name, a.publish_date))
 
-        for attribute in query:
-            yield row(attribute.name, attribute.schema.name, attribute.type,
+        for attribute in attributes:
+            yield row(attribute.name, attribute.schema_name, attribute.type,
                       decimal_places=attribute.decimal_places,
-                      form=attribute.schema.title,
-                      publish_date=attribute.schema.publish_date,
+                      form=attribute.schema_title,
+                      publish_date=attribute.publish_date,
                       title=attribute.title,
                       desc=attribute.description,
                       is_required=attribute.is_required,
                       is_collection=attribute.is_collection,
                       order=attribute.order,
                       is_private=attribute.is_private,
-                      choices=[(c.name, c.title)
-                               for c in itervalues(attribute.choices)])
+                      choices=list(attribute.choices))
 
         footer = [
             row('created_at', self.name, types.DATE,
@@ -165,13 +170,58 @@ class SchemaPlan(ExportPlan):
         for column in footer:
             yield column
 
+    def fingerprint(self):
+        session = self.dbsession
+        entities_query = (
+            session.query(models.Entity)
+            .join(models.Entity.schema)
+            .filter(models.Schema.name == self.name))
+        contexts_query = (
+            session.query(models.Context)
+            .filter(models.Context.entity_id.in_(
+                entities_query.with_entities(models.Entity.id).subquery())))
+        return (
+            [self._table_state(entities_query, models.Entity),
+             self._table_state(contexts_query, models.Context)]
+            + super(SchemaPlan, self).fingerprint())
+
+    def id_ranges(self, count, min_size=10000):
+        session = self.dbsession
+        entities_query = (
+            session.query(models.Entity.id.label('id'))
+            .join(models.Entity.schema)
+            .filter(models.Schema.name == self.name)
+            .filter(models.Schema.publish_date.in_(self.versions)))
+
+        count = min(count, entities_query.count() // min_size)
+        if count < 2:
+            return [None]
+
+        buckets = (
+            entities_query
+            .add_column(
+                func.ntile(count).over(order_by=models.Entity.id)
+                .label('bucket'))
+            .subquery())
+        starts = [
+            start for start, in
+            session.query(func.min(buckets.c.id))
+            .group_by(buckets.c.bucket)
+            .order_by(func.min(buckets.c.id))]
+
+        bounds = [None] + starts[1:] + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             modified_since=None,
+             id_range=None):
         session = self.dbsession
         ids_query = (
             session.query(models.Schema.id)
+            .filter(models.Schema.name == self.name)
             .filter(models.Schema.publish_date.in_(self.versions)))
         ids = [id for id, in ids_query]
 
@@ -183,52 +233,72 @@ class SchemaPlan(ExportPlan):
             use_choice_labels=use_choice_labels,
             ignore_private=ignore_private)
 
+        # Shards only include records in an id range (see `id_ranges`)
+        def in_range(column):
+            start, stop = id_range or (None, None)
+            criteria = []
+            if start is not None:
+                criteria.append(column >= start)
+            if stop is not None:
+                criteria.append(column < stop)
+            return criteria
+
+        def context_query(external, *columns):
+            # Only aggregate the contexts of the entities being reported
+            return (
+                session.query(models.Context.entity_id, *columns)
+                .join(models.Entity,
+                      models.Entity.id == models.Context.entity_id)
+                .filter(models.Entity.schema_id.in_(ids))
+                .filter(*in_range(models.Entity.id))
+                .filter(models.Context.external == external))
+
+        # Single-valued contexts are already resolved per entity by the
+        # trigger-maintained summary table, multi-valued contexts are
+        # pre-aggregated once per entity and then joined to the report,
+        # rather than looked up for every row
+        summary = models.EntitySummary
+
+        enrollment_context = (
+            context_query(
+                u'enrollment',
+                group_concat(models.Study.name, ';').label('enrollment'),
+                group_concat(models.Enrollment.id, ';')
+                .label('enrollment_ids'))
+            .join(models.Enrollment,
+                  models.Context.key == models.Enrollment.id)
+            .join(models.Enrollment.study)
+            .group_by(models.Context.entity_id)
+            .subquery('enrollment_context'))
+
+        cycle_context = (
+            session.query(
+                summary.entity_id,
+                group_concat(models.Study.title
+                             + literal_column(u"'('")
+                             + cast(models.Cycle.week, String)
+                             + literal_column(u"')'"),
+                             literal_column(u"';'")).label('visit_cycles'))
+            .join(models.Visit, summary.visit_id == models.Visit.id)
+            .join(models.Visit.cycles)
+            .join(models.Cycle.study)
+            .filter(summary.schema_name == self.name)
+            .filter(*in_range(summary.entity_id))
+            .group_by(summary.entity_id)
+            .subquery('cycle_context'))
+
         query = (
             session.query(report.c.id.label('id'))
-            .add_column(
-                session.query(models.Patient.pid)
-                .join(models.Context,
-                      (models.Context.external == u'patient')
-                      & (models.Context.key == models.Patient.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('pid'))
-            .add_column(
-                session.query(models.Site.name)
-                .select_from(models.Patient)
-                .join(models.Site)
-                .join(models.Context,
-                      (models.Context.external == u'patient')
-                      & (models.Context.key == models.Patient.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('site'))
-            .add_column(
-                session.query(group_concat(models.Study.name, ';'))
-                .select_from(models.Enrollment)
-                .join(models.Study)
-                .join(models.Context,
-                      (models.Context.external == u'enrollment')
-                      & (models.Context.key == models.Enrollment.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
-                .label('enrollment'))
-            .add_column(
-                session.query(group_concat(models.Enrollment.id, ';'))
-                .select_from(models.Enrollment)
-                .join(models.Context,
-                      (models.Context.external == u'enrollment')
-                      & (models.Context.key == models.Enrollment.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
-                .label('enrollment_ids'))
-            )
+            .outerjoin(summary, summary.entity_id == report.c.id)
+            .outerjoin(models.Patient, summary.patient_id == models.Patient.id)
+            .outerjoin(models.Site, summary.site_id == models.Site.id)
+            .outerjoin(enrollment_context,
+                       enrollment_context.c.entity_id == report.c.id)
+            .add_columns(
+                models.Patient.pid.label('pid'),
+                models.Site.name.label('site'),
+                enrollment_context.c.enrollment,
+                enrollment_context.c.enrollment_ids))
 
         if self._is_aeh_partner_form:
             PartnerPatient = orm.aliased(models.Patient)
@@ -259,85 +329,66 @@ class SchemaPlan(ExportPlan):
         if self.has_rand:
             query = (
                 query
-                .add_column(
-                    session.query(models.Stratum.block_number)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('block_number'))
-                .add_column(
-                    session.query(models.Stratum.randid)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('randid'))
-                .add_column(
-                    session.query(models.Arm.title)
-                    .select_from(models.Stratum)
-                    .join(models.Context,
-                          (models.Context.external == u'stratum')
-                          & (models.Context.key == models.Stratum.id))
-                    .filter(models.Context.entity_id == report.c.id)
-                    .join(models.Stratum.arm)
-                    .correlate(report)
-                    .as_scalar()
-                    .label('arm_name')))
+                .outerjoin(models.Stratum,
+                           summary.stratum_id == models.Stratum.id)
+                .outerjoin(models.Stratum.arm)
+                .add_columns(
+                    models.Stratum.block_number.label('block_number'),
+                    models.Stratum.randid.label('randid'),
+                    models.Arm.title.label('arm_name')))
 
         query = (
             query
-            .add_column(
-                session.query(group_concat(models.Study.title
-                                           + literal_column(u"'('")
-                                           + cast(models.Cycle.week, String)
-                                           + literal_column(u"')'"),
-                                           literal_column(u"';'")))
-                .select_from(models.Visit)
-                .join(models.Visit.cycles)
-                .join(models.Cycle.study)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .group_by(models.Context.entity_id)
-                .correlate(report)
-                .as_scalar()
-                .label('visit_cycles'))
-            .add_column(
-                session.query(models.Visit.id)
-                .select_from(models.Visit)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('visit_id'))
-            .add_column(
-                session.query(models.Visit.visit_date)
-                .select_from(models.Visit)
-                .join(models.Context,
-                      (models.Context.external == u'visit')
-                      & (models.Context.key == models.Visit.id))
-                .filter(models.Context.entity_id == report.c.id)
-                .correlate(report)
-                .as_scalar()
-                .label('visit_date'))
-        )
+            .outerjoin(cycle_context,
+                       cycle_context.c.entity_id == report.c.id)
+            .add_columns(
+                cycle_context.c.visit_cycles,
+                summary.visit_id.label('visit_id'),
+                summary.visit_date.label('visit_date')))
 
         query = query.add_columns(
             *[c for c in report.columns if c.name != 'id'])
 
+        if modified_since:
+            query = query.filter(report.c.modify_date > modified_since)
+
+        query = query.filter(*in_range(report.c.id))
+
+        # Joins don't preserve the report's order
+        query = query.order_by(report.c.id)
+
         return query
 
 
+# Catalog of exportable schemata, keyed by database URL
+_catalog_cache = {}
+
+
+def _list_schemata_catalog(dbsession):
+    """
+    Lists the exportable schemata records, ordered by title
+
+    The records are cached per database and rebuilt only when the catalog
+    version has changed since they were last listed (see
+    `models.CatalogVersion` for the changes it covers).
+    """
+    key = str(dbsession.bind.url)
+    version = (
+        dbsession.query(models.CatalogVersion.version)
+        .filter_by(id=1)
+        .scalar())
+    cached = _catalog_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    subquery = _list_schemata_info(dbsession).subquery()
+    records = (
+        dbsession.query(subquery)
+        .order_by(subquery.c.title)
+        .all())
+    _catalog_cache[key] = (version, records)
+    return records
+
+
 def _list_schemata_info(dbsession):
     InnerSchema = orm.aliased(models.Schema)
     OuterSchema = orm.aliased(models.Schema)
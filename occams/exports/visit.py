@@ -15,6 +15,14 @@ class VisitPlan(ExportPlan):
 
     title = _(u'Visits')
 
+    dependencies = [
+        models.Visit,
+        models.Patient,
+        models.Site,
+        models.Cycle,
+        models.Study,
+    ]
+
     def codebook(self):
         return iter([
             row('id', self.name, types.NUMBER, decimal_places=0,
@@ -40,7 +48,8 @@ class VisitPlan(ExportPlan):
     def data(self,
              use_choice_labels=False,
              expand_collections=False,
-             ignore_private=True):
+             ignore_private=True,
+             modified_since=None):
         session = self.dbsession
         query = (
             session.query(
@@ -61,4 +70,8 @@ class VisitPlan(ExportPlan):
             .join(models.Cycle.study)
             .join(models.Patient.site)
             .order_by(models.Visit.id))
+
+        if modified_since:
+            query = query.filter(models.Visit.modified_at > modified_since)
+
         return query
@@ -35,6 +35,8 @@ from .studies import (  # noqa
     Visit,
     ExportFactory,
     Export,
+    EntitySummary,
+    CatalogVersion,
     EntryFactory,
     Survey,
     SurveyFactory
@@ -51,6 +53,7 @@ from .schema import (  # noqa
     Schema,
     Category,
     Attribute,
+    AttributeLineage,
     Choice
 )
 
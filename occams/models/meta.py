@@ -22,7 +22,7 @@ def after_create(target, connection, **kw):
     for table in target.sorted_tables:
 
         if table.info.get('audit_exclude'):
-            return
+            continue
 
         exclude_columns = \
             [c.name for c in table.c if c.info.get('audit_exclude')]
@@ -10,6 +10,7 @@ import re
 from six import iterkeys, iteritems, itervalues
 import sqlalchemy as sa
 from sqlalchemy import orm
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm.collections import attribute_mapped_collection
@@ -673,3 +674,155 @@ sa.CheckConstraint(
     sa.cast(Choice.name, sa.Integer) != sa.sql.null(),
     name='ck_choice_numeric_name'
 )
+
+
+# Builds the lineage rows of published attributes, filtered by the caller
+ATTRIBUTE_LINEAGE_SELECT = """
+    SELECT DISTINCT ON (schema.name, attribute.name)
+        schema.name,
+        attribute.name,
+        attribute."order",
+        attribute.title,
+        attribute.type,
+        array_agg(schema.publish_date) OVER (
+            PARTITION BY schema.name, attribute.name
+            ORDER BY schema.publish_date
+            ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+    FROM attribute
+    JOIN schema ON schema.id = attribute.schema_id
+    WHERE schema.publish_date IS NOT NULL
+    AND schema.retract_date IS NULL
+    AND attribute.type != 'section'
+"""
+
+# Picks the most recent version of each attribute for its lineage
+ATTRIBUTE_LINEAGE_ORDER = """
+    ORDER BY schema.name, attribute.name, schema.publish_date DESC
+"""
+
+ATTRIBUTE_LINEAGE_COLUMNS = """
+    schema_name, attribute_name, latest_order, latest_title, type, versions
+"""
+
+
+class AttributeLineage(Base):
+    """
+    The history of an attribute name across the published versions of a form
+
+    Used to order report columns by the most recent position of each
+    attribute. This table is maintained by database triggers as schemata are
+    published or retracted, so it should never be modified directly.
+    """
+
+    __tablename__ = 'attribute_lineage'
+
+    schema_name = sa.Column(sa.String, primary_key=True)
+
+    attribute_name = sa.Column(sa.String(100), primary_key=True)
+
+    latest_order = sa.Column(sa.Integer, nullable=False)
+
+    latest_title = sa.Column(sa.Unicode)
+
+    type = sa.Column(sa.String, nullable=False)
+
+    versions = sa.Column(ARRAY(sa.Date), nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            sa.Index(
+                'ix_%s_latest_order' % cls.__tablename__,
+                'schema_name', 'latest_order'),
+            {'info': {'audit_exclude': True}})
+
+
+@sa.event.listens_for(Base.metadata, 'after_create')
+def create_attribute_lineage_triggers(target, connection, **kw):
+    """
+    Creates the stored procedures that keep attribute lineages up-to-date
+    """
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION
+            attribute_lineage_refresh(target_name varchar)
+            RETURNS void AS $$
+        BEGIN
+            DELETE FROM attribute_lineage WHERE schema_name = target_name;
+            INSERT INTO attribute_lineage (%(columns)s)
+            %(select)s
+            AND schema.name = target_name
+            %(order)s;
+        END;
+        $$ LANGUAGE plpgsql;
+    """ % {'columns': ATTRIBUTE_LINEAGE_COLUMNS,
+           'select': ATTRIBUTE_LINEAGE_SELECT,
+           'order': ATTRIBUTE_LINEAGE_ORDER})
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION attribute_lineage_backfill()
+            RETURNS void AS $$
+        BEGIN
+            DELETE FROM attribute_lineage;
+            INSERT INTO attribute_lineage (%(columns)s)
+            %(select)s
+            %(order)s;
+        END;
+        $$ LANGUAGE plpgsql;
+    """ % {'columns': ATTRIBUTE_LINEAGE_COLUMNS,
+           'select': ATTRIBUTE_LINEAGE_SELECT,
+           'order': ATTRIBUTE_LINEAGE_ORDER})
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION attribute_lineage_trigger()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            IF tg_table_name = 'schema' THEN
+                IF tg_op = 'INSERT' THEN
+                    PERFORM attribute_lineage_refresh(NEW.name);
+                ELSIF tg_op = 'DELETE' THEN
+                    PERFORM attribute_lineage_refresh(OLD.name);
+                ELSE
+                    PERFORM attribute_lineage_refresh(OLD.name);
+                    IF NEW.name != OLD.name THEN
+                        PERFORM attribute_lineage_refresh(NEW.name);
+                    END IF;
+                END IF;
+            ELSE
+                -- Only published attributes are part of a lineage
+                IF tg_op = 'INSERT' THEN
+                    PERFORM attribute_lineage_refresh(schema.name)
+                    FROM schema
+                    WHERE schema.id = NEW.schema_id
+                    AND schema.publish_date IS NOT NULL;
+                ELSE
+                    PERFORM attribute_lineage_refresh(schema.name)
+                    FROM schema
+                    WHERE schema.id = OLD.schema_id
+                    AND schema.publish_date IS NOT NULL;
+                    IF tg_op = 'UPDATE' AND NEW.schema_id != OLD.schema_id THEN
+                        PERFORM attribute_lineage_refresh(schema.name)
+                        FROM schema
+                        WHERE schema.id = NEW.schema_id
+                        AND schema.publish_date IS NOT NULL;
+                    END IF;
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    connection.execute(r"""
+        DROP TRIGGER IF EXISTS attribute_lineage_trigger ON schema;
+        CREATE TRIGGER attribute_lineage_trigger
+        AFTER INSERT OR DELETE OR UPDATE OF name, publish_date, retract_date
+        ON schema
+        FOR EACH ROW EXECUTE PROCEDURE attribute_lineage_trigger();
+
+        DROP TRIGGER IF EXISTS attribute_lineage_trigger ON attribute;
+        CREATE TRIGGER attribute_lineage_trigger
+        AFTER INSERT OR UPDATE OR DELETE
+        ON attribute
+        FOR EACH ROW EXECUTE PROCEDURE attribute_lineage_trigger();
+    """)
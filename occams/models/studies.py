@@ -8,7 +8,7 @@ import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 
 from .groups import groups
 from .meta import Base
@@ -1128,6 +1128,293 @@ def _entity_acl(self):
 Entity.__acl__ = property(_entity_acl)
 
 
+# Builds the summary rows of entities, filtered by the caller
+ENTITY_SUMMARY_SELECT = """
+    SELECT
+        entity.id,
+        schema.name,
+        state.name,
+        COALESCE(patient.id, visit.patient_id),
+        (SELECT site_id
+         FROM patient AS p
+         WHERE p.id = COALESCE(patient.id, visit.patient_id)),
+        visit.id,
+        visit.visit_date,
+        (SELECT array_agg(context.key ORDER BY context.key)
+         FROM context
+         WHERE context.entity_id = entity.id
+         AND context.external = 'enrollment'),
+        (SELECT context.key
+         FROM context
+         WHERE context.entity_id = entity.id
+         AND context.external = 'stratum'
+         ORDER BY context.key
+         LIMIT 1)
+    FROM entity
+    JOIN schema ON schema.id = entity.schema_id
+    LEFT JOIN state ON state.id = entity.state_id
+    LEFT JOIN patient ON patient.id = (
+        SELECT context.key
+        FROM context
+        WHERE context.entity_id = entity.id
+        AND context.external = 'patient'
+        ORDER BY context.key
+        LIMIT 1)
+    LEFT JOIN visit ON visit.id = (
+        SELECT context.key
+        FROM context
+        WHERE context.entity_id = entity.id
+        AND context.external = 'visit'
+        ORDER BY context.key
+        LIMIT 1)
+"""
+
+ENTITY_SUMMARY_COLUMNS = """
+    entity_id, schema_name, state, patient_id, site_id,
+    visit_id, visit_date, enrollment_ids, stratum_id
+"""
+
+# Tables that affect entity summaries
+ENTITY_SUMMARY_SOURCES = [
+    'entity', 'context', 'patient', 'visit', 'enrollment']
+
+
+class EntitySummary(Base):
+    """
+    Denormalized entity context, for reporting
+
+    Resolves the polymorphic ``Context`` associations of an entity into
+    plain indexed columns. This table is maintained by database triggers,
+    so it should never be modified directly.
+    """
+
+    __tablename__ = 'entity_summary'
+
+    entity_id = sa.Column(
+        sa.BigInteger,
+        sa.ForeignKey(Entity.id, ondelete='CASCADE'),
+        primary_key=True)
+
+    entity = orm.relationship(Entity)
+
+    schema_name = sa.Column(sa.String, nullable=False)
+
+    state = sa.Column(sa.String)
+
+    patient_id = sa.Column(sa.Integer)
+
+    site_id = sa.Column(sa.Integer)
+
+    visit_id = sa.Column(sa.Integer)
+
+    visit_date = sa.Column(sa.Date)
+
+    enrollment_ids = sa.Column(ARRAY(sa.Integer))
+
+    stratum_id = sa.Column(sa.Integer)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            sa.Index('ix_%s_schema_name' % cls.__tablename__, 'schema_name'),
+            sa.Index('ix_%s_patient_id' % cls.__tablename__, 'patient_id'),
+            sa.Index('ix_%s_site_id' % cls.__tablename__, 'site_id'),
+            sa.Index('ix_%s_visit_id' % cls.__tablename__, 'visit_id'),
+            sa.Index('ix_%s_stratum_id' % cls.__tablename__, 'stratum_id'),
+            {'info': {'audit_exclude': True}})
+
+
+@sa.event.listens_for(Base.metadata, 'after_create')
+def create_entity_summary_triggers(target, connection, **kw):
+    """
+    Creates the stored procedures that keep entity summaries up-to-date
+    """
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION entity_summary_refresh(target_id bigint)
+            RETURNS void AS $$
+        BEGIN
+            DELETE FROM entity_summary WHERE entity_id = target_id;
+            INSERT INTO entity_summary (%(columns)s)
+            %(select)s
+            WHERE entity.id = target_id;
+        END;
+        $$ LANGUAGE plpgsql;
+    """ % {'columns': ENTITY_SUMMARY_COLUMNS,
+           'select': ENTITY_SUMMARY_SELECT})
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION entity_summary_backfill()
+            RETURNS void AS $$
+        BEGIN
+            DELETE FROM entity_summary;
+            INSERT INTO entity_summary (%(columns)s)
+            %(select)s;
+        END;
+        $$ LANGUAGE plpgsql;
+    """ % {'columns': ENTITY_SUMMARY_COLUMNS,
+           'select': ENTITY_SUMMARY_SELECT})
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION entity_summary_trigger()
+            RETURNS TRIGGER AS $$
+        DECLARE
+            _key bigint;
+        BEGIN
+            IF tg_table_name = 'entity' THEN
+                IF tg_op != 'DELETE' THEN
+                    PERFORM entity_summary_refresh(NEW.id);
+                END IF;
+            ELSIF tg_table_name = 'context' THEN
+                IF tg_op != 'INSERT' THEN
+                    PERFORM entity_summary_refresh(OLD.entity_id);
+                END IF;
+                IF tg_op != 'DELETE' THEN
+                    PERFORM entity_summary_refresh(NEW.entity_id);
+                END IF;
+            ELSE
+                IF tg_op = 'DELETE' THEN
+                    _key := OLD.id;
+                ELSE
+                    _key := NEW.id;
+                END IF;
+                IF tg_table_name = 'patient' THEN
+                    -- Includes patients only resolved through visits
+                    PERFORM entity_summary_refresh(entity_id)
+                    FROM (
+                        SELECT entity_id
+                        FROM entity_summary
+                        WHERE patient_id = _key
+                        UNION
+                        SELECT entity_id
+                        FROM context
+                        WHERE external = 'patient' AND key = _key
+                    ) AS affected;
+                ELSE
+                    PERFORM entity_summary_refresh(entity_id)
+                    FROM context
+                    WHERE external = tg_table_name AND key = _key;
+                END IF;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    for table_name in ENTITY_SUMMARY_SOURCES:
+        connection.execute(r"""
+            DROP TRIGGER IF EXISTS entity_summary_trigger ON %(table)s;
+            CREATE TRIGGER entity_summary_trigger
+            AFTER INSERT OR UPDATE OR DELETE
+            ON %(table)s
+            FOR EACH ROW EXECUTE PROCEDURE entity_summary_trigger();
+        """ % {'table': table_name})
+
+
+class CatalogVersion(Base):
+    """
+    Version of the exportable schemata catalog, for caching
+
+    A single row whose version is replaced with a new sequence value, by
+    database triggers, in the same transaction as any change to:
+    * Schemata names, titles, publish or retract dates
+    * Attribute privacy, or attributes added to or removed from schemata
+    * Strata, or their association with entities (i.e. randomization)
+    Versions are never reused, even if the transaction is rolled back, so
+    a catalog cached with a version is current for as long as it is the
+    committed version. This table should never be modified directly.
+    """
+
+    __tablename__ = 'catalog_version'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+
+    version = sa.Column(
+        sa.BigInteger,
+        sa.Sequence('catalog_version_seq'),
+        nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            sa.CheckConstraint(
+                'id = 1', name='ck_%s_single' % cls.__tablename__),
+            {'info': {'audit_exclude': True}})
+
+
+@sa.event.listens_for(Base.metadata, 'after_create')
+def create_catalog_version_triggers(target, connection, **kw):
+    """
+    Creates the stored procedures that version the exportable catalog
+    """
+
+    connection.execute(r"""
+        INSERT INTO catalog_version (id, version)
+        SELECT 1, nextval('catalog_version_seq')
+        WHERE NOT EXISTS (SELECT 1 FROM catalog_version);
+    """)
+
+    connection.execute(r"""
+        CREATE OR REPLACE FUNCTION catalog_version_trigger()
+            RETURNS TRIGGER AS $$
+        BEGIN
+            UPDATE catalog_version
+            SET version = nextval('catalog_version_seq');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    connection.execute(r"""
+        DROP TRIGGER IF EXISTS catalog_version_trigger ON schema;
+        CREATE TRIGGER catalog_version_trigger
+        AFTER INSERT OR DELETE
+            OR UPDATE OF name, title, publish_date, retract_date
+        ON schema
+        FOR EACH STATEMENT EXECUTE PROCEDURE catalog_version_trigger();
+
+        DROP TRIGGER IF EXISTS catalog_version_trigger ON attribute;
+        CREATE TRIGGER catalog_version_trigger
+        AFTER INSERT OR DELETE OR UPDATE OF schema_id, is_private
+        ON attribute
+        FOR EACH STATEMENT EXECUTE PROCEDURE catalog_version_trigger();
+
+        DROP TRIGGER IF EXISTS catalog_version_trigger ON stratum;
+        CREATE TRIGGER catalog_version_trigger
+        AFTER INSERT OR DELETE
+        ON stratum
+        FOR EACH STATEMENT EXECUTE PROCEDURE catalog_version_trigger();
+
+        DROP TRIGGER IF EXISTS catalog_version_trigger ON entity;
+        CREATE TRIGGER catalog_version_trigger
+        AFTER UPDATE OF schema_id
+        ON entity
+        FOR EACH STATEMENT EXECUTE PROCEDURE catalog_version_trigger();
+
+        -- Entity contexts change with every entry, only strata matter
+        DROP TRIGGER IF EXISTS catalog_version_insert_trigger ON context;
+        CREATE TRIGGER catalog_version_insert_trigger
+        AFTER INSERT
+        ON context
+        FOR EACH ROW WHEN (NEW.external = 'stratum')
+        EXECUTE PROCEDURE catalog_version_trigger();
+
+        DROP TRIGGER IF EXISTS catalog_version_update_trigger ON context;
+        CREATE TRIGGER catalog_version_update_trigger
+        AFTER UPDATE
+        ON context
+        FOR EACH ROW WHEN ('stratum' IN (OLD.external, NEW.external))
+        EXECUTE PROCEDURE catalog_version_trigger();
+
+        DROP TRIGGER IF EXISTS catalog_version_delete_trigger ON context;
+        CREATE TRIGGER catalog_version_delete_trigger
+        AFTER DELETE
+        ON context
+        FOR EACH ROW WHEN (OLD.external = 'stratum')
+        EXECUTE PROCEDURE catalog_version_trigger();
+    """)
+
+
 class ExportFactory(object):
 
     __acl__ = [
@@ -1210,6 +1497,23 @@ class Export(Base,
             AT THE TIME this export was generated.
             """)
 
+    modified_since = sa.Column(
+        sa.DateTime(timezone=True),
+        doc='If set, only records modified after this time are exported')
+
+    scheduled_at = sa.Column(
+        sa.DateTime,
+        doc='If set, the export is queued once this time has passed')
+
+    file_size = sa.Column(
+        sa.BigInteger,
+        doc='Size of the archive in bytes, set once the export is complete')
+
+    fingerprint = sa.Column(
+        sa.String,
+        doc='Identifies the data and options of this export, so that '
+            'identical requests can share the same archive')
+
     @property
     def path(self):
         """
@@ -1221,14 +1525,6 @@ class Export(Base,
         if export_dir:
             return os.path.join(export_dir, self.name)
 
-    @property
-    def file_size(self):
-        """
-        Virtual attribute that returns export's file size (if complete)
-        """
-        if self.status == 'complete':
-            return os.path.getsize(self.path)
-
     @property
     def expire_date(self):
         """
@@ -1238,7 +1534,7 @@ class Export(Base,
         session = orm.object_session(self)
         delta = session.info.get('settings', {}).get('studies.export.expire')
         if delta:
-            return self.modify_date + timedelta(delta)
+            return self.modified_at + timedelta(delta)
 
     @property
     def redis_key(self):
@@ -1256,7 +1552,10 @@ class Export(Base,
                 cls.name, name=u'uq_%s_name' % cls.__tablename__),
             sa.Index(
                 'ix_%s_owner_user_id' % cls.__tablename__,
-                cls.owner_user_id))
+                cls.owner_user_id),
+            sa.Index(
+                'ix_%s_fingerprint' % cls.__tablename__,
+                cls.fingerprint))
 
 
 class Survey(Base, Referenceable, Modifiable):
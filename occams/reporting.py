@@ -2,16 +2,31 @@
 A utility for allowing the access of entered schema data to be represented
 in a SQL table-like fashion.
 """
+from collections import namedtuple
 try:
     from collections import OrderedDict
 except ImportError:  # pragma: nocover
     from ordereddict import OrderedDict
 
 from six import itervalues, iteritems
-from sqlalchemy import orm, cast, null, literal, Integer, case, Unicode
+from sqlalchemy import \
+    orm, cast, type_coerce, null, literal, literal_column, select, func, \
+    case, Integer, Numeric, Date, DateTime, String, Unicode, UnicodeText
+from sqlalchemy.dialects.postgresql import JSONB
 
 from . import models
-from .utils.sql import group_concat, to_date, to_datetime
+from .utils.sql import group_concat
+
+
+# SQL types that JSONB text values are casted to, by attribute type
+VALUE_TYPES = {
+    'choice': String,
+    'string': Unicode,
+    'text': UnicodeText,
+    'number': Numeric,
+    'date': Date,
+    'datetime': DateTime,
+}
 
 
 def build_report(session,
@@ -76,6 +91,38 @@ def build_report(session,
 
     attributes = None if attributes is None else set(attributes)
 
+    # Every expanded choice flag would otherwise read the entire data
+    # document again, so each collection's selections are extracted once per
+    # entity and the flags are derived from those instead
+    selections = None
+    if expand_collections:
+        names = sorted(set(
+            c.attributes[0].name for c in itervalues(columns)
+            if c.choice is not None
+            and not (c.is_private and ignore_private)
+            and (attributes is None or c.name in attributes)))
+        if names:
+            selections_query = (
+                session.query(models.Entity.id.label('entity_id'))
+                .join(models.Schema)
+                .filter(models.Schema.name == schema_name)
+                .filter(models.Schema.publish_date != null())
+                .filter(models.Schema.retract_date == null()))
+            if ids:
+                selections_query = \
+                    selections_query.filter(models.Schema.id.in_(ids))
+            selections = (
+                selections_query
+                .add_columns(*[
+                    as_array(models.Entity.data[name]).label(name)
+                    for name in names])
+                # Keeps the planner from inlining the extractions back into
+                # every flag expression
+                .offset(0)
+                .subquery('selections'))
+            query = query.outerjoin(
+                selections, selections.c.entity_id == models.Entity.id)
+
     for column in itervalues(columns):
         if column.type == 'section':  # Sections are not used in reports
             continue
@@ -87,106 +134,113 @@ def build_report(session,
             query = query.add_column(literal(u'[PRIVATE]').label(column.name))
             continue
 
-        # evaluate the target mapped class and casted value column
-        Value = orm.aliased(models.nameModelMap[column.type])
-        value_column = Value._value
-
-        if column.type in ('date', 'datetime'):
-            # Cast datetimes to match their attribute types
-            conv = to_date if column.type == 'date' else to_datetime
-            value_column = conv(Value._value)
-
-        if column.type == 'blob':
-            value_column = case(
-                whens=[((value_column != null()), literal(u'[FILE]'))],
-                else_=null())
-
-        filter_expression = (
-            (models.Entity.id == Value.entity_id)
-            & (Value.attribute_id.in_([a.id for a in column.attributes])))
-
-        Choice = orm.aliased(models.Choice)
-
-        if column.is_collection:
-            # Collections are added via correlated sub-queries to the entity
-            if not expand_collections:
-
-                if use_choice_labels:
-                    value_column = Choice.title
-                else:
-                    value_column = Choice.name
-
-                # Not all vendors suppoar ARRAY, so we just concatenate the
-                # and let clients deal with spliting
-                value_column = (
-                    session.query(group_concat(value_column, ';'))
-                    .select_from(Value)
-                    .filter(filter_expression)
-                    .join(Choice)
-                    .group_by(Value.attribute_id)
-                    .correlate(models.Entity)
-                    .as_scalar())
-
-            else:
-                selected_exists = (
-                    session.query(Value)
-                    .join(Choice, Value._value == Choice.id)
-                    .filter(filter_expression)
-                    .filter(Choice.name == column.choice.name)
-                    .correlate(models.Entity)
-                    .exists())
-
-                if use_choice_labels:
-                    selected_value_column = (
-                        session.query(
-                            cast(literal(column.choice.title), Unicode))
-                        .filter(selected_exists)
-                        .as_scalar())
-                else:
-                    selected_value_column = (
-                        session.query(cast(selected_exists, Integer))
-                        .as_scalar())
-
-                is_selected = (
-                    session.query(Value)
-                    .filter(filter_expression)
-                    .correlate(models.Entity)
-                    .exists())
-
-                value_column = case([(is_selected, selected_value_column)])
-
-        else:
-            # Scalar columns are added via LEFT OUTER JOIN
-            query = query.outerjoin(Value, filter_expression)
-
-            if column.type == 'choice':
-                Choice = orm.aliased(models.Choice)
-                query = query.outerjoin(Choice, Value._value == Choice.id)
-                if use_choice_labels:
-                    value_column = Choice.title
-                else:
-                    value_column = Choice.name
+        value_column = build_value_column(
+            column,
+            expand_collections=expand_collections,
+            use_choice_labels=use_choice_labels,
+            document=(
+                selections.c[column.attributes[0].name]
+                if selections is not None and column.choice is not None
+                else None))
 
         query = query.add_column(value_column.label(column.name))
 
-    CreateUser = orm.aliased(models.User)
-    ModifyUser = orm.aliased(models.User)
-
     query = (
         query
-        .join(CreateUser, models.Entity.create_user)
-        .join(ModifyUser, models.Entity.modify_user)
         .add_columns(
-            models.Entity.create_date,
-            CreateUser.key.label('create_user'),
-            models.Entity.modify_date,
-            ModifyUser.key.label('modify_user'))
+            models.Entity.created_at.label('create_date'),
+            models.Entity.created_by.label('create_user'),
+            models.Entity.modified_at.label('modify_date'),
+            models.Entity.modified_by.label('modify_user'))
         .order_by(models.Entity.id))
 
     return query.cte(schema_name) \
         if not is_sqlite else query.subquery(schema_name)
 
 
+def build_value_column(column, expand_collections=False,
+                       use_choice_labels=False, document=None):
+    """
+    Builds the SQL expression that extracts a column's value from entity data
+
+    Values are pulled directly out of the ``Entity.data`` JSONB document
+    and casted according to the column plan, so a report never needs to
+    join another table per attribute.
+
+    Parameters:
+    column -- The ``DataColumn`` plan of the value
+    expand_collections -- (Optional) The column is an expanded choice flag
+    use_choice_labels -- (Optional) Uses choice labels instead of codes
+    document -- (Optional) An already extracted JSONB value of the column's
+                attribute, collections must already be guarded by
+                ``as_array`` (default: extracted from ``Entity.data``)
+
+    Returns:
+    A SQLAlchemy column expression correlated to ``Entity``
+    """
+    extracted = document is None
+    if extracted:
+        # Expanded choice columns are named after the choice, not the
+        # attribute
+        document = models.Entity.data[column.attributes[0].name]
+
+    if column.type == 'blob':
+        # Files are stored as attachment ids, just flag that one exists
+        return case(
+            [(document.astext != null(), literal(u'[FILE]'))], else_=null())
+
+    def labeled(code):
+        if column.type != 'choice' or not use_choice_labels:
+            return code
+        return case(sorted(iteritems(column.choices)), value=code, else_=code)
+
+    if not column.is_collection:
+        return labeled(cast(document.astext, VALUE_TYPES[column.type]))
+
+    if extracted:
+        # Unanswered collections are stored as JSON null, which the array
+        # functions reject
+        document = as_array(document)
+
+    if not expand_collections or column.choice is None:
+        # Not all vendors support ARRAY, so we just concatenate the values
+        # and let clients deal with spliting
+        return (
+            select([group_concat(
+                labeled(literal_column('value', String)), ';')])
+            .select_from(func.jsonb_array_elements_text(document))
+            .correlate(models.Entity)
+            .as_scalar())
+
+    # Collections are stored as JSON arrays, so a missing or empty array
+    # means nothing was selected
+    selected = document.contains([column.choice.name])
+    is_answered = func.jsonb_array_length(document) > 0
+
+    if use_choice_labels:
+        return case(
+            [(selected, cast(literal(column.choice.title), Unicode))],
+            else_=null())
+
+    return case([(selected, 1), (is_answered, 0)], else_=null())
+
+
+def as_array(document):
+    """
+    Guards a JSONB value against array functions
+
+    Parameters:
+    document -- A JSONB column expression
+
+    Returns:
+    The value if it is a JSON array, otherwise an empty JSON array
+    """
+    return type_coerce(
+        case([(func.jsonb_typeof(document) == u'array', document)],
+             else_=cast(literal(u'[]'), JSONB)),
+        JSONB)
+
+
 def build_columns(session, schema_name, ids=None, expand_collections=False):
     """
     Helper method to determine the columns of the report to generate
@@ -199,6 +253,10 @@ def build_columns(session, schema_name, ids=None, expand_collections=False):
     Attribute lineages are are ordered by their most recent position in the
     schema, then by oldest to newest within the lineage.
 
+    Column plans are cached by the versions they are generated from and the
+    number and latest modification of their attributes and choices, so
+    publishing, retracting or editing a version generates a new plan.
+
     Paramters:
     session -- The session to query plan from
     schema_name -- The name of the schema to get columns plans for
@@ -212,50 +270,121 @@ def build_columns(session, schema_name, ids=None, expand_collections=False):
     also contain the attribute's checksum.
     """
 
-    query = (
-        session.query(models.Attribute)
-        .join(models.Attribute.schema)
+    versions_query = (
+        session.query(models.Schema.id)
         .filter(models.Schema.name == schema_name)
         .filter(models.Schema.publish_date != null())
-        .filter(models.Schema.retract_date == null())
-        .filter(models.Attribute.type != u'section'))
+        .filter(models.Schema.retract_date == null()))
 
     if ids:
-        query = query.filter(models.Schema.id.in_(ids))
+        versions_query = versions_query.filter(models.Schema.id.in_(ids))
+
+    version_ids = tuple(sorted(id for id, in versions_query))
+    key = (str(session.bind.url), schema_name, version_ids,
+           _columns_token(session, version_ids),
+           bool(expand_collections))
+
+    columns = _columns_cache.pop(key, None)
+
+    if columns is None:
+        columns = _plan_columns(session, version_ids, expand_collections)
+        while len(_columns_cache) >= COLUMNS_CACHE_SIZE:
+            _columns_cache.popitem(last=False)
+
+    # Most recently used plans are kept last
+    _columns_cache[key] = columns
 
-    # aliased so we don't get naming ambiguity
-    RecentAttribute = orm.aliased(models.Attribute)
+    return OrderedDict(columns)
+
+
+def clear_columns_cache():
+    """
+    Discards all cached column plans
+    """
+    _columns_cache.clear()
+
+
+# Maximum number of column plans to keep
+COLUMNS_CACHE_SIZE = 1000
+
+# Column plans, keyed by database, schema name, version ids, modification
+# token and expansion
+_columns_cache = OrderedDict()
+
+
+def _columns_token(session, version_ids):
+    """
+    Summarizes the modifications of the attributes of specific versions
+
+    Attributes and choices are timestamped by the database every time they
+    are inserted or updated, so their count and latest timestamp change with
+    any edit, deletion or addition.
+    """
+
+    if not version_ids:
+        return None
+
+    attributes = (
+        session.query(
+            func.count(models.Attribute.id),
+            func.max(models.Attribute.modified_at))
+        .filter(models.Attribute.schema_id.in_(version_ids))
+        .subquery())
+
+    choices = (
+        session.query(
+            func.count(models.Choice.id),
+            func.max(models.Choice.modified_at))
+        .join(models.Choice.attribute)
+        .filter(models.Attribute.schema_id.in_(version_ids))
+        .subquery())
+
+    return tuple(session.query(attributes, choices).one())
+
+
+def _plan_columns(session, version_ids, expand_collections=False):
+    """
+    Generates the column plan of specific schema versions
+    """
+
+    columns = OrderedDict()
+
+    if not version_ids:
+        return columns
 
     query = (
-        query.order_by(
-            (session.query(RecentAttribute.order)
-                .join(RecentAttribute.schema)
-                .filter(models.Schema.name == schema_name)
-                .filter(models.Schema.publish_date != null())
-                .filter(RecentAttribute.name == models.Attribute.name)
-                .order_by(models.Schema.publish_date.desc())
-                .limit(1)
-                .correlate(models.Attribute)
-                .as_scalar()
-                .label('most_recent_attribute')).asc(),
+        session.query(models.Attribute)
+        .join(models.Attribute.schema)
+        .outerjoin(models.AttributeLineage, (
+            (models.AttributeLineage.schema_name == models.Schema.name)
+            & (models.AttributeLineage.attribute_name
+               == models.Attribute.name)))
+        .filter(models.Schema.id.in_(version_ids))
+        .filter(models.Attribute.type != u'section')
+        .options(
+            orm.contains_eager(models.Attribute.schema),
+            orm.subqueryload(models.Attribute.choices))
+        .order_by(
+            # most recent position of the attribute across all versions
+            models.AttributeLineage.latest_order.asc(),
             # oldest to newest within the lineage
             models.Schema.publish_date.asc()))
 
     plan = OrderedDict()
     selected = dict()
-    columns = OrderedDict()
 
     # Organize the attributes
     for attribute in query:
+        spec = AttributeSpec(attribute)
         if (expand_collections
-                and attribute.is_collection
-                and attribute.type == 'choice'):
-            for choice in itervalues(attribute.choices):
-                name = attribute.name + '_' + choice.name
-                plan.setdefault(name, []).append(attribute)
+                and spec.is_collection
+                and spec.type == 'choice'):
+            for choice in spec.choices:
+                name = spec.name + '_' + choice.name
+                plan.setdefault(name, []).append(spec)
                 selected[name] = choice
         else:
-            plan.setdefault(attribute.name, []).append(attribute)
+            plan.setdefault(spec.name, []).append(spec)
 
     # Build the final plan
     for name, attributes in iteritems(plan):
@@ -264,6 +393,58 @@ def build_columns(session, schema_name, ids=None, expand_collections=False):
     return columns
 
 
+# A choice of an attribute snapshot
+ChoiceSpec = namedtuple('ChoiceSpec', ['name', 'title'])
+
+
+class AttributeSpec(object):
+    """
+    A read-only snapshot of a published attribute
+
+    Snapshots are detached from the session they were loaded with, so that
+    they can be shared by column plans across sessions.
+    """
+
+    __slots__ = (
+        'name',
+        'title',
+        'description',
+        'type',
+        'decimal_places',
+        'order',
+        'is_required',
+        'is_collection',
+        'is_private',
+        'choices',
+        'schema_name',
+        'schema_title',
+        'publish_date',
+    )
+
+    def __init__(self, attribute):
+        """
+        Parameters:
+        attribute -- the attribute to snapshot, along with its schema
+                     and choices
+        """
+        self.name = attribute.name
+        self.title = attribute.title
+        self.description = attribute.description
+        self.type = attribute.type
+        self.decimal_places = attribute.decimal_places
+        self.order = attribute.order
+        self.is_required = attribute.is_required
+        self.is_collection = attribute.is_collection
+        self.is_private = attribute.is_private
+        self.choices = tuple(
+            ChoiceSpec(c.name, c.title)
+            for c in sorted(itervalues(attribute.choices),
+                            key=lambda c: c.order))
+        self.schema_name = attribute.schema.name
+        self.schema_title = attribute.schema.title
+        self.publish_date = attribute.schema.publish_date
+
+
 class DataColumn(object):
     """
     A data dictionary column for reference when inspecting a report column.
@@ -274,13 +455,23 @@ class DataColumn(object):
     terms (if the underlying attributes have specified choices).
     """
 
+    __slots__ = (
+        'name',
+        'type',
+        'is_collection',
+        'is_private',
+        'attributes',
+        'choice',
+        'choices',
+    )
+
     def __init__(self, name, attributes, choice=None):
         """
         Parameters:
         name -- the column name (usually the attribute name)
-        attributes -- the attributes that make up this column
-        choice -- (optional) if expanding choices, the one represented
-                  by this column
+        attributes -- the `AttributeSpec` snapshots that make up this column
+        choice -- (optional) if expanding choices, the `ChoiceSpec`
+                  represented by this column
         """
         types = set([a.type for a in attributes])
         collections = set([a.is_collection for a in attributes])
@@ -295,6 +486,4 @@ class DataColumn(object):
         if choice is not None:
             self.choices = {}
         else:
-            self.choices = dict((c.name, c.title)
-                                for a in attributes
-                                for c in itervalues(a.choices))
+            self.choices = dict(c for a in attributes for c in a.choices)
@@ -36,8 +36,10 @@ def includeme(config):
     config.add_route('studies.exports_notifications',       '/studies/exports/notifications',           factory=models.ExportFactory)
     config.add_route('studies.exports_faq',                 '/studies/exports/faq',                     factory=models.ExportFactory)
     config.add_route('studies.exports_codebook',            '/studies/exports/codebook',                factory=models.ExportFactory)
+    config.add_route('studies.exports_plan',                '/studies/exports/plans/{plan}',            factory=models.ExportFactory)
     config.add_route('studies.export',                      '/studies/exports/{export:\d+}',            factory=models.ExportFactory, traverse='/{export}')
     config.add_route('studies.export_download',             '/studies/exports/{export:\d+}/download',   factory=models.ExportFactory, traverse='/{export}')
+    config.add_route('studies.export_resume',               '/studies/exports/{export:\d+}/resume',     factory=models.ExportFactory, traverse='/{export}')
 
     config.add_route('studies.patients',                    '/studies/patients',                        factory=models.PatientFactory)
     config.add_route('studies.patients_forms',              '/studies/patients/forms',                  factory=models.PatientFactory)
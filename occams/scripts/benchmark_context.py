@@ -0,0 +1,292 @@
+"""
+Command-line interface for benchmarking form export context lookups
+
+Compares the pre-aggregated context joins of ``SchemaPlan.data`` with the
+correlated per-row subqueries they replaced. Unless an existing form is
+specified, a synthetic form with patient, enrollment and visit contexts is
+generated for the benchmark and rolled back afterwards.
+"""
+
+import argparse
+from datetime import date
+import sys
+import time
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy import cast, literal_column, text, String
+from tabulate import tabulate
+import transaction
+
+from .. import models
+from ..exports.schema import SchemaPlan
+from ..reporting import build_report
+from ..utils.sql import group_concat
+
+
+# Name of the synthetic form generated for the benchmark
+BENCHMARK_FORM = u'benchmark_context'
+
+
+def parse_args(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks form export context lookups.')
+    parser.add_argument(
+        '-c', '--config',
+        metavar='INI',
+        dest='config',
+        help='Application INI file')
+    parser.add_argument(
+        '--form',
+        metavar='NAME',
+        help='Benchmark an existing form instead of a synthetic one')
+    parser.add_argument(
+        '--entities',
+        type=int,
+        default=20000,
+        help='Number of synthetic form entries to generate (default: 20000)')
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of timed runs of each query, the best is reported '
+             '(default: 3)')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv[1:])
+
+    setup_logging(args.config)
+    env = bootstrap(args.config)
+
+    dbsession = env['request'].dbsession
+
+    with transaction.manager:
+        models.set_pg_locals(dbsession, 'benchmark', 'benchmark@localhost')
+
+        if args.form:
+            name = args.form
+        else:
+            name = BENCHMARK_FORM
+            generate(dbsession, name, args.entities)
+
+        plan = SchemaPlan.from_schema(dbsession, name)
+
+        results = []
+        for label, query in [('correlated', correlated_data(plan)),
+                             ('joined', plan.data())]:
+            timings = [timed(query) for i in range(args.repeat)]
+            count = timings[0][1]
+            best = min(seconds for seconds, _ in timings)
+            results.append((label, count, best))
+
+        # Never keep the synthetic data
+        transaction.abort()
+
+    baseline = results[0][2]
+    print(tabulate(
+        [(label, rows, '%.3f' % seconds, '%.1fx' % (baseline / seconds))
+         for label, rows, seconds in results],
+        headers=['Context lookup', 'Rows', 'Seconds', 'Speedup'],
+        tablefmt='simple'))
+
+
+def timed(query):
+    """
+    Fetches all records of a query
+
+    Returns:
+    A tuple of the elapsed seconds and the number of records
+    """
+    started = time.time()
+    count = len(query.all())
+    return time.time() - started, count
+
+
+def generate(dbsession, name, count):
+    """
+    Generates a form with patient, enrollment and visit contexts
+
+    Each entry belongs to its own patient, enrollment and visit, so every
+    context is looked up once per record.
+
+    Parameters:
+    dbsession -- the database session
+    name -- the name of the form
+    count -- the number of form entries to generate
+    """
+    today = date.today()
+
+    site = models.Site(name=u'benchmark', title=u'Benchmark')
+    study = models.Study(
+        name=u'benchmark',
+        title=u'Benchmark',
+        short_title=u'BM',
+        code=u'000',
+        consent_date=today)
+    cycle = models.Cycle(
+        name=u'benchmark-1', title=u'Benchmark 1', week=1, study=study)
+    schema = models.Schema(
+        name=name,
+        title=u'Benchmark',
+        publish_date=today,
+        attributes={
+            'value': models.Attribute(
+                name=u'value', title=u'Value', type=u'number', order=0)})
+    dbsession.add_all([site, study, cycle, schema])
+    dbsession.flush()
+
+    params = {
+        'count': count,
+        'site_id': site.id,
+        'study_id': study.id,
+        'cycle_id': cycle.id,
+        'schema_id': schema.id,
+        'today': today,
+    }
+
+    statements = [
+        """
+        INSERT INTO patient (site_id, pid)
+        SELECT :site_id, 'BM' || i FROM generate_series(1, :count) AS i
+        """,
+        """
+        INSERT INTO enrollment
+            (patient_id, study_id, consent_date, latest_consent_date)
+        SELECT id, :study_id, :today, :today
+        FROM patient WHERE site_id = :site_id
+        """,
+        """
+        INSERT INTO visit (patient_id, visit_date)
+        SELECT id, :today FROM patient WHERE site_id = :site_id
+        """,
+        """
+        INSERT INTO visit_cycle (visit_id, cycle_id)
+        SELECT visit.id, :cycle_id
+        FROM visit JOIN patient ON patient.id = visit.patient_id
+        WHERE patient.site_id = :site_id
+        """,
+        # Entries are matched to their patient by the number in their data
+        """
+        INSERT INTO entity (schema_id, collect_date, not_done, data)
+        SELECT :schema_id, :today, FALSE,
+               json_build_object('value', i)::jsonb
+        FROM generate_series(1, :count) AS i
+        """,
+        """
+        INSERT INTO context (entity_id, external, key)
+        SELECT entity.id, 'patient', patient.id
+        FROM entity
+        JOIN patient ON patient.pid = 'BM' || (entity.data->>'value')
+        WHERE entity.schema_id = :schema_id AND patient.site_id = :site_id
+        """,
+        """
+        INSERT INTO context (entity_id, external, key)
+        SELECT context.entity_id, 'enrollment', enrollment.id
+        FROM context
+        JOIN enrollment ON enrollment.patient_id = context.key
+        JOIN entity ON entity.id = context.entity_id
+        WHERE context.external = 'patient'
+        AND entity.schema_id = :schema_id
+        """,
+        """
+        INSERT INTO context (entity_id, external, key)
+        SELECT context.entity_id, 'visit', visit.id
+        FROM context
+        JOIN visit ON visit.patient_id = context.key
+        JOIN entity ON entity.id = context.entity_id
+        WHERE context.external = 'patient'
+        AND entity.schema_id = :schema_id
+        """,
+    ]
+
+    for statement in statements:
+        dbsession.execute(text(statement), params)
+
+    dbsession.execute('ANALYZE')
+
+
+def correlated_data(plan):
+    """
+    Generates a plan's data query with a correlated subquery per context
+    column, as ``SchemaPlan.data`` did before contexts were pre-aggregated
+
+    Partner and randomization contexts are not included.
+    """
+    session = plan.dbsession
+    ids = [
+        id for id, in session.query(models.Schema.id)
+        .filter(models.Schema.name == plan.name)
+        .filter(models.Schema.publish_date.in_(plan.versions))]
+
+    report = build_report(session, plan.name, ids=ids)
+
+    def keyed(external, model):
+        return ((models.Context.external == external)
+                & (models.Context.key == model.id))
+
+    def scalar(query, name):
+        return (
+            query
+            .filter(models.Context.entity_id == report.c.id)
+            .correlate(report)
+            .as_scalar()
+            .label(name))
+
+    query = (
+        session.query(report.c.id.label('id'))
+        .add_columns(
+            scalar(
+                session.query(models.Patient.pid)
+                .join(models.Context, keyed(u'patient', models.Patient)),
+                'pid'),
+            scalar(
+                session.query(models.Site.name)
+                .select_from(models.Patient)
+                .join(models.Site)
+                .join(models.Context, keyed(u'patient', models.Patient)),
+                'site'),
+            scalar(
+                session.query(group_concat(models.Study.name, ';'))
+                .select_from(models.Enrollment)
+                .join(models.Study)
+                .join(models.Context,
+                      keyed(u'enrollment', models.Enrollment))
+                .group_by(models.Context.entity_id),
+                'enrollment'),
+            scalar(
+                session.query(group_concat(models.Enrollment.id, ';'))
+                .select_from(models.Enrollment)
+                .join(models.Context,
+                      keyed(u'enrollment', models.Enrollment))
+                .group_by(models.Context.entity_id),
+                'enrollment_ids'),
+            scalar(
+                session.query(group_concat(
+                    models.Study.title
+                    + literal_column(u"'('")
+                    + cast(models.Cycle.week, String)
+                    + literal_column(u"')'"),
+                    literal_column(u"';'")))
+                .select_from(models.Visit)
+                .join(models.Visit.cycles)
+                .join(models.Cycle.study)
+                .join(models.Context, keyed(u'visit', models.Visit))
+                .group_by(models.Context.entity_id),
+                'visit_cycles'),
+            scalar(
+                session.query(models.Visit.id)
+                .join(models.Context, keyed(u'visit', models.Visit)),
+                'visit_id'),
+            scalar(
+                session.query(models.Visit.visit_date)
+                .join(models.Context, keyed(u'visit', models.Visit)),
+                'visit_date'))
+        .add_columns(*[c for c in report.columns if c.name != 'id'])
+        .order_by(report.c.id))
+
+    return query
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
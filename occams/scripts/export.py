@@ -3,17 +3,30 @@ Command-line interface for exporting data
 """
 
 import argparse
+import glob
 from itertools import chain
+import json
+from multiprocessing import Pool
 import os
+import re
 import shutil
 import sys
 import uuid
 
+from dateutil.parser import parse as dateutil_parse
 from pyramid.paster import bootstrap, setup_logging
 from six import itervalues
+from sqlalchemy import func, orm, text
 from tabulate import tabulate
 
-from .. import exports
+from .. import exports, models
+
+
+# Records when the last export of each data file in a directory was started
+WATERMARK_FILE = '.watermark'
+
+# Profiles of the data files generated with --profile
+PROFILE_FILE = 'profile.json'
 
 
 def parse_args(argv=sys.argv):
@@ -72,6 +85,34 @@ def parse_args(argv=sys.argv):
         dest='show_private',
         action='store_true',
         help='De-identifies private data.')
+    export_group.add_argument(
+        '--batch-size',
+        metavar='N',
+        dest='batch_size',
+        type=int,
+        help='Stream rows from the database N at a time '
+             '(default: fetch all rows at once)')
+    export_group.add_argument(
+        '--engine',
+        choices=list(exports.engines),
+        default='orm',
+        help='How data files are written: "orm" serializes rows in Python, '
+             '"copy" lets PostgreSQL generate the CSV (default: orm)')
+    export_group.add_argument(
+        '-j', '--jobs',
+        metavar='N',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='Generate data files in N worker processes, splitting large '
+             'forms into shards of entity ids (default: 1)')
+    export_group.add_argument(
+        '--profile',
+        action='store_true',
+        help='Record where the time generating each data file goes '
+             '(query compilation, query plan, database vs serialization '
+             'time) to %s in the output directory. Note that each query '
+             'is run twice.' % PROFILE_FILE)
     export_group.add_argument(
         '--dir',
         metavar='PATH',
@@ -81,6 +122,16 @@ def parse_args(argv=sys.argv):
         '--atomic',
         action='store_true',
         help='Treat the output path as a symlink')
+    export_group.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Only export records modified since the previous export to the '
+             'output directory, as delta files next to the full data files')
+    export_group.add_argument(
+        '--compact',
+        action='store_true',
+        help='Merge delta files in the output directory into their full '
+             'data files')
 
     return parser.parse_args(argv)
 
@@ -94,7 +145,10 @@ def main(argv=sys.argv):
     if args.list:
         print_list(args, env)
     else:
-        make_export(args, env)
+        if not args.compact or has_selection(args):
+            make_export(args, env)
+        if args.compact:
+            compact_export(args)
 
 
 def print_list(args, env):
@@ -110,27 +164,35 @@ def print_list(args, env):
 
     header = ['sys', 'priv', 'rand', 'name', 'title']
     dbsession = env['request'].dbsession
-    plans = exports.plans
-    rows = iter(format(e) for e in itervalues(
-        exports.list_all(plans, dbsession)))
+    rows = iter(format(e) for e in itervalues(exports.list_all(dbsession)))
     print(tabulate(rows, header, tablefmt='simple'))
 
 
+def has_selection(args):
+    """
+    Checks if the user specified any data files to export
+    """
+    return bool(args.all
+                or args.all_public
+                or args.all_private
+                or args.all_rand
+                or args.names)
+
+
 def make_export(args, env):
     """
     Generates the export data files
     """
 
-    if not (args.all
-            or args.all_public
-            or args.all_private
-            or args.all_rand
-            or args.names):
+    if not has_selection(args):
         sys.exit('You must specifiy something to export!')
 
+    if args.incremental and args.atomic:
+        sys.exit('Incremental exports cannot be atomic!')
+
     dbsession = env['request'].dbsession
-    plans = exports.plans
-    exportables = exports.list_all(plans, dbsession)
+    exportables = exports.list_all(dbsession)
+    write_data = exports.engines[args.engine]
 
     if args.atomic:
         out_dir = '%s-%s' % (args.dir.rstrip('/'), uuid.uuid4())
@@ -140,6 +202,12 @@ def make_export(args, env):
         if not os.path.exists(args.dir):
             os.makedirs(args.dir)
 
+    # Use the database clock since that's what sets modification times
+    started = dbsession.query(func.now()).scalar()
+    watermarks = read_watermarks(out_dir)
+
+    jobs = []
+
     for plan in itervalues(exportables):
         if (args.all
                 or (args.all_private
@@ -150,16 +218,54 @@ def make_export(args, env):
                     and not plan.has_rand)
                 or (args.all_rand and plan.has_rand)
                 or (args.names and plan.name in args.names)):
-            with open(os.path.join(out_dir, plan.file_name), 'w+b') as fp:
-                exports.write_data(fp, plan.data(
-                    use_choice_labels=args.use_choice_labels,
-                    expand_collections=args.expand_collections,
-                    ignore_private=not args.show_private))
+            path = os.path.join(out_dir, plan.file_name)
+            # Plans without a previous full data file get a full export
+            if args.incremental and os.path.exists(path):
+                modified_since = watermarks.get(plan.name)
+            else:
+                modified_since = None
+            if modified_since:
+                path = delta_path(path, started)
+            jobs.append((plan, path, {
+                'use_choice_labels': args.use_choice_labels,
+                'expand_collections': args.expand_collections,
+                'ignore_private': not args.show_private,
+                'modified_since': modified_since,
+            }))
+
+    if args.jobs > 1:
+        profiles = write_parallel(args, env, jobs)
+    else:
+        profiles = []
+        for plan, path, options in jobs:
+            with open(path, 'w+b') as fp:
+                if args.profile:
+                    profile = exports.profile.profile_data(
+                        fp, plan.data(**options), write_data,
+                        batch_size=args.batch_size)
+                    profile.update(name=plan.name, path=path)
+                    profiles.append(profile)
+                else:
+                    write_data(fp, plan.data(**options),
+                               batch_size=args.batch_size)
+
+    if args.profile:
+        with open(os.path.join(out_dir, PROFILE_FILE), 'w') as fp:
+            json.dump(profiles, fp, indent=2)
 
     with open(os.path.join(out_dir, exports.codebook.FILE_NAME), 'w+b') as fp:
         codebooks = [p.codebook() for p in itervalues(exportables)]
         exports.write_codebook(fp, chain.from_iterable(codebooks))
 
+    # Data files not exported this time keep their previous watermark
+    for plan, path, options in jobs:
+        watermarks[plan.name] = started
+
+    with open(os.path.join(out_dir, WATERMARK_FILE), 'w') as fp:
+        json.dump(dict(
+            (name, watermark.isoformat())
+            for name, watermark in watermarks.items()), fp)
+
     if args.atomic:
         old_dir = os.path.realpath(args.dir)
         if os.path.islink(args.dir):
@@ -167,3 +273,150 @@ def make_export(args, env):
         os.symlink(os.path.abspath(out_dir), args.dir)
         if not os.path.islink(old_dir):
             shutil.rmtree(old_dir)
+
+
+def write_parallel(args, env, jobs):
+    """
+    Generates data files in worker processes
+
+    Large forms are split into entity id ranges which are generated as
+    separate shards and then concatenated in order. All workers read from
+    the same database snapshot, so shards are consistent with each other.
+
+    Returns:
+    The profiles of the shards, if profiling was requested
+    """
+    dbsession = env['request'].dbsession
+    settings = env['registry'].settings
+    db_settings = dict(
+        (k, v) for k, v in settings.items() if k.startswith('sqlalchemy.'))
+
+    if dbsession.bind.dialect.name == 'postgresql':
+        # Keep this transaction open until workers are done with its snapshot
+        snapshot = dbsession.execute(text('SELECT pg_export_snapshot()'))
+        snapshot = snapshot.scalar()
+    else:
+        snapshot = None
+
+    shards = []
+    tasks = []
+
+    for plan, path, options in jobs:
+        ranges = plan.id_ranges(args.jobs)
+        paths = []
+        for i, id_range in enumerate(ranges):
+            shard_options = dict(options)
+            if id_range is not None:
+                shard_options['id_range'] = id_range
+            shard_path = (
+                path if len(ranges) == 1 else '%s.part%04d' % (path, i))
+            paths.append(shard_path)
+            tasks.append((
+                plan.name, shard_path, shard_options,
+                args.engine, args.batch_size, args.profile, snapshot))
+        shards.append((path, paths))
+
+    pool = Pool(args.jobs, initializer=_init_worker, initargs=(db_settings,))
+    try:
+        # Dispatch one shard at a time so large shards don't queue up
+        profiles = pool.map(_write_shard, tasks, chunksize=1)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for path, paths in shards:
+        if paths != [path]:
+            exports.concat_data(path, paths)
+
+    return [profile for profile in profiles if profile is not None]
+
+
+# Database session of the current worker process
+_worker_dbsession = None
+
+
+def _init_worker(db_settings):
+    """
+    Connects a worker process to the database with its own engine
+    """
+    global _worker_dbsession
+    engine = models.get_engine(db_settings)
+    _worker_dbsession = orm.sessionmaker(bind=engine)()
+
+
+def _write_shard(task):
+    """
+    Generates a data file (or a shard of it) in a worker process
+
+    Returns:
+    The shard's profile if requested, otherwise None
+    """
+    name, path, options, engine, batch_size, profile, snapshot = task
+    dbsession = _worker_dbsession
+
+    try:
+        if snapshot is not None:
+            # Snapshot ids are generated by the database, but still check
+            # them since they cannot be passed as a parameter
+            assert re.match(r'^[0-9A-F-]+$', snapshot), snapshot
+            dbsession.connection(execution_options={
+                'isolation_level': 'REPEATABLE READ'})
+            dbsession.execute(
+                text("SET TRANSACTION SNAPSHOT '%s'" % snapshot))
+
+        plan = exports.list_all(dbsession)[name]
+
+        with open(path, 'w+b') as fp:
+            if profile:
+                profile = exports.profile.profile_data(
+                    fp, plan.data(**options), exports.engines[engine],
+                    batch_size=batch_size)
+                profile.update(name=name, path=path)
+            else:
+                exports.engines[engine](
+                    fp, plan.data(**options), batch_size=batch_size)
+    finally:
+        dbsession.rollback()
+
+    return profile or None
+
+
+def read_watermarks(out_dir):
+    """
+    Returns the times the previous exports to the directory were started
+
+    Returns:
+    A dictionary of data file names to the time their previous export was
+    started
+    """
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        entries = json.load(fp)
+    return dict(
+        (name, dateutil_parse(value)) for name, value in entries.items())
+
+
+def delta_path(path, started):
+    """
+    Generates the path of a delta file for a full data file
+    """
+    base, ext = os.path.splitext(path)
+    return '{}.delta-{}{}'.format(base, started.strftime('%Y%m%d%H%M%S'), ext)
+
+
+def compact_export(args):
+    """
+    Merges delta files into their full data files
+    """
+    out_dir = os.path.realpath(args.dir)
+    for name in sorted(os.listdir(out_dir)):
+        base, ext = os.path.splitext(name)
+        if ext != '.csv' or '.delta-' in base:
+            continue
+        shard_paths = sorted(
+            glob.glob(os.path.join(out_dir, base + '.delta-*' + ext)))
+        if shard_paths:
+            exports.compact_data(os.path.join(out_dir, name), shard_paths)
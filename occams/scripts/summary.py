@@ -0,0 +1,36 @@
+"""
+Command-line interface for rebuilding entity summaries
+
+Entity summaries are normally kept up-to-date by database triggers, this
+script is only needed to populate them for pre-existing data, or if they
+are suspected to be out of sync.
+"""
+
+import argparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+import transaction
+
+
+def parse_args(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Rebuilds the entity summary table.')
+    parser.add_argument(
+        '-c', '--config',
+        metavar='INI',
+        dest='config',
+        help='Application INI file')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv[1:])
+
+    setup_logging(args.config)
+    env = bootstrap(args.config)
+
+    dbsession = env['request'].dbsession
+
+    with transaction.manager:
+        dbsession.execute('SELECT entity_summary_backfill()')
@@ -12,12 +12,18 @@ function Export(data) {
   self.status = ko.observable();
   self.use_choice_labels = ko.observable();
   self.expand_collections = ko.observable();
+  self.modified_since = ko.observable();
   self.contents = ko.observable();
   self.count = ko.observable();
   self.total = ko.observable();
+  self.rows = ko.observable();
+  self.estimated_rows = ko.observable();
+  self.rate = ko.observable();
+  self.eta = ko.observable();
   self.file_size = ko.observable();
   self.download_url = ko.observable();
   self.delete_url = ko.observable();
+  self.resume_url = ko.observable();
   self.create_date = ko.observable();
   self.expire_date = ko.observable();
 
@@ -29,12 +35,18 @@ function Export(data) {
     self.status(data.status);
     self.use_choice_labels(data.use_choice_labels);
     self.expand_collections(data.expand_collections);
+    self.modified_since(data.modified_since);
     self.contents(data.contents);
     self.count(data.count);
     self.total(data.total);
+    self.rows(data.rows);
+    self.estimated_rows(data.estimated_rows);
+    self.rate(data.rate);
+    self.eta(data.eta);
     self.file_size(data.file_size);
     self.download_url(data.download_url);
     self.delete_url(data.delete_url);
+    self.resume_url(data.resume_url);
     self.create_date(data.create_date);
     self.expire_date(data.expire_date);
   };
@@ -43,9 +55,28 @@ function Export(data) {
    * Calculates this export's current progress
    */
   self.progress = ko.pureComputed(function(){
+    if (self.estimated_rows() > 0){
+      // Rows are only estimated, so don't report completion prematurely
+      return Math.min(
+        Math.ceil((self.rows() / self.estimated_rows()) * 100), 99);
+    }
     return Math.ceil((self.count() / self.total()) * 100);
   }).extend({ throttle: 1 });
 
+  /**
+   * Describes the estimated time remaining
+   */
+  self.eta_text = ko.pureComputed(function(){
+    var eta = self.eta();
+    if (eta === null || eta === undefined){
+      return null;
+    }
+    if (eta < 60){
+      return '< 1 min';
+    }
+    return '~' + Math.ceil(eta / 60) + ' min';
+  });
+
   self.update(data);
 }
 
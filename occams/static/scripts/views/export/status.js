@@ -38,6 +38,20 @@ function StatusViewModel(options) {
     });
   };
 
+  /**
+   * Sends resume request to the server
+   */
+  self.resumeExport = function(export_) {
+    $.ajax({
+      url: export_.resume_url(),
+      method: 'POST',
+      headers: {'X-CSRF-Token': $.cookie('csrf_token')},
+      success: function(data, textStatus, jqXHR){
+        export_.status('pending');
+      }
+    });
+  };
+
   /**
    * Handles an element being shown by "sliding" it in.
    * (Necessary DOM manipulation evil...)
@@ -99,8 +113,14 @@ function StatusViewModel(options) {
 
       export_.count(data['count']);
       export_.total(data['total']);
+      export_.rows(data['rows']);
+      export_.estimated_rows(data['estimated_rows']);
+      export_.rate(data['rate']);
+      export_.eta(data['eta']);
       export_.status(data['status']);
-      export_.file_size(data['file_size']);
+      if (data['file_size']){
+        export_.file_size(data['file_size']);
+      }
     });
 
     var query = parse_url_query(),
@@ -16,22 +16,69 @@ try:
     from collections import OrderedDict
 except ImportError:  # pragma: nocover
     from ordereddict import OrderedDict  # NOQA
+import binascii
 from contextlib import closing
-from itertools import chain
+from datetime import datetime, timedelta
 import json
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
 import tempfile
-from zipfile import ZipFile, ZIP_DEFLATED
+import time
+import zipfile
+from zipfile import ZipFile
+import zlib
 
 import celery.signals
 import humanize
+from pyramid.settings import asbool
+from redis.exceptions import LockError
 import six
+from sqlalchemy import orm
 
-from occams.celery import app, Session, log, with_transaction
+from occams.celery import \
+    app, Session, log, with_transaction, EXPORT_QUEUE, LARGE_EXPORT_QUEUE
 
 from . import models, exports
 
 
+# Archive compression codecs that entries can be streamed with
+ZIP_CODECS = OrderedDict([
+    ('deflated', zipfile.ZIP_DEFLATED),
+    ('stored', zipfile.ZIP_STORED)])
+
+# Export progress is published to a channel per owner, named by this prefix
+# followed by the owner's user key
+PROGRESS_CHANNEL = 'export.'
+
+# Maximum number of seconds an export waits on an identical export that is
+# still in progress before generating its own archive
+FOLLOW_TIMEOUT = 3600
+
+# Minimum and maximum number of seconds between checks on an identical
+# export in progress, the interval grows with the time waited so far
+FOLLOW_INTERVAL = 30
+FOLLOW_MAX_INTERVAL = 300
+
+# Number of seconds an export's lock outlives its last progress report. A
+# task delivered again while the export is still locked waits this long
+# before trying again.
+LOCK_TIMEOUT = 600
+
+# Maximum number of id range shards a checkpointed data file is split into
+CHECKPOINT_SHARDS = 100
+
+# Maximum number of expired exports removed per garbage collection run
+GC_BATCH_SIZE = 100
+
+# Files in the export directory younger than this many seconds are never
+# considered orphaned, since their export may not be committed yet
+GC_GRACE_PERIOD = 3600
+
+# Export directory entries that do not belong to individual exports
+GC_RESERVED = ('cache', 'codebook', exports.codebook.FILE_NAME)
+
+
 def includeme(config):
     """
     Configures the Celery connection from the pyramid side of the application.
@@ -60,6 +107,73 @@ def includeme(config):
         settings['studies.export.expire'] = \
             int(settings['studies.export.expire'])
 
+    if 'studies.export.batch_size' in settings:
+        settings['studies.export.batch_size'] = \
+            int(settings['studies.export.batch_size'])
+
+    if 'studies.export.cache_size' in settings:
+        settings['studies.export.cache_size'] = \
+            int(settings['studies.export.cache_size'])
+
+    if 'studies.export.workers' in settings:
+        settings['studies.export.workers'] = \
+            int(settings['studies.export.workers'])
+
+    if 'studies.export.large_rows' in settings:
+        settings['studies.export.large_rows'] = \
+            int(settings['studies.export.large_rows'])
+
+    if 'studies.export.byte_budget' in settings:
+        settings['studies.export.byte_budget'] = \
+            int(settings['studies.export.byte_budget'])
+
+    if 'studies.export.off_hours' in settings:
+        settings['studies.export.off_hours'] = \
+            int(settings['studies.export.off_hours'])
+        assert 0 <= settings['studies.export.off_hours'] < 24, \
+            'Invalid export off hours: %s' % \
+            settings['studies.export.off_hours']
+
+    if 'studies.export.user_concurrency' in settings:
+        settings['studies.export.user_concurrency'] = \
+            int(settings['studies.export.user_concurrency'])
+
+    settings['studies.export.sse_heartbeat'] = \
+        float(settings.get('studies.export.sse_heartbeat', 15))
+
+    settings['studies.export.sse_timeout'] = \
+        float(settings.get('studies.export.sse_timeout', 300))
+
+    settings['studies.export.stream_limit'] = \
+        int(settings.get('studies.export.stream_limit', 100000))
+
+    if 'studies.export.progress_interval' in settings:
+        settings['studies.export.progress_interval'] = \
+            float(settings['studies.export.progress_interval'])
+
+    if 'studies.export.compression_level' in settings:
+        settings['studies.export.compression_level'] = \
+            int(settings['studies.export.compression_level'])
+
+    settings['studies.export.profile'] = \
+        asbool(settings.get('studies.export.profile'))
+
+    settings['studies.export.checkpoint'] = \
+        asbool(settings.get('studies.export.checkpoint'))
+
+    if 'studies.export.checkpoint_rows' in settings:
+        settings['studies.export.checkpoint_rows'] = \
+            int(settings['studies.export.checkpoint_rows'])
+
+    settings.setdefault('studies.export.compression', 'deflated')
+    assert settings['studies.export.compression'] in ZIP_CODECS, \
+        'Invalid export compression: %s' % \
+        settings['studies.export.compression']
+
+    settings.setdefault('studies.export.engine', 'orm')
+    assert settings['studies.export.engine'] in exports.engines, \
+        'Invalid export engine: %s' % settings['studies.export.engine']
+
 
 @celery.signals.celeryd_after_setup.connect
 def on_celeryd_after_setup(**kw):
@@ -84,12 +198,19 @@ class ExportTask(celery.Task):
         export = Session.query(models.Export).filter_by(name=task_id).one()
         export.status = u'failed'
 
+        # The task may have failed before it wrote the progress hash
         redis = app.redis
-        redis.hset(export.redis_key, 'status', export.status)
-        redis.publish('export', json.dumps(redis.hgetall(export.redis_key)))
+        redis.hmset(export.redis_key, {
+            'export_id': export.id,
+            'owner_user': export.owner_user.key,
+            'status': export.status,
+        })
+        publish_progress(redis, redis.hgetall(export.redis_key))
 
 
-@celery.task(name='make_export', base=ExportTask, ignore_result=True)
+@celery.task(
+    name='make_export', base=ExportTask, ignore_result=True, max_retries=None,
+    acks_late=True)
 @with_transaction
 def make_export(name):
     """
@@ -100,65 +221,703 @@ def make_export(name):
     conditions,
     (http://docs.celeryproject.org/en/latest/userguide/tasks.html#state)
 
-    All progress will be broadcast to the redis **export** channel with the
-    following dictionary:
+    All progress will be broadcast to the owner's redis channel (see
+    `publish_progress`) with the following dictionary:
     export_id -- the export being processed
     owner_user -- the user who this export belongs to
     count -- the current number of files processed
     total -- the total number of files that will be processed
+    rows -- the number of data rows written so far
+    bytes -- the number of data bytes written so far
+    rate -- the average number of rows written per second
+    estimated_rows -- (if available) the estimated total number of rows
+    eta -- (if available) the estimated number of seconds remaining
     status -- current status of the export
 
+    If an identical export (see `find_identical`) has already completed, its
+    archive is linked instead of generating a new one. If one is still in
+    progress, this task mirrors its progress and retries until it completes.
+
+    If ``studies.export.checkpoint`` is enabled, each data file (or id range
+    shard of large data files, see ``studies.export.checkpoint_rows``) is
+    kept in a checkpoint directory next to the archive as soon as it
+    completes. If the task is re-run for the same export, because its worker
+    was lost or the user resumed it, completed data files are reused. The
+    archive is assembled from the checkpoint once all data files are done.
+
+    If ``studies.export.profile`` is enabled, a profile of each data file
+    (see `exports.profile.profile_data`) is written as JSON next to the
+    export archive.
+
+    Exports that are no longer pending are skipped, and an export is only
+    generated by one worker at a time, since the broker delivers the task
+    again if a worker takes longer than its visibility timeout (see
+    `occams.celery.VISIBILITY_TIMEOUT`).
+
     Parameters:
     export_id -- export to process
 
     """
 
     redis = app.redis
+    batch_size = app.settings.get('studies.export.batch_size')
+    write_data = \
+        exports.engines[app.settings.get('studies.export.engine', 'orm')]
+    workers = app.settings.get('studies.export.workers', 1)
+    interval = app.settings.get('studies.export.progress_interval', 5.0)
+    profiles = [] if app.settings.get('studies.export.profile') else None
+    checkpoint = app.settings.get('studies.export.checkpoint')
+
+    if app.settings.get('studies.export.cache_size'):
+        cache = exports.cache.ArtifactCache(
+            os.path.join(app.settings['studies.export.dir'], 'cache'),
+            app.settings['studies.export.cache_size'])
+    else:
+        cache = None
 
     export = Session.query(models.Export).filter_by(name=name).one()
 
-    redis.hmset(export.redis_key, {
-        'export_id': export.id,
-        'owner_user': export.owner_user.key,
-        'status': export.status,
-        'count': 0,
-        'total': len(export.contents),
-    })
+    if export.status != u'pending':
+        log.info('Skipping {} export {}'.format(export.status, name))
+        return
 
-    with closing(ZipFile(export.path, 'w', ZIP_DEFLATED)) as zfp:
+    lock = redis.lock(export.redis_key + ':lock', timeout=LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        log.info('Export {} is running elsewhere, waiting'.format(name))
+        raise make_export.retry(countdown=LOCK_TIMEOUT)
 
-        exportables = exports.list_all(Session)
+    try:
+        options = {
+            'use_choice_labels': export.use_choice_labels,
+            'expand_collections': export.expand_collections,
+            'modified_since': export.modified_since,
+        }
 
-        for item in export.contents:
-            plan = exportables[item['name']]
+        # Exports waiting on an identical export keep the fingerprint they
+        # started waiting with, and the progress mirrored from it
+        followed_at = redis.hget(export.redis_key, 'followed_at')
+        if followed_at is None or export.fingerprint is None:
+            followed_at = None
+            # Written before anything that may fail, since failures are
+            # published to the owner from here (see `ExportTask`)
+            redis.hmset(export.redis_key, {
+                'export_id': export.id,
+                'owner_user': export.owner_user.key,
+                'status': export.status,
+                'count': 0,
+                'total': len(export.contents),
+                'rows': 0,
+                'bytes': 0,
+            })
 
-            with tempfile.NamedTemporaryFile() as tfp:
-                exports.write_data(tfp, plan.data(
-                    use_choice_labels=export.use_choice_labels,
-                    expand_collections=export.expand_collections))
-                zfp.write(tfp.name, plan.file_name)
+            exportables = exports.list_all(Session)
+            plans = [exportables[item['name']] for item in export.contents]
+            export.fingerprint = exports.fingerprint(plans, **options)
+        else:
+            exportables = plans = None
 
-            redis.hincrby(export.redis_key, 'count')
+        started = time.time()
+
+        def publish():
             data = redis.hgetall(export.redis_key)
             # redis-py returns everything as string, so we need to clean it
-            for key in ('export_id', 'count', 'total'):
+            for key in ('export_id', 'count', 'total', 'rows', 'bytes'):
                 data[key] = int(data[key])
-            redis.publish('export', json.dumps(data))
+            elapsed = time.time() - started
+            data['rate'] = round(data['rows'] / elapsed, 1) if elapsed else 0.0
+            if data.get('estimated_rows'):
+                data['estimated_rows'] = int(data['estimated_rows'])
+                if data['rate']:
+                    remaining = max(data['estimated_rows'] - data['rows'], 0)
+                    data['eta'] = int(remaining / data['rate'])
+            redis.hmset(export.redis_key, dict(
+                (key, data[key]) for key in ('rate', 'eta') if key in data))
+            publish_progress(redis, data)
+            # Progress shows this worker is still running the export
+            redis.expire(lock.name, LOCK_TIMEOUT)
+            # Identical exports waiting on this one show its progress as theirs
+            followers = redis.smembers(export.redis_key + ':followers')
+            for follower_key in followers:
+                export_id, owner_user = \
+                    redis.hmget(follower_key, 'export_id', 'owner_user')
+                if export_id is None:
+                    continue
+                redis.hmset(follower_key, dict(
+                    (key, data[key]) for key in (
+                        'count', 'total', 'rows', 'bytes', 'estimated_rows',
+                        'rate', 'eta')
+                    if key in data))
+                publish_progress(redis, dict(
+                    data, export_id=int(export_id), owner_user=owner_user))
+            return data
+
+        def notify(plan):
+            redis.hincrby(export.redis_key, 'count')
+            data = publish()
             count, total = data['count'], data['total']
-            log.info(', '.join(map(str, [count, total, item['name']])))
+            log.info(', '.join(map(str, [count, total, plan.name])))
+
+        def meter_for(plan):
+            def report(meter):
+                rows, size = meter.pending
+                redis.hincrby(export.redis_key, 'rows', rows)
+                redis.hincrby(export.redis_key, 'bytes', size)
+                publish()
+                log.info('{}: {} rows, {} bytes, {:.1f} rows/sec'.format(
+                    plan.name, meter.rows, meter.bytes, meter.rate))
+            return exports.progress.ProgressMeter(report, interval=interval)
+
+        def write_for(plan):
+            if profiles is None:
+                return write_data
+
+            def write_profiled(buffer, query, **kw):
+                profile = exports.profile.profile_data(
+                    buffer, query, write_data, **kw)
+                profile['name'] = plan.name
+                profiles.append(profile)
+            return write_profiled
+
+        def complete():
+            export.status = 'complete'
+            export.file_size = os.path.getsize(export.path)
+            redis.hmset(export.redis_key, {
+                'status': export.status,
+                'file_size': humanize.naturalsize(export.file_size)
+            })
+            publish_progress(redis, redis.hgetall(export.redis_key))
+
+        source = find_identical(Session, export)
+
+        if source is not None and source.status == u'complete':
+            log.info('Reusing archive of identical export {}'.format(
+                     source.name))
+            link_archive(source, export)
+            complete()
+            return
+
+        now = time.time()
+        waited = now - float(followed_at) if followed_at is not None else 0
+
+        if source is not None and waited < FOLLOW_TIMEOUT:
+            log.info('Waiting on identical export {}'.format(source.name))
+            if followed_at is None:
+                redis.hset(export.redis_key, 'followed_at', now)
+                redis.sadd(source.redis_key + ':followers', export.redis_key)
+            # Return normally so the fingerprint is committed
+            make_export.retry(
+                countdown=min(max(waited, FOLLOW_INTERVAL),
+                              FOLLOW_MAX_INTERVAL),
+                throw=False)
+            return
+
+        if plans is None:
+            redis.hdel(export.redis_key, 'followed_at')
+            exportables = exports.list_all(Session)
+            plans = [exportables[item['name']] for item in export.contents]
+
+        with closing(_open_archive(export.path)) as zfp:
+
+            estimates = [
+                exports.estimate_rows(p.data(**options)) for p in plans]
+            if plans and None not in estimates:
+                redis.hset(export.redis_key, 'estimated_rows', sum(estimates))
+
+            if checkpoint:
+                parts_dir = export.path + '.parts'
+                if not os.path.exists(parts_dir):
+                    os.makedirs(parts_dir)
+            else:
+                parts_dir = None
+
+            if cache is None and parts_dir is None \
+                    and (workers <= 1 or len(plans) <= 1):
+                # Write each data file straight into its archive entry
+                for plan in plans:
+                    with _open_entry(zfp, plan.file_name) as entry:
+                        write_for(plan)(
+                            BinaryWriter(entry), plan.data(**options),
+                            batch_size=batch_size,
+                            progress=meter_for(plan))
+                    notify(plan)
+            else:
+                _write_data_files(
+                    zfp, plans, write_for, notify,
+                    meter_for=meter_for,
+                    batch_size=batch_size,
+                    workers=workers,
+                    cache=cache,
+                    parts_dir=parts_dir,
+                    min_size=app.settings.get(
+                        'studies.export.checkpoint_rows', 100000),
+                    **options)
+
+            fragments = (
+                _codebook_fragments_dir(), six.itervalues(exportables))
+            with _open_entry(zfp, exports.codebook.FILE_NAME) as entry:
+                exports.write_codebook_fragments(
+                    BinaryWriter(entry), *fragments)
+
+        if parts_dir is not None:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+
+        if profiles is not None:
+            with open(export.path + '.profile.json', 'w') as fp:
+                json.dump(profiles, fp, indent=2)
+
+        complete()
+
+        # Exports waiting on this one check again once it is committed,
+        # which failed exports never are
+        Session.commit()
+        _wake_followers(redis, export)
+
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # Expired, so a later delivery of this task may hold it now
+            pass
+
+
+class BinaryWriter(object):
+    """
+    A write-only binary file object proxy that also accepts text
+
+    CSV writers produce bytes on Python 2 (unicodecsv) but text with the
+    standard library on Python 3, while the COPY engine always produces
+    bytes. Archive entries and temporary files only accept bytes, so text
+    is encoded as UTF-8.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        self.buffer.write(data)
+
+    def flush(self):
+        self.buffer.flush()
+
+
+def export_queue(plans, large_rows=None, **options):
+    """
+    Chooses the queue an export should run in
+
+    Exports estimated to exceed ``studies.export.large_rows`` rows in total
+    are sent to a separate queue, so that they only hold up each other.
+
+    Parameters:
+    plans -- the export plans
+    large_rows -- (Optional) the estimated number of rows above which an
+                  export is large (default: 1000000)
+    options -- the options passed to the plans' data queries
+
+    Returns:
+    The name of the queue
+    """
+    limit = int(large_rows) if large_rows is not None else 1000000
+    estimates = [plan.estimate(**options) for plan in plans]
+    if None not in estimates and sum(e.rows for e in estimates) > limit:
+        return LARGE_EXPORT_QUEUE
+    return EXPORT_QUEUE
+
+
+def _wake_followers(redis, export):
+    """
+    Queues the checks of the exports waiting on an export
+
+    Parameters:
+    redis -- the redis connection
+    export -- the export that was completed
+    """
+    followers_key = export.redis_key + ':followers'
+    for follower_key in redis.smembers(followers_key):
+        if isinstance(follower_key, six.binary_type):
+            follower_key = follower_key.decode('utf-8')
+        name = follower_key.split(':', 1)[1]
+        make_export.apply_async(
+            args=[name], task_id=name, queue=EXPORT_QUEUE)
+    redis.delete(followers_key)
+
+
+def find_identical(dbsession, export):
+    """
+    Finds an export of the same data that an export can reuse
+
+    Parameters:
+    dbsession -- the database session
+    export -- the export to find a match for
+
+    Returns:
+    The most recent complete export whose archive is still available,
+    otherwise the oldest identical export requested before this one that
+    is still in progress, or None
+    """
+    if export.fingerprint is None:
+        return None
+
+    query = (
+        dbsession.query(models.Export)
+        .filter(models.Export.fingerprint == export.fingerprint)
+        .filter(models.Export.name != export.name))
+
+    for source in (
+            query.filter_by(status=u'complete')
+            .order_by(models.Export.id.desc())):
+        if os.path.exists(source.path):
+            return source
+
+    # Only follow earlier exports so that two exports never wait on each other
+    pending = query.filter_by(status=u'pending')
+    if export.id is not None:
+        pending = pending.filter(models.Export.id < export.id)
+
+    return pending.order_by(models.Export.id).first()
+
+
+def link_archive(source, export):
+    """
+    Shares an identical export's archive, copying it if it cannot be linked
+    """
+    try:
+        os.link(source.path, export.path)
+    except OSError:
+        shutil.copyfile(source.path, export.path)
+
+
+def publish_progress(redis, data):
+    """
+    Publishes an export's progress to its owner's channel
+
+    Parameters:
+    redis -- the redis connection
+    data -- the export's progress, see `make_export`
+    """
+    redis.publish(PROGRESS_CHANNEL + data['owner_user'], json.dumps(data))
+
+
+def _open_archive(path):
+    """
+    Opens a new export archive using the configured compression
+
+    Parameters:
+    path -- the location of the archive
+
+    Returns:
+    A writable `ZipFile`, entries are added with `_open_entry`
+    """
+    codec = ZIP_CODECS[app.settings.get('studies.export.compression',
+                                        'deflated')]
+    return ZipFile(path, 'w', codec, allowZip64=True)
+
+
+def _open_entry(zfp, name):
+    """
+    Adds an entry to an export archive using the configured compression
+
+    Parameters:
+    zfp -- the archive to add the entry to
+    name -- the name of the entry
+
+    Returns:
+    A writable `ArchiveEntry`
+    """
+    return ArchiveEntry(
+        zfp, name, level=app.settings.get('studies.export.compression_level'))
+
+
+class ArchiveEntry(object):
+    """
+    A write-only archive entry of unknown length
+
+    ``ZipFile`` can only stream to a new entry on Python 3.6+ and only
+    compresses with the default level before 3.7. Instead, the entry's
+    header is written up-front with room for ZIP64 sizes, the data is
+    compressed as it is written, and the header is rewritten with the
+    final sizes and checksum once the entry is closed.
+
+    Parameters:
+    zfp -- a `ZipFile` open for writing, no other entry may be written to
+           it until this one is closed
+    name -- the name of the entry
+    level -- (Optional) the zlib compression level of deflated entries
+    """
 
-        with tempfile.NamedTemporaryFile() as tfp:
-            codebook_chain = \
-                [p.codebook() for p in six.itervalues(exportables)]
-            exports.write_codebook(tfp, chain.from_iterable(codebook_chain))
-            zfp.write(tfp.name, exports.codebook.FILE_NAME)
+    def __init__(self, zfp, name, level=None):
+        self.zfp = zfp
+        self.info = zipfile.ZipInfo(name, time.localtime()[:6])
+        self.info.compress_type = zfp.compression
+        self.info.external_attr = 0o600 << 16
+        self.info.header_offset = zfp.fp.tell()
+        self.info.file_size = self.info.compress_size = self.info.CRC = 0
+        if self.info.compress_type == zipfile.ZIP_DEFLATED:
+            if level is None:
+                level = zlib.Z_DEFAULT_COMPRESSION
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        else:
+            self.compressor = None
+        self.zfp.fp.write(self.info.FileHeader(True))
 
-    export.status = 'complete'
-    redis.hmset(export.redis_key, {
-        'status': export.status,
-        'file_size': humanize.naturalsize(export.file_size)
-    })
-    redis.publish('export', json.dumps(redis.hgetall(export.redis_key)))
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        self.info.file_size += len(data)
+        self.info.CRC = binascii.crc32(data, self.info.CRC) & 0xffffffff
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._write(data)
+
+    def flush(self):
+        # Compressed data is only complete once the entry is closed
+        pass
+
+    def close(self):
+        if self.compressor is not None:
+            self._write(self.compressor.flush())
+            self.compressor = None
+        fp = self.zfp.fp
+        end = fp.tell()
+        fp.seek(self.info.header_offset)
+        fp.write(self.info.FileHeader(True))
+        fp.seek(end)
+        self.zfp.filelist.append(self.info)
+        self.zfp.NameToInfo[self.info.filename] = self.info
+        # Python 3 writes the central directory after the last entry it
+        # knows of, both versions only write it if the archive was modified
+        if hasattr(self.zfp, 'start_dir'):
+            self.zfp.start_dir = end
+        self.zfp._didModify = True
+
+    def _write(self, data):
+        self.info.compress_size += len(data)
+        self.zfp.fp.write(data)
+
+
+def _copy_entry(zfp, path, name):
+    """
+    Adds a file to an export archive using the configured compression
+
+    Parameters:
+    zfp -- the archive to add the file to
+    path -- the location of the file
+    name -- the name of the entry
+    """
+    with open(path, 'rb') as fp, _open_entry(zfp, name) as entry:
+        shutil.copyfileobj(fp, entry)
+
+
+def _write_data_files(zfp, plans, write_for, notify, meter_for=None,
+                      batch_size=None, workers=1, cache=None, parts_dir=None,
+                      min_size=100000, **kw):
+    """
+    Adds plan data files to an archive via intermediate files
+
+    Used when plans are generated concurrently, checkpointed or reused from
+    the cache.
+
+    Parameters:
+    zfp -- the archive to add the data files to
+    plans -- the export plans to generate
+    write_for -- returns the data file writer of a plan (see
+                 `exports.engines`)
+    notify -- called with each plan once it has been added
+    meter_for -- (Optional) returns a `exports.progress.ProgressMeter` for
+                 a plan
+    batch_size -- (Optional) number of rows to fetch at a time
+    workers -- (Optional) number of plans to generate concurrently
+    cache -- (Optional) an `exports.cache.ArtifactCache` to reuse unchanged
+             data files from
+    parts_dir -- (Optional) the export's checkpoint directory, completed
+                 data files are kept and reused from there
+                 (see `_write_checkpointed_file`)
+    min_size -- (Optional) the minimum number of records per checkpointed
+                shard
+    kw -- the options passed to the plan's data query
+    """
+
+    def generate(plan):
+        options = dict(
+            progress=meter_for(plan) if meter_for else None,
+            batch_size=batch_size,
+            isolated=workers > 1,
+            cache=cache)
+        options.update(kw)
+        if parts_dir is not None:
+            path = _write_checkpointed_file(
+                plan, parts_dir, write_for(plan), min_size=min_size,
+                **options)
+        else:
+            path = _write_data_file(plan, write_for(plan), **options)
+        return plan, path
+
+    # Plans run concurrently on their own connections, but only this
+    # thread writes to the archive
+    if workers > 1 and len(plans) > 1:
+        pool = ThreadPool(min(workers, len(plans)))
+        results = pool.imap_unordered(generate, plans)
+    else:
+        pool = None
+        results = six.moves.map(generate, plans)
+
+    try:
+        for plan, path in results:
+            try:
+                _copy_entry(zfp, path, plan.file_name)
+            finally:
+                if parts_dir is None:
+                    os.unlink(path)
+            notify(plan)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _isolate(plan):
+    """
+    Rebuilds a plan on its own database session
+
+    Plans hold on to ORM objects of the session they were listed with,
+    which must not be shared with other threads.
+
+    Parameters:
+    plan -- the export plan to rebuild
+
+    Returns:
+    A tuple of the rebuilt plan and its session, which the caller is
+    responsible for closing
+    """
+    dbsession = orm.sessionmaker(bind=Session.bind)()
+    try:
+        return exports.list_all(dbsession)[plan.name], dbsession
+    except:
+        dbsession.close()
+        raise
+
+
+def _write_data_file(plan, write_data, progress=None, batch_size=None,
+                     isolated=False, cache=None, tmp_dir=None, **kw):
+    """
+    Writes a plan's data file to a temporary location
+
+    Parameters:
+    plan -- the export plan to generate
+    write_data -- the data file writer (see `exports.engines`)
+    progress -- (Optional) a `exports.progress.ProgressMeter` for the plan
+    batch_size -- (Optional) number of rows to fetch at a time
+    isolated -- (Optional) run the plan on its own database connection,
+                so that it may be generated concurrently with other plans
+    cache -- (Optional) an `exports.cache.ArtifactCache` to reuse unchanged
+             data files from
+    tmp_dir -- (Optional) the directory to write the file in
+    kw -- the options passed to the plan's data query
+
+    Returns:
+    The path to the generated file, the caller is responsible for removing it
+    """
+    if isolated:
+        plan, dbsession = _isolate(plan)
+
+    try:
+        key = cache.key(plan, **kw) if cache is not None else None
+        if key is not None:
+            path = cache.get(key)
+            if path is not None:
+                log.info('Reusing cached data file for {}'.format(plan.name))
+                return path
+
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tfp:
+            try:
+                write_data(BinaryWriter(tfp), plan.data(**kw),
+                           batch_size=batch_size, progress=progress)
+            except:
+                os.unlink(tfp.name)
+                raise
+
+        if key is not None:
+            cache.put(key, tfp.name)
+
+        return tfp.name
+    finally:
+        if isolated:
+            dbsession.close()
+
+
+def _write_checkpointed_file(plan, parts_dir, write_data, isolated=False,
+                             min_size=100000, **kw):
+    """
+    Writes a plan's data file to an export's checkpoint directory
+
+    Large plans are written as id range shards (see `ExportPlan.id_ranges`)
+    which are checkpointed individually. Data files and shards completed by
+    a previous attempt are reused.
+
+    Parameters:
+    plan -- the export plan to generate
+    parts_dir -- the export's checkpoint directory
+    write_data -- the data file writer (see `exports.engines`)
+    isolated -- (Optional) run the plan on its own database connection,
+                so that it may be generated concurrently with other plans
+    min_size -- (Optional) the minimum number of records per shard
+    kw -- passed to `_write_data_file`
+
+    Returns:
+    The path to the completed data file, which is kept in the checkpoint
+    """
+    path = os.path.join(parts_dir, plan.file_name)
+
+    if os.path.exists(path):
+        log.info('Resuming {} from checkpoint'.format(plan.name))
+        return path
+
+    if isolated:
+        plan, dbsession = _isolate(plan)
+
+    try:
+        # Shards must cover the same ranges across attempts
+        ranges_path = path + '.ranges'
+        if os.path.exists(ranges_path):
+            with open(ranges_path) as fp:
+                ranges = json.load(fp)
+        else:
+            ranges = plan.id_ranges(CHECKPOINT_SHARDS, min_size=min_size)
+            with open(ranges_path + '.tmp', 'w') as fp:
+                json.dump(ranges, fp)
+            os.rename(ranges_path + '.tmp', ranges_path)
+
+        shard_paths = []
+
+        for i, id_range in enumerate(ranges):
+            shard_path = '%s.part%04d' % (path, i)
+            shard_paths.append(shard_path)
+            if os.path.exists(shard_path):
+                continue
+            if id_range is not None:
+                kw['id_range'] = id_range
+            # Written to the checkpoint directory so the rename is atomic
+            tmp_path = _write_data_file(
+                plan, write_data, tmp_dir=parts_dir, **kw)
+            os.rename(tmp_path, shard_path)
+    finally:
+        if isolated:
+            dbsession.close()
+
+    if len(shard_paths) == 1:
+        os.rename(shard_paths[0], path)
+    else:
+        exports.concat_data(path + '.tmp', shard_paths)
+        os.rename(path + '.tmp', path)
+
+    os.unlink(ranges_path)
+
+    return path
 
 
 @celery.task(name='make_codebook', ignore_result=True, bind=True)
@@ -168,12 +927,175 @@ def make_codebook(task):
     Pre-cooks a codebook file for faster downloading
     """
     try:
-        codebook_chain = \
-            [p.codebook() for p in six.itervalues(exports.list_all(Session))]
         path = os.path.join(app.settings['studies.export.dir'],
                             exports.codebook.FILE_NAME)
-        with open(path, 'w+b') as fp:
-            exports.write_codebook(fp, chain.from_iterable(codebook_chain))
+        with tempfile.NamedTemporaryFile(
+                dir=app.settings['studies.export.dir'], delete=False) as fp:
+            try:
+                exports.write_codebook_fragments(
+                    fp, _codebook_fragments_dir(),
+                    six.itervalues(exports.list_all(Session)))
+            except:
+                os.unlink(fp.name)
+                raise
+        # Replace atomically so downloads never see a partial codebook
+        os.rename(fp.name, path)
     except Exception as exc:
         # Need to keep retrying (default is every 3 min)
         task.retry(exc=exc)
+
+
+def _codebook_fragments_dir():
+    """
+    Returns the directory per-plan codebook fragments are kept in
+    """
+    return os.path.join(app.settings['studies.export.dir'], 'codebook')
+
+
+@celery.task(name='start_scheduled_exports', ignore_result=True)
+@with_transaction
+def start_scheduled_exports():
+    """
+    Queues exports scheduled for off hours once their time has come
+
+    Meant to be scheduled via ``celery.beat``. Scheduled exports are not
+    queued with an ETA, since the broker delivers unacknowledged tasks
+    again every visibility timeout (see `occams.celery.VISIBILITY_TIMEOUT`).
+
+    Returns:
+    The number of exports queued
+    """
+    due = (
+        Session.query(models.Export)
+        .filter_by(status=u'pending')
+        .filter(models.Export.scheduled_at <= datetime.now())
+        .order_by(models.Export.scheduled_at)
+        .all())
+
+    for export in due:
+        export.scheduled_at = None
+        make_export.apply_async(
+            args=[export.name], task_id=export.name, queue=LARGE_EXPORT_QUEUE)
+
+    log.info('Queued {} scheduled exports'.format(len(due)))
+
+    return len(due)
+
+
+@celery.task(name='gc_exports', ignore_result=True)
+@with_transaction
+def gc_exports(batch_size=GC_BATCH_SIZE):
+    """
+    Removes expired exports and export artifacts that are no longer needed
+
+    Meant to be scheduled via ``celery.beat``, each run removes:
+    * Up to `batch_size` complete or failed exports older than
+      ``studies.export.expire`` days, along with their archives, profiles
+      and checkpoints
+    * Files in the export directory that do not belong to any export
+    * Redis progress hashes of exports that are complete or no longer exist
+
+    The shared data file cache and codebook fragments are left alone, they
+    are bounded by their own settings.
+
+    Parameters:
+    batch_size -- (Optional) the maximum number of exports to remove
+
+    Returns:
+    The number of bytes reclaimed
+    """
+    redis = app.redis
+    export_dir = app.settings['studies.export.dir']
+    expire = app.settings.get('studies.export.expire')
+    reclaimed = 0
+
+    if expire is not None:
+        now = datetime.now()
+        cutoff = now - timedelta(expire)
+        # Pending exports, including scheduled ones, are still to be made
+        expired = (
+            Session.query(models.Export)
+            .filter(models.Export.status.in_([u'complete', u'failed']))
+            .filter(models.Export.scheduled_at.is_(None)
+                    | (models.Export.scheduled_at <= now))
+            .filter(models.Export.modified_at < cutoff)
+            .order_by(models.Export.modified_at)
+            .limit(batch_size)
+            .all())
+        for export in expired:
+            reclaimed += _remove_artifacts(export.path)
+            Session.delete(export)
+        Session.flush()
+        log.info('Removed {} expired exports'.format(len(expired)))
+
+    statuses = dict(Session.query(models.Export.name, models.Export.status))
+    grace_cutoff = time.time() - GC_GRACE_PERIOD
+
+    for entry in os.listdir(export_dir):
+        # Exports are named by task id, their artifacts add a suffix
+        name = entry.split('.', 1)[0]
+        if entry in GC_RESERVED or name in statuses:
+            continue
+        path = os.path.join(export_dir, entry)
+        try:
+            if os.lstat(path).st_mtime > grace_cutoff:
+                continue
+        except OSError:
+            continue
+        log.info('Removing orphaned export file {}'.format(entry))
+        reclaimed += _remove_artifacts(path, suffixes=[''])
+
+    for key in redis.scan_iter(models.Export.__tablename__ + ':*'):
+        if isinstance(key, six.binary_type):
+            key = key.decode('utf-8')
+        # Includes derived keys, such as an export's followers
+        name = key.split(':')[1]
+        if statuses.get(name) not in ('pending', 'failed'):
+            redis.delete(key)
+
+    log.info('Reclaimed {} of export artifacts'.format(
+        humanize.naturalsize(reclaimed)))
+
+    return reclaimed
+
+
+def _remove_artifacts(path, suffixes=('', '.profile.json', '.parts')):
+    """
+    Removes the files of an export
+
+    Parameters:
+    path -- the export's archive path
+    suffixes -- (Optional) the suffixes of the export's artifacts
+
+    Returns:
+    The number of bytes reclaimed, files still linked elsewhere (i.e. shared
+    by identical exports) are not counted
+    """
+    reclaimed = 0
+
+    for suffix in suffixes:
+        artifact = path + suffix
+        if os.path.isdir(artifact) and not os.path.islink(artifact):
+            for root, dirs, files in os.walk(artifact):
+                for file_name in files:
+                    reclaimed += _file_size(os.path.join(root, file_name))
+            shutil.rmtree(artifact, ignore_errors=True)
+        elif os.path.lexists(artifact):
+            reclaimed += _file_size(artifact)
+            try:
+                os.unlink(artifact)
+            except OSError:
+                pass
+
+    return reclaimed
+
+
+def _file_size(path):
+    """
+    Returns the number of bytes removing a file would reclaim
+    """
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return 0
+    return stat.st_size if stat.st_nlink <= 1 else 0
@@ -0,0 +1,112 @@
+"""
+Redis pub/sub fan-out
+
+A single subscription per process receives the messages of a family of
+channels and hands them out to local listener queues, instead of every
+listener holding its own Redis connection and filtering every message.
+
+Listeners block on standard library queues, which cooperate with gevent
+once it has patched the process (i.e. under gunicorn's gevent worker).
+"""
+
+import threading
+import time
+
+import six
+from six.moves import queue
+
+from .. import log
+
+
+class FanOut(object):
+    """
+    Distributes messages published on ``<prefix><key>`` channels to the
+    listeners of each key
+    """
+
+    def __init__(self, redis, prefix, maxsize=100, retry_interval=1.0):
+        """
+        Parameters:
+        redis -- the redis connection to subscribe with
+        prefix -- the prefix of the channels to subscribe to
+        maxsize -- (Optional) the number of messages a listener may fall
+                   behind by before further messages are dropped for it
+        retry_interval -- (Optional) number of seconds to wait before
+                          resubscribing after the connection is lost
+        """
+        self.redis = redis
+        self.prefix = prefix
+        self.maxsize = maxsize
+        self.retry_interval = retry_interval
+        self._listeners = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def listen(self, key):
+        """
+        Registers a listener for a key's messages
+
+        The subscription is started with the first listener.
+
+        Parameters:
+        key -- the channel key, without the prefix
+
+        Returns:
+        A queue that receives the key's message payloads, which must be
+        released with `unlisten` when no longer needed
+        """
+        listener = queue.Queue(self.maxsize)
+        with self._lock:
+            self._listeners.setdefault(key, set()).add(listener)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='fanout:' + self.prefix)
+                self._thread.daemon = True
+                self._thread.start()
+        return listener
+
+    def unlisten(self, key, listener):
+        """
+        Releases a listener registered with `listen`
+        """
+        with self._lock:
+            listeners = self._listeners.get(key)
+            if listeners is not None:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[key]
+
+    def dispatch(self, message):
+        """
+        Hands a pub/sub message out to the listeners of its channel's key
+        """
+        if message['type'] != 'pmessage':
+            return
+
+        channel = message['channel']
+        if isinstance(channel, six.binary_type):
+            channel = channel.decode('utf-8')
+        key = channel[len(self.prefix):]
+
+        with self._lock:
+            listeners = list(self._listeners.get(key, ()))
+
+        for listener in listeners:
+            try:
+                listener.put_nowait(message['data'])
+            except queue.Full:
+                # Slow listeners miss messages rather than hold up others
+                log.debug('Dropped message for {}'.format(channel))
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.psubscribe(self.prefix + '*')
+                for message in pubsub.listen():
+                    self.dispatch(message)
+            except Exception:
+                log.exception(
+                    'Lost subscription to {}*, resubscribing'.format(
+                        self.prefix))
+            time.sleep(self.retry_interval)
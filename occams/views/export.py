@@ -1,22 +1,27 @@
 from datetime import datetime, timedelta
-import json
 import os
+import threading
 import uuid
 
 from babel.dates import format_datetime
 from humanize import naturalsize
 from pyramid.i18n import get_localizer, negotiate_locale_name
-from pyramid.httpexceptions import HTTPBadRequest, HTTPFound, HTTPOk
+from pyramid.httpexceptions import \
+    HTTPBadRequest, HTTPFound, HTTPNotFound, HTTPOk
+from pyramid.settings import asbool
 from pyramid.response import FileResponse
 from pyramid.session import check_csrf_token
 from pyramid.view import view_config
 import six
+import sqlalchemy as sa
+from sqlalchemy import orm
 import transaction
 import wtforms
 
 from .. import _, log, models, exports, tasks
 from ..utils.forms import wtferrors, Form
 from ..utils.pagination import Pagination
+from ..utils.pubsub import FanOut
 
 
 @view_config(
@@ -55,12 +60,25 @@ def checkout(context, request):
     isn't left with an unresponsive page.
     """
     dbsession = request.dbsession
+    settings = request.registry.settings
     exportables = exports.list_all(request.dbsession, include_rand=False)
-    limit = request.registry.settings.get('app.export.limit')
+    budget = settings.get('studies.export.byte_budget')
+    off_hours = settings.get('studies.export.off_hours')
+    limit = settings.get('app.export.limit')
     exceeded = limit is not None and query_exports(request).count() > limit
+    # Running exports count against the user until they finish, including
+    # those waiting on an identical export, but not those scheduled for off
+    # hours since they do not take up a worker yet
+    concurrency = settings.get('studies.export.user_concurrency')
+    busy = (
+        concurrency is not None
+        and query_exports(request)
+        .filter_by(status=u'pending', scheduled_at=None)
+        .count() >= concurrency)
     errors = {}
 
-    if request.method == 'POST' and check_csrf_token(request) and not exceeded:
+    if request.method == 'POST' and check_csrf_token(request) \
+            and not exceeded and not busy:
 
         def check_exportable(form, field):
             if any(value not in exportables for value in field.data):
@@ -74,6 +92,7 @@ def checkout(context, request):
                     wtforms.validators.InputRequired()])
             expand_collections = wtforms.BooleanField(default=False)
             use_choice_labels = wtforms.BooleanField(default=False)
+            incremental = wtforms.BooleanField(default=False)
 
         form = CheckoutForm(request.POST)
 
@@ -81,40 +100,161 @@ def checkout(context, request):
             errors = wtferrors(form)
         else:
             task_id = six.text_type(str(uuid.uuid4()))
-            dbsession.add(models.Export(
-                name=task_id,
-                expand_collections=form.expand_collections.data,
-                use_choice_labels=form.use_choice_labels.data,
-                owner_user=(dbsession.query(models.User)
-                            .filter_by(key=request.authenticated_userid)
-                            .one()),
-                contents=[exportables[k].to_json() for k in form.contents.data]
-            ))
-
-            def apply_after_commit(success):
-                if success:
-                    tasks.make_export.apply_async(
-                        args=[task_id],
-                        task_id=task_id,
-                        countdown=4)
-
-            # Avoid race-condition by executing the task after succesful commit
-            transaction.get().addAfterCommitHook(apply_after_commit)
-
-            msg = _(u'Your request has been received!')
-            request.session.flash(msg, 'success')
-
-            next_url = request.route_path('studies.exports_status')
-            return HTTPFound(location=next_url)
+            owner_user = (
+                dbsession.query(models.User)
+                .filter_by(key=request.authenticated_userid)
+                .one())
+
+            plans = [exportables[k] for k in form.contents.data]
+            options = {
+                'use_choice_labels': form.use_choice_labels.data,
+                'expand_collections': form.expand_collections.data,
+            }
+            if form.incremental.data:
+                options['modified_since'] = watermark(
+                    dbsession, owner_user, plans, **options)
+            else:
+                options['modified_since'] = None
+
+            # Exports over budget wait for off hours if configured,
+            # otherwise they are refused
+            size = estimate_size(plans, **options)
+            over_budget = budget is not None and size > budget
+
+            if over_budget and off_hours is None:
+                errors = {'contents': request.localizer.translate(_(
+                    u'The selected data is estimated at ${size}, which '
+                    u'exceeds the limit of ${budget}. '
+                    u'Please select less data.',
+                    mapping={
+                        'size': naturalsize(size),
+                        'budget': naturalsize(budget)}))}
+            else:
+                export = models.Export(
+                    name=task_id,
+                    owner_user=owner_user,
+                    contents=[plan.to_json() for plan in plans],
+                    fingerprint=exports.fingerprint(plans, **options),
+                    **options)
+                dbsession.add(export)
+
+                source = tasks.find_identical(dbsession, export)
+
+                if source is not None and source.status == u'complete':
+                    # Share the identical archive instead of queuing
+                    log.info('Reusing archive of identical export {}'.format(
+                             source.name))
+                    tasks.link_archive(source, export)
+                    export.status = u'complete'
+                    export.file_size = source.file_size
+                    msg = _(u'Your request has been received!')
+                elif over_budget:
+                    # Queued by the scheduler rather than with an ETA, which
+                    # the broker would deliver again every visibility timeout
+                    export.scheduled_at = off_hours_start(off_hours)
+                    msg = _(
+                        u'Your request is large and has been scheduled '
+                        u'for ${start}.',
+                        mapping={'start': format_datetime(
+                            export.scheduled_at,
+                            locale=negotiate_locale_name(request))})
+                else:
+                    queue = tasks.export_queue(
+                        plans,
+                        large_rows=settings.get('studies.export.large_rows'),
+                        **options)
+                    msg = _(u'Your request has been received!')
+
+                    def apply_after_commit(success):
+                        if success:
+                            tasks.make_export.apply_async(
+                                args=[task_id],
+                                task_id=task_id,
+                                queue=queue,
+                                countdown=4)
+
+                    # Avoid race-condition by executing the task after
+                    # succesful commit
+                    transaction.get().addAfterCommitHook(apply_after_commit)
+
+                request.session.flash(msg, 'success')
+
+                next_url = request.route_path('studies.exports_status')
+                return HTTPFound(location=next_url)
+
+    def describe(plan):
+        estimate = plan.estimate()
+        if estimate is not None:
+            return {
+                'rows': '{:,}'.format(estimate.rows),
+                'columns': estimate.columns,
+                'size': naturalsize(estimate.bytes)}
 
     return {
         'errors': errors,
         'exceeded': exceeded,
         'limit': limit,
-        'exportables': exportables
+        'busy': busy,
+        'concurrency': concurrency,
+        'budget': naturalsize(budget) if budget is not None else None,
+        'selected': request.GET.get('contents'),
+        'exportables': exportables,
+        'estimates': dict(
+            (name, describe(plan)) for name, plan in exportables.items())
     }
 
 
+def watermark(dbsession, owner_user, plans, **options):
+    """
+    Finds the time an incremental export should include changes since
+
+    Each plan's watermark is the start of the owner's last complete export
+    that contained it with the same options. Plans may have been exported
+    at different times, so the export starts from the earliest of them.
+
+    Parameters:
+    dbsession -- the database session
+    owner_user -- the user requesting the export
+    plans -- the export plans
+    options -- the export's options, other than ``modified_since``
+
+    Returns:
+    The watermark, or None if any plan has not been exported before
+    """
+    watermarks = []
+    for plan in plans:
+        plan_watermark = (
+            dbsession.query(sa.func.max(models.Export.created_at))
+            .filter_by(owner_user=owner_user, status=u'complete', **options)
+            .filter(models.Export.contents.contains([{'name': plan.name}]))
+            .scalar())
+        if plan_watermark is None:
+            return None
+        watermarks.append(plan_watermark)
+    return min(watermarks) if watermarks else None
+
+
+def estimate_size(plans, **options):
+    """
+    Estimates the total size of an export's data files in bytes
+
+    Plans that cannot be estimated are not counted.
+    """
+    estimates = [plan.estimate(**options) for plan in plans]
+    return sum(e.bytes for e in estimates if e is not None)
+
+
+def off_hours_start(hour):
+    """
+    Returns the next time large exports are allowed to start
+    """
+    now = datetime.now()
+    start = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if start <= now:
+        start += timedelta(days=1)
+    return start
+
+
 @view_config(
     route_name='studies.exports_codebook',
     permission='view',
@@ -161,8 +301,27 @@ def codebook_json(context, request):
     permission='view')
 def codebook_download(context, request):
     """
-    Returns full codebook file
+    Returns full codebook file, or a single data file's if specified
     """
+    file = request.GET.get('file')
+
+    if file:
+        exportables = exports.list_all(request.dbsession)
+
+        if file not in exportables:
+            raise HTTPBadRequest(u'File specified does not exist')
+
+        plan = exportables[file]
+        buffer = six.BytesIO()
+        exports.write_codebook(buffer, plan.codebook())
+        response = request.response
+        response.content_type = 'text/csv'
+        response.content_disposition = \
+            'attachment;filename=%s-%s' % (plan.name,
+                                           exports.codebook.FILE_NAME)
+        response.body = buffer.getvalue()
+        return response
+
     export_dir = request.registry.settings['studies.export.dir']
     codebook_name = exports.codebook.FILE_NAME
     path = os.path.join(export_dir, codebook_name)
@@ -174,6 +333,66 @@ def codebook_download(context, request):
     return response
 
 
+@view_config(
+    route_name='studies.exports_plan',
+    permission='add')
+def plan_download(context, request):
+    """
+    Streams a single data file directly, bypassing the export queue
+
+    Intended for small data files, if the data file is estimated to
+    exceed the configured row limit the user is redirected to the checkout
+    page to queue it as a regular export instead.
+    """
+    settings = request.registry.settings
+    exportables = exports.list_all(request.dbsession, include_rand=False)
+    name = request.matchdict['plan']
+
+    if name not in exportables:
+        raise HTTPNotFound()
+
+    plan = exportables[name]
+    options = {
+        'use_choice_labels': asbool(request.GET.get('use_choice_labels')),
+        'expand_collections': asbool(request.GET.get('expand_collections')),
+    }
+
+    limit = settings['studies.export.stream_limit']
+    estimate = exports.estimate_rows(plan.data(**options))
+
+    if estimate is not None and estimate > limit:
+        request.session.flash(
+            _(u'${title} is too large to download directly, '
+              u'please export it instead.',
+              mapping={'title': plan.title}),
+            'warning')
+        return HTTPFound(location=request.route_path(
+            'studies.exports_checkout', _query={'contents': name}))
+
+    # The request transaction is finished by the time the response body is
+    # sent, so the data is read over its own connection, with a plan that
+    # does not hold on to the request's ORM objects
+    dbsession = orm.sessionmaker(bind=request.dbsession.bind)()
+    plan = exports.list_all(dbsession, include_rand=False)[name]
+    batch_size = settings.get('studies.export.batch_size')
+
+    def stream():
+        try:
+            for chunk in exports.iter_data(
+                    plan.data(**options), batch_size=batch_size):
+                yield chunk
+        finally:
+            dbsession.close()
+
+    response = request.response
+    response.content_type = 'text/csv'
+    response.content_disposition = 'attachment;filename=%s' % plan.file_name
+    # Set reverse proxies (if any, i.e nginx) not to buffer this connection
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.app_iter = stream()
+    return response
+
+
 @view_config(
     route_name='studies.exports_status',
     permission='view',
@@ -195,55 +414,101 @@ def status(context, request):
 def status_json(context, request):
     """
     Returns the current exports statuses.
+
+    The page and the total count are fetched in one query, and the progress
+    of unfinished exports in one redis round trip, since this is polled
+    constantly.
     """
 
+    per_page = 5
     exports_query = query_exports(request)
-    exports_count = exports_query.count()
 
-    pagination = Pagination(request.GET.get('page', 1), 5, exports_count)
-    exports_query = exports_query.offset(pagination.offset).limit(5)
+    def fetch_page(page):
+        return (
+            exports_query
+            .add_columns(sa.func.count().over().label('total_count'))
+            .offset((page - 1) * per_page)
+            .limit(per_page)
+            .all())
+
+    page = max(1, int(request.GET.get('page') or 1))
+    rows = fetch_page(page)
+
+    if rows:
+        exports_count = rows[0].total_count
+        pagination = Pagination(page, per_page, exports_count)
+    else:
+        # Either there are no exports, or the page is past the last one
+        exports_count = exports_query.count()
+        pagination = Pagination(page, per_page, exports_count)
+        if exports_count:
+            rows = fetch_page(pagination.page)
+
+    exports_page = [row[0] for row in rows]
 
     locale = negotiate_locale_name(request)
     localizer = get_localizer(request)
 
-    redis = request.redis
+    unfinished = [e for e in exports_page if e.status != 'complete']
+    if unfinished:
+        pipeline = request.redis.pipeline(transaction=False)
+        for export in unfinished:
+            pipeline.hgetall(export.redis_key)
+        progress = dict(zip((e.id for e in unfinished), pipeline.execute()))
+    else:
+        progress = {}
+
+    titles = {}
+
+    def title(count):
+        if count not in titles:
+            titles[count] = localizer.pluralize(
+                _(u'Export containing ${count} item'),
+                _(u'Export containing ${count} items'),
+                count, 'occams', mapping={'count': count})
+        return titles[count]
 
     def export2json(export):
-        # TODO: This doesn't actually work, I can't figure out how to get
-        #       the corect data out of redis
-        if export.status != 'complete':
-            data = redis.hgetall(export.redis_key)
-        else:
-            data = {}
-        log.debug('info: {}'.format(str(data)))
-        count = len(export.contents)
+        data = progress.get(export.id) or {}
+        file_size = export.file_size
+        if file_size is None and export.status == 'complete':
+            # Archives completed before their size was recorded
+            path = export.path
+            if path and os.path.isfile(path):
+                file_size = os.path.getsize(path)
         return {
             'id': export.id,
-            'title': localizer.pluralize(
-                _(u'Export containing ${count} item'),
-                _(u'Export containing ${count} items'),
-                count, 'occams', mapping={'count': count}),
+            'title': title(len(export.contents)),
             'name': export.name,
             'status': export.status,
             'use_choice_labels': export.use_choice_labels,
             'expand_collections': export.expand_collections,
+            'modified_since': (
+                format_datetime(export.modified_since, locale=locale)
+                if export.modified_since else None),
             'contents': sorted(export.contents, key=lambda v: v['title']),
             'count': data.get('count'),
             'total': data.get('total'),
-            'file_size': (naturalsize(export.file_size)
-                          if export.file_size else None),
+            'rows': data.get('rows'),
+            'estimated_rows': data.get('estimated_rows'),
+            'rate': data.get('rate'),
+            'eta': data.get('eta'),
+            'file_size': (naturalsize(file_size)
+                          if file_size is not None else None),
             'download_url': request.route_path('studies.export_download',
                                                export=export.id),
             'delete_url': request.route_path('studies.export',
                                              export=export.id),
-            'create_date': format_datetime(export.create_date, locale=locale),
+            'resume_url': request.route_path('studies.export_resume',
+                                             export=export.id),
+            'create_date': format_datetime(export.created_at, locale=locale),
             'expire_date': format_datetime(export.expire_date, locale=locale)
         }
 
     return {
         'csrf_token': request.session.get_csrf_token(),
         'pager': pagination.serialize(),
-        'exports': [export2json(e) for e in exports_query]
+        'exports': [export2json(e) for e in exports_page]
     }
 
 
@@ -254,30 +519,44 @@ def notifications(context, request):
     """
     Yields server-sent events containing status updates of current exports
     REQUIRES GUNICORN WITH GEVENT WORKER
+
+    Streams send a heartbeat comment every ``studies.export.sse_heartbeat``
+    seconds so that abandoned streams are detected, and end after
+    ``studies.export.sse_timeout`` seconds without progress (browsers
+    reconnect automatically).
     """
 
     # Close DB connections so we don't hog them while polling
     request.dbsession.close()
 
+    settings = request.registry.settings
+    heartbeat = settings['studies.export.sse_heartbeat']
+    timeout = settings['studies.export.sse_timeout']
+    hub = progress_hub(request)
+    userid = request.authenticated_userid
+
     def listener():
-        pubsub = request.redis.pubsub()
-        pubsub.subscribe('export')
+        messages = hub.listen(userid)
 
         sse_payload = 'id:{0}\nevent: progress\ndata:{1}\n\n'
 
-        # emit subsequent progress
-        for message in pubsub.listen():
-
-            if message['type'] != 'message':
-                continue
-
-            data = json.loads(message['data'])
-
-            if data['owner_user'] != request.authenticated_userid:
-                continue
-
-            log.debug(data)
-            yield sse_payload.format(str(uuid.uuid4()), json.dumps(data))
+        try:
+            idle = 0
+            while idle < timeout:
+                try:
+                    data = messages.get(timeout=heartbeat)
+                except six.moves.queue.Empty:
+                    idle += heartbeat
+                    # Writing fails once the client is gone, ending the stream
+                    yield ':\n\n'
+                    continue
+                idle = 0
+                if isinstance(data, six.binary_type):
+                    data = data.decode('utf-8')
+                log.debug(data)
+                yield sse_payload.format(str(uuid.uuid4()), data)
+        finally:
+            hub.unlisten(userid, messages)
 
     response = request.response
     response.content_type = 'text/event-stream'
@@ -289,6 +568,25 @@ def notifications(context, request):
     return response
 
 
+# Registry key of the export progress subscriber (see `progress_hub`)
+PROGRESS_HUB = 'occams.export_progress_hub'
+
+_progress_hub_lock = threading.Lock()
+
+
+def progress_hub(request):
+    """
+    Returns the process-wide subscriber to export progress channels
+    """
+    registry = request.registry
+    with _progress_hub_lock:
+        hub = registry.get(PROGRESS_HUB)
+        if hub is None:
+            hub = registry[PROGRESS_HUB] = \
+                FanOut(request.redis, tasks.PROGRESS_CHANNEL)
+    return hub
+
+
 @view_config(
     route_name='studies.export',
     permission='delete',
@@ -307,6 +605,47 @@ def delete_json(context, request):
     return HTTPOk()
 
 
+@view_config(
+    route_name='studies.export_resume',
+    permission='edit',
+    request_method='POST',
+    xhr=True)
+def resume_json(context, request):
+    """
+    Handles resume AJAX request
+
+    Failed exports are queued again, picking up from their checkpoint
+    (if any) instead of starting over.
+    """
+    check_csrf_token(request)
+    export = context
+
+    if export.status != u'failed':
+        raise HTTPBadRequest('Export has not failed')
+
+    export.status = u'pending'
+
+    exportables = exports.list_all(request.dbsession)
+    queue = tasks.export_queue(
+        [exportables[item['name']] for item in export.contents
+         if item['name'] in exportables],
+        large_rows=request.registry.settings.get('studies.export.large_rows'),
+        use_choice_labels=export.use_choice_labels,
+        expand_collections=export.expand_collections,
+        modified_since=export.modified_since)
+
+    def apply_after_commit(success):
+        if success:
+            tasks.make_export.apply_async(
+                args=[export.name],
+                task_id=export.name,
+                queue=queue)
+
+    transaction.get().addAfterCommitHook(apply_after_commit)
+
+    return HTTPOk()
+
+
 @view_config(
     route_name='studies.export_download',
     permission='view')
@@ -345,6 +684,6 @@ def query_exports(request):
         cutoff = datetime.now() - timedelta(int(export_expire))
         query = query.filter(models.Export.modified_at >= cutoff)
 
-    query = query.order_by(models.Export.create_date.desc())
+    query = query.order_by(models.Export.created_at.desc())
 
     return query
@@ -359,20 +359,26 @@ def visits_cycle(context, request):
     by_state = next(
         (state for state in states if state.name == by_state), None)
 
+    # Tally all states at once from the pre-resolved entity contexts
+    summary_query = (
+        dbsession.query(
+            models.EntitySummary.state,
+            sa.func.count(sa.distinct(models.EntitySummary.visit_id)),
+            sa.func.count())
+        .join(
+            models.visit_cycle_table,
+            models.visit_cycle_table.c.visit_id
+            == models.EntitySummary.visit_id)
+        .filter(models.visit_cycle_table.c.cycle_id == cycle.id)
+        .group_by(models.EntitySummary.state))
+
+    counts = dict((name, (visits, entities))
+                  for name, visits, entities in summary_query)
+
     for state in states:
-        data['visits_summary'][state.name] = (
-            cycle.visits.filter(models.Visit.entities.any(state=state))
-            .count())
-        data['data_summary'][state.name] = (
-            dbsession.query(models.Entity)
-            .join(models.Entity.contexts)
-            .join(
-                models.Visit,
-                (models.Context.external == 'visit')
-                & (models.Visit.id == models.Context.key))
-            .filter(models.Visit.cycles.any(id=cycle.id))
-            .filter(models.Entity.state == state)
-            .count())
+        visits, entities = counts.get(state.name, (0, 0))
+        data['visits_summary'][state.name] = visits
+        data['data_summary'][state.name] = entities
 
     def count_state_exp(name):
         return sa.func.count(
@@ -55,5 +55,6 @@ setup(
     [console_scripts]
     occams_buildassets = occams.scripts.buildassets:main
     occams_initdb = occams.scripts.initdb:main
+    occams_summary = occams.scripts.summary:main
     """,
 )
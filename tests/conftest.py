@@ -90,6 +90,20 @@ def create_tables(request):
     request.addfinalizer(drop_tables)
 
 
+@pytest.yield_fixture(autouse=True)
+def columns_cache():
+    """
+    Isolates the report column plans cached by each test
+    """
+    from occams import reporting
+
+    reporting.clear_columns_cache()
+
+    yield
+
+    reporting.clear_columns_cache()
+
+
 @pytest.yield_fixture
 def config(request):
     """
@@ -376,3 +390,48 @@ def celery(request):
         Session.remove()
 
     request.addfinalizer(cleanup)
+
+
+@pytest.yield_fixture
+def committed_visits(celery):
+    """
+    (Function Testing) Commits patient visits for concurrent export workers
+
+    Export workers run on their own connections, so they can only see
+    committed records, unlike the rest of the (rolled back) test data.
+
+    :param celery: The celery testing application
+
+    :returns: the number of committed visits
+    """
+    from datetime import date
+    from sqlalchemy import orm
+    from occams.celery import Session
+    from occams import models
+
+    count = 3
+
+    dbsession = orm.sessionmaker(bind=Session.bind)()
+    models.set_pg_locals(dbsession, 'tests', USERID)
+    site = models.Site(name=u'ucsd', title=u'UCSD')
+    study = models.Study(
+        name=u'test', title=u'Test', short_title=u'T', code=u'000',
+        consent_date=date(2014, 1, 1))
+    cycle = models.Cycle(name=u'week-1', title=u'Week 1', week=1, study=study)
+    dbsession.add_all([
+        models.Visit(
+            visit_date=date(2015, 1, 1),
+            cycles=[cycle],
+            patient=models.Patient(site=site, pid=u'P%04d' % i))
+        for i in range(count)])
+    dbsession.commit()
+
+    yield count
+
+    dbsession.execute('DELETE FROM "visit"')
+    dbsession.execute('DELETE FROM "patient"')
+    dbsession.execute('DELETE FROM "site"')
+    dbsession.execute('DELETE FROM "cycle"')
+    dbsession.execute('DELETE FROM "study"')
+    dbsession.commit()
+    dbsession.close()
@@ -0,0 +1,75 @@
+import pytest
+
+
+class TestArtifactCache:
+
+    @pytest.fixture
+    def plan(self):
+        from occams.exports.plan import ExportPlan
+
+        class DummyPlan(ExportPlan):
+            name = u'aform'
+            title = u'A Form'
+            state = [['aform', 1, None]]
+
+            def fingerprint(self):
+                return self.state
+
+        return DummyPlan()
+
+    def _create_one(self, *args, **kw):
+        from occams.exports.cache import ArtifactCache
+        return ArtifactCache(*args, **kw)
+
+    def _write(self, tmpdir, name, size):
+        path = tmpdir.join(name)
+        path.write('x' * size)
+        return str(path)
+
+    def test_key(self, tmpdir, plan):
+        """
+        It should generate a different key when options or data change
+        """
+        cache = self._create_one(str(tmpdir.join('cache')), 100)
+        key = cache.key(plan, use_choice_labels=False)
+        assert key == cache.key(plan, use_choice_labels=False)
+        assert key != cache.key(plan, use_choice_labels=True)
+        plan.state = [['aform', 2, None]]
+        assert key != cache.key(plan, use_choice_labels=False)
+
+    def test_key_not_cacheable(self, tmpdir):
+        """
+        It should not generate keys for plans without a fingerprint
+        """
+        from occams.exports.plan import ExportPlan
+        cache = self._create_one(str(tmpdir.join('cache')), 100)
+        assert cache.key(ExportPlan()) is None
+
+    def test_get_put(self, tmpdir):
+        """
+        It should check out a private copy of a cached file
+        """
+        import os
+        cache = self._create_one(str(tmpdir.join('cache')), 100)
+        assert cache.get('abc') is None
+
+        cache.put('abc', self._write(tmpdir, 'data.csv', 10))
+        path = cache.get('abc')
+        assert path is not None
+        assert open(path).read() == 'x' * 10
+        os.unlink(path)
+        assert cache.get('abc') is not None
+
+    def test_evict(self, tmpdir):
+        """
+        It should evict the least recently used files when over capacity
+        """
+        import os
+        cache = self._create_one(str(tmpdir.join('cache')), 25)
+        cache.put('a', self._write(tmpdir, 'a.csv', 10))
+        cache.put('b', self._write(tmpdir, 'b.csv', 10))
+        os.utime(os.path.join(cache.path, 'a.csv'), (0, 0))
+        cache.put('c', self._write(tmpdir, 'c.csv', 10))
+        assert cache.get('a') is None
+        assert cache.get('b') is not None
+        assert cache.get('c') is not None
@@ -25,6 +25,187 @@ class TestWriteData:
         assert sorted(['anumeric', 'astring']) == sorted(rows[0])
         assert sorted([u'420', u'¿Qué pasa?']) == sorted(rows[1])
 
+    def test_progress(self, dbsession):
+        """
+        It should count the rows and bytes written
+        """
+        from contextlib import closing
+        import six
+        from sqlalchemy import func
+        from occams import exports
+        from occams.exports.progress import ProgressMeter
+
+        reports = []
+        meter = ProgressMeter(lambda m: reports.append(m.pending))
+        query = dbsession.query(
+            func.generate_series(1, 100).label('id'))
+
+        with closing(six.BytesIO()) as fp:
+            exports.write_data(fp, query, progress=meter)
+            size = len(fp.getvalue())
+
+        assert meter.rows == 100
+        assert meter.bytes == size
+        assert sum(rows for rows, _ in reports) == 100
+
+    def test_estimate_rows(self, dbsession):
+        """
+        It should estimate the number of rows from the query planner
+        """
+        from sqlalchemy import func
+        from occams import exports
+
+        query = dbsession.query(
+            func.generate_series(1, 100).label('id'))
+
+        assert exports.estimate_rows(query) > 0
+
+    def test_batch_size_bounded_memory(self, dbsession):
+        """
+        It should keep peak memory flat as the row count grows when streaming
+        """
+        import os
+        import resource
+        from sqlalchemy import func, literal_column, Integer, Unicode
+        from occams import exports
+
+        def query(count):
+            return (
+                dbsession.query(
+                    literal_column('n', Integer).label('n'),
+                    literal_column("repeat('x', 200)", Unicode).label('s'))
+                .select_from(func.generate_series(1, count).alias('n')))
+
+        def peak_rss():
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        with open(os.devnull, 'wb') as fp:
+            exports.write_data(fp, query(10000), batch_size=1000)
+            baseline = peak_rss()
+            exports.write_data(fp, query(500000), batch_size=1000)
+            peak = peak_rss()
+
+        # ru_maxrss is in kilobytes, fully buffering would be > 100MB
+        assert peak - baseline < 16 * 1024
+
+
+class TestCopyData:
+
+    def test_unicode(self, dbsession):
+        """
+        It should generate the same CSV contents as the ORM writer
+        """
+        from contextlib import closing
+        import six
+        from sqlalchemy import literal_column, Integer, Unicode
+        from occams import exports
+
+        query = dbsession.query(
+            literal_column(u"'420'", Integer).label(u'anumeric'),
+            literal_column(u"'¿Qué pasa?'", Unicode).label(u'astring'),
+            )
+
+        with closing(six.BytesIO()) as fp:
+            exports.copy_data(fp, query)
+            fp.seek(0)
+            rows = [r for r in exports.csv.reader(fp)]
+
+        assert ['anumeric', 'astring'] == rows[0]
+        assert [u'420', u'¿Qué pasa?'] == rows[1]
+
+
+class TestCompactData:
+
+    def _write(self, path, rows):
+        from occams import exports
+        with open(path, 'w+b') as fp:
+            exports.csv.writer(fp).writerows(rows)
+
+    def _read(self, path):
+        from occams import exports
+        with open(path, 'rb') as fp:
+            return [r for r in exports.csv.reader(fp)]
+
+    def test_merge(self, tmpdir):
+        """
+        It should replace changed records and add new ones in id order
+        """
+        import os
+        from occams import exports
+
+        path = str(tmpdir.join('aform.csv'))
+        shard1 = str(tmpdir.join('aform.delta-1.csv'))
+        shard2 = str(tmpdir.join('aform.delta-2.csv'))
+        self._write(path, [['id', 'a'], ['1', 'x'], ['3', 'x'], ['5', 'x']])
+        self._write(shard1, [['id', 'a'], ['3', 'y'], ['4', 'y']])
+        self._write(shard2, [['id', 'a'], ['4', 'z'], ['9', 'z']])
+
+        exports.compact_data(path, [shard1, shard2])
+
+        assert self._read(path) == [
+            ['id', 'a'], ['1', 'x'], ['3', 'y'], ['4', 'z'], ['5', 'x'],
+            ['9', 'z']]
+        assert not os.path.exists(shard1)
+        assert not os.path.exists(shard2)
+
+    def test_different_columns(self, tmpdir):
+        """
+        It should refuse to merge delta files with different columns
+        """
+        import pytest
+        from occams import exports
+
+        path = str(tmpdir.join('aform.csv'))
+        shard = str(tmpdir.join('aform.delta-1.csv'))
+        self._write(path, [['id', 'a'], ['1', 'x']])
+        self._write(shard, [['id', 'b'], ['1', 'y']])
+
+        with pytest.raises(ValueError):
+            exports.compact_data(path, [shard])
+
+
+class TestConcatData:
+
+    def _write(self, tmpdir, name, rows):
+        from occams import exports
+        path = tmpdir.join(name)
+        with open(str(path), 'w+b') as fp:
+            exports.csv.writer(fp).writerows(rows)
+        return str(path)
+
+    def test_concat(self, tmpdir):
+        """
+        It should append shards in order under a single header
+        """
+        from occams import exports
+        shards = [
+            self._write(tmpdir, 'aform.csv.part0000',
+                        [['id', 'foo'], ['1', 'a'], ['2', 'b']]),
+            self._write(tmpdir, 'aform.csv.part0001',
+                        [['id', 'foo'], ['3', 'c']]),
+        ]
+        path = str(tmpdir.join('aform.csv'))
+
+        exports.concat_data(path, shards)
+
+        with open(path, 'rb') as fp:
+            rows = list(exports.csv.reader(fp))
+        assert rows == [['id', 'foo'], ['1', 'a'], ['2', 'b'], ['3', 'c']]
+        assert tmpdir.listdir() == [tmpdir.join('aform.csv')]
+
+    def test_different_columns(self, tmpdir):
+        """
+        It should refuse to concatenate shards with different columns
+        """
+        import pytest
+        from occams import exports
+        shards = [
+            self._write(tmpdir, 'aform.csv.part0000', [['id', 'foo']]),
+            self._write(tmpdir, 'aform.csv.part0001', [['id', 'bar']]),
+        ]
+        with pytest.raises(ValueError):
+            exports.concat_data(str(tmpdir.join('aform.csv')), shards)
+
 
 class TestDumpCodeBook:
 
@@ -42,3 +223,54 @@ class TestDumpCodeBook:
             fieldnames = exports.csv.DictReader(fp).fieldnames
 
         assert sorted(fieldnames) == sorted(exports.codebook.HEADER)
+
+
+class TestWriteCodebookFragments:
+
+    def _make_plan(self, name, versions):
+        from occams.exports.codebook import row, types
+        from occams.exports.plan import ExportPlan
+
+        class DummyPlan(ExportPlan):
+            calls = 0
+
+            def codebook(self):
+                DummyPlan.calls += 1
+                yield row('id', self.name, types.NUMBER)
+
+        plan = DummyPlan()
+        plan.name = name
+        plan.versions = versions
+        return plan
+
+    def test_reuse_fragments(self, tmpdir):
+        """
+        It should only regenerate the codebooks of plans that changed
+        """
+        from contextlib import closing
+        import six
+        from occams import exports
+
+        fragments_dir = str(tmpdir.join('codebook'))
+        foo = self._make_plan('foo', ['2015-01-01'])
+        bar = self._make_plan('bar', ['2015-01-01'])
+
+        def dump(plans):
+            with closing(six.BytesIO()) as fp:
+                exports.write_codebook_fragments(fp, fragments_dir, plans)
+                fp.seek(0)
+                return list(exports.csv.DictReader(fp))
+
+        rows = dump([foo, bar])
+        assert [r['table'] for r in rows] == ['foo', 'bar']
+        assert type(foo).calls == 1
+        assert type(bar).calls == 1
+
+        foo.versions = ['2015-01-01', '2015-06-01']
+        rows = dump([foo, bar])
+        assert [r['table'] for r in rows] == ['foo', 'bar']
+        assert type(foo).calls == 2
+        assert type(bar).calls == 1
+
+        # Superseded revisions are removed
+        assert len(tmpdir.join('codebook').listdir()) == 2
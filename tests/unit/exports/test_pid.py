@@ -26,6 +26,19 @@ class TestPidPlan:
 
         assert sorted(codebook_columns) == sorted(data_columns)
 
+    def test_estimate(self, dbsession):
+        """
+        It should estimate the size of the data file from the query planner
+        """
+        plan = self._create_one(dbsession)
+
+        estimate = plan.estimate()
+
+        assert estimate.columns == len(plan.data().column_descriptions)
+        assert estimate.rows >= 0
+        assert estimate.bytes >= 0
+        assert plan.estimate() is estimate  # cached
+
     def test_data_without_refs(self, dbsession):
         """
         It should be able to generate reports without refs
@@ -86,6 +99,29 @@ class TestPidPlan:
         data = query.one()._asdict()
         assert data['med_num'] == '999'
 
+    def test_data_modified_since(self, dbsession):
+        """
+        It should only include patients modified after the watermark
+        """
+        from datetime import timedelta
+        from occams import models
+
+        plan = self._create_one(dbsession)
+
+        patient = models.Patient(
+            pid=u'xxx-xxx',
+            site=models.Site(name=u'someplace', title=u'Some Place')
+        )
+
+        dbsession.add(patient)
+        dbsession.flush()
+        # Set by the database
+        dbsession.refresh(patient)
+
+        before = patient.modified_at - timedelta(seconds=1)
+        assert plan.data(modified_since=before).count() == 1
+        assert plan.data(modified_since=patient.modified_at).count() == 0
+
     @pytest.mark.parametrize('study_code', [u'ET', u'LTW', u'CVCT'])
     def test_data_with_early_test(self, dbsession, study_code):
         """
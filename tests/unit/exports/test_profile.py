@@ -0,0 +1,60 @@
+import pytest
+
+
+class TestProfileData:
+
+    def _call_fut(self, *args, **kw):
+        from occams.exports.profile import profile_data
+        return profile_data(*args, **kw)
+
+    @pytest.mark.parametrize('engine', ['orm', 'copy'])
+    def test_profile(self, dbsession, engine):
+        """
+        It should write the data file and report where the time went
+        """
+        from contextlib import closing
+        from sqlalchemy import func
+        import six
+        from occams import exports
+
+        query = dbsession.query(
+            func.generate_series(1, 100).label('id'))
+
+        with closing(six.BytesIO()) as fp:
+            profile = self._call_fut(fp, query, exports.engines[engine])
+            lines = fp.getvalue().splitlines()
+
+        assert lines[0] == b'id'
+        assert len(lines) == 101
+        assert profile['rows'] == 100
+        assert 'generate_series' in profile['sql']
+        assert profile['plan'][0]['Plan']['Actual Rows'] == 100
+        assert profile['db_time'] + profile['serialize_time'] == \
+            pytest.approx(profile['total_time'])
+
+        if engine == 'copy':
+            assert profile['serialize_time'] == 0
+
+
+class TestTimedQuery:
+
+    def test_fetch_time(self):
+        """
+        It should only count the time spent waiting for rows
+        """
+        from occams.exports.profile import TimedQuery
+
+        now = [0]
+
+        def rows():
+            for i in range(3):
+                now[0] += 1
+                yield i
+
+        timed = TimedQuery(rows(), clock=lambda: now[0])
+
+        for row in timed:
+            now[0] += 10
+
+        assert timed.iterated
+        assert timed.fetch_time == 3
@@ -0,0 +1,48 @@
+class TestProgressMeter:
+
+    def _create_one(self, *args, **kw):
+        from occams.exports.progress import ProgressMeter
+        return ProgressMeter(*args, **kw)
+
+    def test_throttle(self):
+        """
+        It should only report progress once the interval has elapsed
+        """
+        now = [0]
+        reports = []
+        meter = self._create_one(
+            lambda m: reports.append(m.pending), interval=5,
+            clock=lambda: now[0])
+
+        meter.update(rows=1, bytes=10)
+        meter.update(rows=1, bytes=10)
+        assert reports == []
+
+        now[0] = 5
+        meter.update(rows=1, bytes=10)
+        assert reports == [(3, 30)]
+
+        meter.update(rows=1, bytes=10)
+        meter.report()
+        assert reports == [(3, 30), (1, 10)]
+        assert meter.rows == 4
+        assert meter.bytes == 40
+        assert meter.rate == 4 / 5.0
+
+    def test_wrap_count_rows(self):
+        """
+        It should count raw CSV lines after the header as rows
+        """
+        from contextlib import closing
+        import six
+
+        meter = self._create_one(lambda m: None)
+
+        with closing(six.BytesIO()) as fp:
+            buffer = meter.wrap(fp, count_rows=True)
+            buffer.write(b'id,name\n1,foo\n')
+            buffer.write(b'2,bar\n')
+            assert fp.getvalue() == b'id,name\n1,foo\n2,bar\n'
+
+        assert meter.rows == 2
+        assert meter.bytes == 20
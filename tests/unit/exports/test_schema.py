@@ -79,6 +79,98 @@ class TestSchemaPlan:
         plans = SchemaPlan.list_all(dbsession, include_rand=False)
         assert len(plans) == 0
 
+    def test_list_refreshes_catalog(self, dbsession):
+        """
+        It should reflect published and retracted schemata in cached listings
+        """
+        from datetime import date
+        from occams import models as datastore
+        from occams.exports.schema import SchemaPlan
+
+        schema = datastore.Schema(
+            name=u'contact', title=u'Contact Details',
+            publish_date=date.today())
+        dbsession.add(schema)
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession)
+        assert [p.name for p in plans] == ['contact']
+
+        dbsession.add(datastore.Schema(
+            name=u'vitals', title=u'Vitals', publish_date=date.today()))
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession)
+        assert [p.name for p in plans] == ['contact', 'vitals']
+
+        schema.retract_date = date.today()
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession)
+        assert [p.name for p in plans] == ['vitals']
+
+    def test_list_refreshes_private_and_rand(self, dbsession):
+        """
+        It should reflect privacy and randomization changes in cached listings
+        """
+        from datetime import date, timedelta
+        from occams import models as datastore
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = datastore.Schema(
+            name=u'vitals',
+            title=u'Vitals',
+            publish_date=date.today(),
+            attributes={
+                'foo': datastore.Attribute(
+                    name='foo',
+                    title=u'',
+                    type='string',
+                    order=0,
+                )})
+        entity = datastore.Entity(
+            collect_date=date.today(),
+            schema=schema)
+        dbsession.add_all([schema, entity])
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession, include_private=False)
+        assert [p.name for p in plans] == ['vitals']
+
+        schema.attributes['foo'].is_private = True
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession, include_private=False)
+        assert plans == []
+
+        plans = SchemaPlan.list_all(dbsession, include_rand=False)
+        assert [p.name for p in plans] == ['vitals']
+
+        study = models.Study(
+            name=u'study1',
+            short_title=u'S1',
+            code=u'001',
+            consent_date=date.today() - timedelta(365),
+            title=u'Study 1')
+        armga = models.Arm(
+            name=u'groupa',
+            title=u'GROUP A',
+            study=study)
+        stratum = models.Stratum(
+            study=study,
+            arm=armga,
+            block_number=12384,
+            randid=u'8484')
+        dbsession.add(stratum)
+        dbsession.flush()
+
+        stratum.entities.add(entity)
+        dbsession.flush()
+
+        plans = SchemaPlan.list_all(dbsession, include_rand=False)
+        assert plans == []
+
     def test_patient(self, dbsession):
         """
         It should add patient-specific metadata to the report
@@ -319,3 +411,175 @@ class TestSchemaPlan:
         assert record.block_number == stratum.block_number
         assert record.arm_name == stratum.arm.title
         assert record.randid == stratum.randid
+
+    def test_id_ranges(self, dbsession):
+        """
+        It should split the data into shards that cover every record once
+        """
+        from datetime import date
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'vitals', title=u'Vitals', publish_date=date.today())
+        entities = [
+            models.Entity(schema=schema, collect_date=date.today())
+            for i in range(10)]
+        patient = models.Patient(
+            site=models.Site(name='ucsd', title=u'UCSD'),
+            pid=u'12345',
+            entities=entities)
+        dbsession.add_all([schema, patient] + entities)
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+
+        assert plan.id_ranges(4) == [None]
+
+        ranges = plan.id_ranges(4, min_size=2)
+        assert len(ranges) == 4
+        assert ranges[0][0] is None
+        assert ranges[-1][1] is None
+
+        ids = []
+        for id_range in ranges:
+            ids.extend(r.id for r in plan.data(id_range=id_range))
+        assert ids == sorted(e.id for e in entities)
+
+    def test_multiple_contexts(self, dbsession):
+        """
+        It should report an entity once even if it has duplicate contexts
+        """
+        from datetime import date, timedelta
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        schema = models.Schema(
+            name=u'vitals', title=u'Vitals', publish_date=date.today())
+        entity = models.Entity(schema=schema, collect_date=date.today())
+        site = models.Site(name='ucsd', title=u'UCSD')
+        patients = [
+            models.Patient(site=site, pid=pid, entities=[entity])
+            for pid in (u'12345', u'67890')]
+        visits = [
+            models.Visit(
+                visit_date=date.today() - timedelta(i), patient=patients[0],
+                entities=[entity])
+            for i in range(2)]
+        dbsession.add_all([schema, entity] + patients + visits)
+        dbsession.flush()
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        records = plan.data().all()
+
+        assert len(records) == 1
+        assert records[0].pid == u'12345'
+        assert records[0].visit_id == min(v.id for v in visits)
+
+    def test_legacy_equivalence(self, dbsession):
+        """
+        It should report the same context as per-row subqueries would
+        """
+        from datetime import date, timedelta
+        from sqlalchemy import cast, literal_column, String
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+        from occams.utils.sql import group_concat
+
+        schema = models.Schema(
+            name=u'vitals', title=u'Vitals', publish_date=date.today())
+        site = models.Site(name='ucsd', title=u'UCSD')
+        study = models.Study(
+            name=u'study1',
+            short_title=u'S1',
+            code=u'001',
+            consent_date=date.today() - timedelta(365),
+            title=u'Study 1')
+        cycle = models.Cycle(
+            name=u'study1-scr', title=u'Study 1 Screening', week=1,
+            study=study)
+        entities = [
+            models.Entity(schema=schema, collect_date=date.today())
+            for i in range(4)]
+        patient = models.Patient(
+            site=site, pid=u'12345', entities=entities[:3])
+        enrollment = models.Enrollment(
+            patient=patient,
+            study=study,
+            consent_date=date.today() - timedelta(5),
+            latest_consent_date=date.today() - timedelta(3),
+            entities=entities[1:3])
+        visit = models.Visit(
+            visit_date=date.today(), patient=patient, cycles=[cycle],
+            entities=entities[2:3])
+        dbsession.add_all(
+            [schema, site, study, patient, enrollment, visit] + entities)
+        dbsession.flush()
+
+        def keyed(external, model):
+            return ((models.Context.external == external)
+                    & (models.Context.key == model.id))
+
+        def scalar(query):
+            return (
+                query
+                .filter(models.Context.entity_id == models.Entity.id)
+                .correlate(models.Entity)
+                .as_scalar())
+
+        q = dbsession.query
+
+        legacy = (
+            dbsession.query(
+                models.Entity.id,
+                scalar(
+                    q(models.Patient.pid)
+                    .join(models.Context, keyed(u'patient', models.Patient))),
+                scalar(
+                    q(models.Site.name)
+                    .select_from(models.Patient)
+                    .join(models.Site)
+                    .join(models.Context, keyed(u'patient', models.Patient))),
+                scalar(
+                    q(group_concat(models.Study.name, ';'))
+                    .select_from(models.Enrollment)
+                    .join(models.Study)
+                    .join(models.Context,
+                          keyed(u'enrollment', models.Enrollment))
+                    .group_by(models.Context.entity_id)),
+                scalar(
+                    q(group_concat(models.Enrollment.id, ';'))
+                    .select_from(models.Enrollment)
+                    .join(models.Context,
+                          keyed(u'enrollment', models.Enrollment))
+                    .group_by(models.Context.entity_id)),
+                scalar(
+                    q(group_concat(
+                        models.Study.title
+                        + literal_column(u"'('")
+                        + cast(models.Cycle.week, String)
+                        + literal_column(u"')'"),
+                        literal_column(u"';'")))
+                    .select_from(models.Visit)
+                    .join(models.Visit.cycles)
+                    .join(models.Cycle.study)
+                    .join(models.Context, keyed(u'visit', models.Visit))
+                    .group_by(models.Context.entity_id)),
+                scalar(
+                    q(models.Visit.id)
+                    .select_from(models.Visit)
+                    .join(models.Context, keyed(u'visit', models.Visit))),
+                scalar(
+                    q(models.Visit.visit_date)
+                    .select_from(models.Visit)
+                    .join(models.Context, keyed(u'visit', models.Visit))))
+            .filter(models.Entity.schema_id == schema.id)
+            .order_by(models.Entity.id))
+
+        plan = SchemaPlan.from_schema(dbsession, schema.name)
+        records = [
+            (r.id, r.pid, r.site, r.enrollment, r.enrollment_ids,
+             r.visit_cycles, r.visit_id, r.visit_date)
+            for r in plan.data()]
+
+        assert records == [tuple(r) for r in legacy]
@@ -174,6 +174,61 @@ def test_schema_has_private(dbsession):
     assert schema.has_private
 
 
+def test_attribute_lineage(dbsession):
+    """
+    It should track the latest version of each attribute as forms are
+    published and retracted
+    """
+    from copy import deepcopy
+    from datetime import date, timedelta
+    from occams import models
+
+    today = date.today()
+
+    schema1 = models.Schema(
+        name=u'aform',
+        title=u'A Form',
+        publish_date=today,
+        attributes={
+            'foo': models.Attribute(
+                name=u'foo', title=u'Foo', type=u'string', order=0),
+            'bar': models.Attribute(
+                name=u'bar', title=u'Bar', type=u'string', order=1)})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    def lineage(name):
+        dbsession.expire_all()
+        return dbsession.query(models.AttributeLineage).get(
+            (u'aform', name))
+
+    assert lineage(u'foo').latest_order == 0
+    assert lineage(u'foo').versions == [today]
+
+    schema2 = deepcopy(schema1)
+    schema2.publish_date = None
+    schema2.attributes['foo'].order = 2
+    schema2.attributes['foo'].title = u'Foo Prime'
+    dbsession.add(schema2)
+    dbsession.flush()
+
+    # Drafts are not part of the lineage
+    assert lineage(u'foo').latest_title == u'Foo'
+
+    schema2.publish_date = today + timedelta(1)
+    dbsession.flush()
+
+    assert lineage(u'foo').latest_order == 2
+    assert lineage(u'foo').latest_title == u'Foo Prime'
+    assert lineage(u'foo').versions == [today, today + timedelta(1)]
+
+    schema2.retract_date = today + timedelta(2)
+    dbsession.flush()
+
+    assert lineage(u'foo').latest_order == 0
+    assert lineage(u'foo').versions == [today]
+
+
 def test_json(dbsession):
     """
     It should be able to load a schema from json data
@@ -562,3 +562,74 @@ def test_choice_constraint(dbsession):
 
     with pytest.raises(ConstraintError):
         entity['test'] = u'999'
+
+
+def test_entity_summary(dbsession):
+    """
+    It should keep entity summaries in sync with their contexts
+    """
+    from occams import models
+
+    schema = models.Schema(
+        name=u'Foo', title=u'Foo', publish_date=date(2000, 1, 1))
+    entity = models.Entity(schema=schema)
+    site1 = models.Site(name=u'ucsd', title=u'UCSD')
+    site2 = models.Site(name=u'ucla', title=u'UCLA')
+    patient = models.Patient(site=site1, pid=u'12345')
+    visit = models.Visit(
+        visit_date=date(2010, 1, 1), patient=patient, entities=[entity])
+    dbsession.add_all([schema, entity, patient, visit])
+    dbsession.flush()
+
+    def get_summary():
+        dbsession.expire_all()
+        return dbsession.query(models.EntitySummary).get(entity.id)
+
+    summary = get_summary()
+    assert summary.schema_name == u'Foo'
+    assert summary.visit_id == visit.id
+    assert summary.visit_date == date(2010, 1, 1)
+    assert summary.patient_id == patient.id
+    assert summary.site_id == site1.id
+
+    visit.visit_date = date(2011, 1, 1)
+    patient.site = site2
+    dbsession.flush()
+
+    summary = get_summary()
+    assert summary.visit_date == date(2011, 1, 1)
+    assert summary.site_id == site2.id
+
+    (dbsession.query(models.Context)
+        .filter_by(entity_id=entity.id, external=u'visit')
+        .delete())
+
+    summary = get_summary()
+    assert summary.visit_id is None
+
+
+def test_entity_summary_late_patient(dbsession):
+    """
+    It should resolve patient contexts recorded before their patient
+    """
+    from occams import models
+
+    schema = models.Schema(
+        name=u'Foo', title=u'Foo', publish_date=date(2000, 1, 1))
+    entity = models.Entity(schema=schema)
+    site = models.Site(name=u'ucsd', title=u'UCSD')
+    dbsession.add_all([schema, entity, site])
+    dbsession.flush()
+
+    patient_id, = dbsession.execute("SELECT nextval('patient_id_seq')").first()
+    dbsession.add(models.Context(
+        entity=entity, external=u'patient', key=patient_id))
+    dbsession.flush()
+
+    dbsession.add(models.Patient(id=patient_id, site=site, pid=u'12345'))
+    dbsession.flush()
+
+    dbsession.expire_all()
+    summary = dbsession.query(models.EntitySummary).get(entity.id)
+    assert summary.patient_id == patient_id
+    assert summary.site_id == site.id
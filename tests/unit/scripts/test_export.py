@@ -17,7 +17,7 @@ def plan(dbsession):
 
         def data(self, *args, **kw):
             return self.dbsession.query(
-                literal_column("'blah'").label('dummy')
+                literal_column('1').label('id')
             )
 
     return DummyPlan(dbsession)
@@ -116,6 +116,21 @@ class TestPrintList:
             assert plan.file_name in files
             assert FILE_NAME in files
 
+    def test_make_export_unmocked(self, dbsession):
+        """
+        It should export the data files listed for the database session
+        """
+        import os
+        from occams.exports.codebook import FILE_NAME
+        output = self._call_fut([None, '--config', 'fake.ini', '--list'])
+        assert 'pid' in output
+        self._call_fut(
+            [None, '--config', 'fake.ini', '--dir', self.dir, '--all',
+                '--batch-size', '10', '--engine', 'copy'])
+        files = os.listdir(self.dir)
+        assert 'pid.csv' in files
+        assert FILE_NAME in files
+
     def test_make_export_private(self, plan):
         """
         It should be able to export only private data
@@ -228,6 +243,74 @@ class TestPrintList:
                     '--atomic'])
         assert not os.path.exists(old_dir), 'Was not removed'
 
+    def test_make_export_incremental(self, plan):
+        """
+        It should write delta files next to existing full data files
+        """
+        import os
+        import mock
+        with mock.patch('occams.exports.list_all',
+                        return_value={plan.name: plan}):
+            self._call_fut(
+                [None, '--config', 'fake.ini', '--dir', self.dir, '--all'])
+            self._call_fut(
+                [None, '--config', 'fake.ini', '--dir', self.dir, '--all',
+                    '--incremental'])
+        files = os.listdir(self.dir)
+        assert plan.file_name in files
+        assert any(f.startswith('aform.delta-') for f in files)
+
+        with mock.patch('occams.exports.list_all',
+                        return_value={plan.name: plan}):
+            self._call_fut(
+                [None, '--config', 'fake.ini', '--dir', self.dir,
+                    '--compact'])
+        files = os.listdir(self.dir)
+        assert not any(f.startswith('aform.delta-') for f in files)
+
+    def test_make_export_incremental_per_plan(self, dbsession, plan):
+        """
+        It should keep a separate watermark for each data file
+        """
+        import json
+        import os
+        import mock
+        from occams.scripts.export import WATERMARK_FILE, read_watermarks
+
+        other = type(plan)(dbsession)
+        other.name = u'bform'
+        other.title = u'B Form'
+        exportables = {plan.name: plan, other.name: other}
+
+        for p in (plan, other):
+            with open(os.path.join(self.dir, p.file_name), 'w') as fp:
+                fp.write('dummy\n')
+        with open(os.path.join(self.dir, WATERMARK_FILE), 'w') as fp:
+            json.dump({
+                plan.name: '2000-01-01T00:00:00+00:00',
+                other.name: '2010-01-01T00:00:00+00:00'}, fp)
+        watermarks = read_watermarks(self.dir)
+
+        with mock.patch('occams.exports.list_all', return_value=exportables), \
+                mock.patch.object(plan, 'data', wraps=plan.data) as data:
+            self._call_fut(
+                [None, '--config', 'fake.ini', '--dir', self.dir,
+                    '--incremental', plan.name])
+
+        # Only the exported data file moves its watermark
+        assert data.call_args[1]['modified_since'] == watermarks[plan.name]
+        updated = read_watermarks(self.dir)
+        assert updated[plan.name] != watermarks[plan.name]
+        assert updated[other.name] == watermarks[other.name]
+
+        with mock.patch('occams.exports.list_all', return_value=exportables), \
+                mock.patch.object(other, 'data', wraps=other.data) as data:
+            self._call_fut(
+                [None, '--config', 'fake.ini', '--dir', self.dir,
+                    '--incremental', other.name])
+
+        assert data.call_args[1]['modified_since'] == watermarks[other.name]
+
     def test_make_export_create_directory(self):
         """
         It should auto create the destination directory if it doesn't exist.
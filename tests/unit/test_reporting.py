@@ -146,6 +146,62 @@ def test_datadict_multiple_choice(dbsession):
         sorted(iterkeys(columns['a'].choices))
 
 
+def test_datadict_cached(dbsession):
+    """
+    It should reuse column plans until the published versions change
+    """
+
+    from copy import deepcopy
+    from datetime import date, timedelta
+    from occams import models, reporting
+
+    today = date.today()
+
+    schema1 = models.Schema(
+        name=u'A',
+        title=u'A',
+        publish_date=today,
+        attributes={
+            's1': models.Attribute(
+                name=u's1',
+                title=u'S1',
+                type='section',
+                order=0,
+                attributes={
+                    'a': models.Attribute(
+                        name=u'a',
+                        title=u'',
+                        type='string',
+                        order=1)})})
+
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    columns = reporting.build_columns(dbsession, u'A')
+    assert columns['a'] is reporting.build_columns(dbsession, u'A')['a']
+
+    schema2 = deepcopy(schema1)
+    schema2.publish_date = today + timedelta(1)
+    dbsession.add(schema2)
+    dbsession.flush()
+
+    columns = reporting.build_columns(dbsession, u'A')
+    assert len(columns['a'].attributes) == 2
+
+    schema2.retract_date = today + timedelta(2)
+    dbsession.flush()
+
+    columns = reporting.build_columns(dbsession, u'A')
+    assert len(columns['a'].attributes) == 1
+
+    # edits of an already published version also generate a new plan
+    schema1.attributes['a'].type = 'text'
+    dbsession.flush()
+
+    columns = reporting.build_columns(dbsession, u'A')
+    assert columns['a'].type == 'text'
+
+
 def test_datadict_duplicate_vocabulary_term(dbsession):
     """
     It should use the most recent version of a choice label
@@ -301,13 +357,13 @@ def test_build_report_scalar_values(dbsession):
 
     # add some entries for the schema
     entity1 = models.Entity(schema=schema1)
-    entity1['a'] = u'foovalue'
+    entity1.data = {'a': u'foovalue'}
     dbsession.add(entity1)
     dbsession.flush()
 
     report = reporting.build_report(dbsession, u'A')
     result = dbsession.query(report).one()
-    assert entity1[u'a'] == result.a
+    assert entity1.data[u'a'] == result.a
 
 
 def test_build_report_datetime(dbsession):
@@ -340,7 +396,7 @@ def test_build_report_datetime(dbsession):
 
     # add some entries for the schema
     entity1 = models.Entity(schema=schema1)
-    entity1['a'] = date(1976, 7, 4)
+    entity1.data = {'a': str(date(1976, 7, 4))}
     dbsession.add(entity1)
     dbsession.flush()
 
@@ -401,7 +457,7 @@ def test_build_report_choice_types(dbsession):
     dbsession.flush()
 
     entity1 = models.Entity(schema=schema1)
-    entity1['a'] = u'002'
+    entity1.data = {'a': u'002'}
     dbsession.add(entity1)
     dbsession.flush()
 
@@ -417,7 +473,7 @@ def test_build_report_choice_types(dbsession):
 
     # switch to multiple-choice
     schema1.attributes['a'].is_collection = True
-    entity1['a'] = ['002', '003']
+    entity1.data = {'a': ['002', '003']}
     dbsession.flush()
 
     # delimited multiple-choice, labels off
@@ -533,6 +589,154 @@ def test_build_report_expand_none_selected(dbsession):
     assert result.a_003 is None
 
 
+def test_build_report_unanswered_collection(dbsession):
+    """
+    It should leave all choices blank if the collection was stored as null
+    """
+    from datetime import date
+    from occams import models, reporting
+
+    today = date.today()
+
+    schema1 = models.Schema(
+        name=u'A',
+        title=u'A',
+        publish_date=today,
+        attributes={
+            's1': models.Attribute(
+                name=u's1',
+                title=u'S1',
+                type='section',
+                order=0,
+                attributes={
+                    'a': models.Attribute(
+                        name=u'a',
+                        title=u'',
+                        type='choice',
+                        is_collection=True,
+                        order=1,
+                        choices={
+                            '001': models.Choice(
+                                name=u'001',
+                                title=u'Green',
+                                order=0),
+                            '002': models.Choice(
+                                name=u'002',
+                                title=u'Red',
+                                order=1),
+                            '003': models.Choice(
+                                name=u'003',
+                                title=u'Blue',
+                                order=2)
+                            })})})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    entity1 = models.Entity(schema=schema1)
+    entity1.data = {'a': None}
+    dbsession.add(entity1)
+    dbsession.flush()
+
+    # delimited multiple-choice, labels off
+    report = reporting.build_report(dbsession, u'A',
+                                    expand_collections=False,
+                                    use_choice_labels=False)
+    result = dbsession.query(report).one()
+    assert result.a is None
+
+    # delimited multiple-choice, labels on
+    report = reporting.build_report(dbsession, u'A',
+                                    expand_collections=False,
+                                    use_choice_labels=True)
+    result = dbsession.query(report).one()
+    assert result.a is None
+
+    # expanded multiple-choice, labels off
+    report = reporting.build_report(dbsession, u'A',
+                                    expand_collections=True,
+                                    use_choice_labels=False)
+    result = dbsession.query(report).one()
+    assert result.a_001 is None
+    assert result.a_002 is None
+    assert result.a_003 is None
+
+    # expanded multiple-choice, labels on
+    report = reporting.build_report(dbsession, u'A',
+                                    expand_collections=True,
+                                    use_choice_labels=True)
+    result = dbsession.query(report).one()
+    assert result.a_001 is None
+    assert result.a_002 is None
+    assert result.a_003 is None
+
+
+def test_build_report_expand_null_and_selected(dbsession):
+    """
+    It should expand selected choices next to collections stored as null
+    """
+    from datetime import date
+    from occams import models, reporting
+
+    today = date.today()
+
+    schema1 = models.Schema(
+        name=u'A',
+        title=u'A',
+        publish_date=today,
+        attributes={
+            's1': models.Attribute(
+                name=u's1',
+                title=u'S1',
+                type='section',
+                order=0,
+                attributes={
+                    'a': models.Attribute(
+                        name=u'a',
+                        title=u'',
+                        type='choice',
+                        is_collection=True,
+                        order=1,
+                        choices={
+                            '001': models.Choice(
+                                name=u'001',
+                                title=u'Green',
+                                order=0),
+                            '002': models.Choice(
+                                name=u'002',
+                                title=u'Red',
+                                order=1)
+                            })})})
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    entity1 = models.Entity(schema=schema1)
+    entity1.data = {'a': None}
+    entity2 = models.Entity(schema=schema1)
+    entity2.data = {'a': [u'002']}
+    dbsession.add_all([entity1, entity2])
+    dbsession.flush()
+
+    # expanded multiple-choice, labels off
+    report = reporting.build_report(dbsession, u'A',
+                                    expand_collections=True,
+                                    use_choice_labels=False)
+    results = dict((r.id, r) for r in dbsession.query(report))
+    assert results[entity1.id].a_001 is None
+    assert results[entity1.id].a_002 is None
+    assert results[entity2.id].a_001 == 0
+    assert results[entity2.id].a_002 == 1
+
+    # expanded multiple-choice, labels on
+    report = reporting.build_report(dbsession, u'A',
+                                    expand_collections=True,
+                                    use_choice_labels=True)
+    results = dict((r.id, r) for r in dbsession.query(report))
+    assert results[entity1.id].a_001 is None
+    assert results[entity1.id].a_002 is None
+    assert results[entity2.id].a_001 is None
+    assert results[entity2.id].a_002 == 'Red'
+
+
 def test_build_report_ids(dbsession):
     """
     It should be able to include only the schemata with the specified ids
@@ -617,7 +821,7 @@ def test_build_report_context(dbsession):
     dbsession.flush()
 
     entity1 = models.Entity(schema=schema1)
-    entity1['a'] = u'002'
+    entity1.data = {'a': u'002'}
     dbsession.add(entity1)
     dbsession.flush()
 
@@ -710,16 +914,66 @@ def test_build_report_ignore_private(dbsession):
 
     # add some entries for the schema
     entity1 = models.Entity(schema=schema1)
-    entity1['name'] = u'Jane Doe'
+    entity1.data = {'name': u'Jane Doe'}
     dbsession.add(entity1)
     dbsession.flush()
 
     # not de-identified
     report = reporting.build_report(dbsession, u'A', ignore_private=False)
     result = dbsession.query(report).one()
-    assert entity1[u'name'] == result.name
+    assert entity1.data[u'name'] == result.name
 
     # de-identified
     report = reporting.build_report(dbsession, u'A', ignore_private=True)
     result = dbsession.query(report).one()
     assert '[PRIVATE]' == result.name
+
+
+def test_build_report_column_order(dbsession):
+    """
+    It should report data columns in the same order as the column plan
+    """
+
+    from datetime import date
+    from occams import models, reporting
+
+    today = date.today()
+
+    schema1 = models.Schema(
+        name=u'A',
+        title=u'A',
+        publish_date=today,
+        attributes={
+            's1': models.Attribute(
+                name=u's1',
+                title=u'S1',
+                type='section',
+                order=0,
+                attributes={
+                    'b': models.Attribute(
+                        name=u'b',
+                        title=u'',
+                        type='number',
+                        order=1),
+                    'a': models.Attribute(
+                        name=u'a',
+                        title=u'',
+                        type='blob',
+                        order=2)})})
+
+    dbsession.add(schema1)
+    dbsession.flush()
+
+    entity1 = models.Entity(schema=schema1, data={'a': 123, 'b': '4.5'})
+    dbsession.add(entity1)
+    dbsession.flush()
+
+    columns = reporting.build_columns(dbsession, u'A')
+    report = reporting.build_report(dbsession, u'A')
+    names = [c.name for c in report.columns]
+    assert [names.index(n) for n in columns] == \
+        sorted(names.index(n) for n in columns)
+
+    result = dbsession.query(report).one()
+    assert result.a == u'[FILE]'
+    assert str(result.b) == '4.5'
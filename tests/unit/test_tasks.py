@@ -28,6 +28,141 @@ class TestIncludeme:
         for key in input.keys():
             assert config.registry.settings[key] == expected[key]
 
+    def test_worker_settings(self, config):
+        """
+        It should parse the settings workers read as they come from the .ini
+        """
+        from tests.conftest import REDIS_URL
+        config.registry.settings.update({
+            'celery.backend.url': REDIS_URL,
+            'celery.broker.url': REDIS_URL,
+            'studies.export.dir': '/tmp',
+            'studies.export.batch_size': '1000',
+            'studies.export.workers': '2',
+            'studies.export.progress_interval': '2.5',
+            'studies.export.profile': 'false',
+            'studies.export.checkpoint': 'false',
+        })
+        config.include('occams.tasks')
+        settings = config.registry.settings
+        assert settings['studies.export.batch_size'] == 1000
+        assert settings['studies.export.workers'] == 2
+        assert settings['studies.export.progress_interval'] == 2.5
+        assert settings['studies.export.profile'] is False
+        assert settings['studies.export.checkpoint'] is False
+
+    def test_view_settings(self, config):
+        """
+        It should parse the settings views read, with their defaults
+        """
+        from tests.conftest import REDIS_URL
+        config.registry.settings.update({
+            'celery.backend.url': REDIS_URL,
+            'celery.broker.url': REDIS_URL,
+            'studies.export.dir': '/tmp',
+            'studies.export.byte_budget': '1000',
+            'studies.export.off_hours': '22',
+            'studies.export.user_concurrency': '2',
+            'studies.export.sse_heartbeat': '0.5',
+        })
+        config.include('occams.tasks')
+        settings = config.registry.settings
+        assert settings['studies.export.byte_budget'] == 1000
+        assert settings['studies.export.off_hours'] == 22
+        assert settings['studies.export.user_concurrency'] == 2
+        assert settings['studies.export.sse_heartbeat'] == 0.5
+        assert settings['studies.export.sse_timeout'] == 300
+        assert settings['studies.export.stream_limit'] == 100000
+
+    def test_invalid_compression(self, config):
+        """
+        It should reject unsupported archive compression codecs
+        """
+        from tests.conftest import REDIS_URL
+        config.registry.settings.update({
+            'celery.backend.url': REDIS_URL,
+            'celery.broker.url': REDIS_URL,
+            'studies.export.dir': '/tmp',
+            'studies.export.compression': 'rar',
+        })
+        with pytest.raises(AssertionError):
+            config.include('occams.tasks')
+
+
+class TestExportQueue:
+
+    def _call_fut(self, *args, **kw):
+        from occams.tasks import export_queue
+        return export_queue(*args, **kw)
+
+    def test_queue(self, dbsession):
+        """
+        It should send exports estimated to be large to their own queue
+        """
+        from occams.celery import EXPORT_QUEUE, LARGE_EXPORT_QUEUE
+        from occams.exports.pid import PidPlan
+
+        plans = [PidPlan(dbsession)]
+
+        assert self._call_fut(plans) == EXPORT_QUEUE
+        assert self._call_fut(plans, large_rows=-1) == LARGE_EXPORT_QUEUE
+        assert self._call_fut(plans, large_rows='-1') == LARGE_EXPORT_QUEUE
+
+
+class TestArchiveEntry:
+
+    def _make_one(self, *args, **kw):
+        from occams.tasks import ArchiveEntry
+        return ArchiveEntry(*args, **kw)
+
+    @pytest.mark.parametrize('codec', ['deflated', 'stored'])
+    def test_stream(self, tmpdir, codec):
+        """
+        It should write entries of unknown length that can be read back
+        """
+        import os
+        from zipfile import ZipFile
+        from occams.tasks import ZIP_CODECS
+
+        data = os.urandom(100000) + b'abc' * 100000
+        path = str(tmpdir.join('test.zip'))
+
+        with ZipFile(path, 'w', ZIP_CODECS[codec], allowZip64=True) as zfp:
+            with self._make_one(zfp, 'a.csv') as entry:
+                for i in range(0, len(data), 7000):
+                    entry.write(data[i:i + 7000])
+            zfp.writestr('b.csv', b'written after')
+            with self._make_one(zfp, 'c.csv') as entry:
+                pass
+
+        with ZipFile(path, 'r') as zfp:
+            assert zfp.testzip() is None
+            assert zfp.getinfo('a.csv').compress_type == ZIP_CODECS[codec]
+            assert zfp.read('a.csv') == data
+            assert zfp.read('b.csv') == b'written after'
+            assert zfp.read('c.csv') == b''
+
+    def test_level(self, tmpdir):
+        """
+        It should deflate entries with the requested compression level
+        """
+        from zipfile import ZipFile, ZIP_DEFLATED
+
+        data = b'abcdefghij' * 100000
+        path = str(tmpdir.join('test.zip'))
+
+        with ZipFile(path, 'w', ZIP_DEFLATED, allowZip64=True) as zfp:
+            with self._make_one(zfp, 'fast.csv', level=0) as entry:
+                entry.write(data)
+            with self._make_one(zfp, 'best.csv', level=9) as entry:
+                entry.write(data)
+
+        with ZipFile(path, 'r') as zfp:
+            assert zfp.read('fast.csv') == data
+            assert zfp.read('best.csv') == data
+            assert zfp.getinfo('fast.csv').compress_size > \
+                zfp.getinfo('best.csv').compress_size
+
 
 @pytest.mark.usefixtures('celery')
 class TestMakeExport:
@@ -36,6 +171,7 @@ class TestMakeExport:
         """
         It should generate a zip file containing the specified contents
         """
+        import os
         from zipfile import ZipFile
         from occams.celery import Session
         from occams import models as datastore
@@ -50,7 +186,7 @@ class TestMakeExport:
         export = models.Export(
             owner_user=owner,
             contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
-            status='complete')
+            status='pending')
         Session.add(export)
         Session.flush()
 
@@ -63,3 +199,528 @@ class TestMakeExport:
             file_names = zfp.namelist()
 
         assert sorted(['pid.csv', 'codebook.csv']) == sorted(file_names)
+        assert export.file_size == os.path.getsize(export.path)
+
+    @pytest.mark.parametrize('engine', ['orm', 'copy'])
+    def test_zip_streaming(self, engine):
+        """
+        It should write data files straight into their archive entries
+        """
+        from zipfile import ZipFile
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        tasks.app.settings['studies.export.engine'] = engine
+        with mock.patch('occams.tasks._write_data_files') as write_files:
+            tasks.make_export(export.name)
+
+        assert not write_files.called
+        export = Session.merge(export)
+        with ZipFile(export.path, 'r') as zfp:
+            assert zfp.read('pid.csv').startswith(b'id,site,pid,')
+            assert zfp.read('codebook.csv').startswith(b'table,')
+
+    def test_zip_workers(self, committed_visits):
+        """
+        It should generate all contents when plans are run concurrently
+        """
+        from zipfile import ZipFile
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[
+                {'name': 'pid', 'title': 'PID', 'versions': []},
+                {'name': 'visit', 'title': 'Visits', 'versions': []}],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        tasks.app.settings['studies.export.workers'] = 2
+        tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        with ZipFile(export.path, 'r') as zfp:
+            file_names = zfp.namelist()
+            # The header and every committed record
+            for file_name in ('pid.csv', 'visit.csv'):
+                assert len(zfp.read(file_name).splitlines()) == \
+                    committed_visits + 1
+
+        assert sorted(['pid.csv', 'visit.csv', 'codebook.csv']) == \
+            sorted(file_names)
+
+    def test_zip_workers_contents(self, committed_visits):
+        """
+        It should write the same data files concurrently as serially
+        """
+        from zipfile import ZipFile
+        import six
+        from occams.celery import Session
+        from occams import exports, models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[
+                {'name': 'pid', 'title': 'PID', 'versions': []},
+                {'name': 'visit', 'title': 'Visits', 'versions': []}],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        exportables = exports.list_all(Session)
+        expected = {}
+        for name in ('pid', 'visit'):
+            buffer = six.BytesIO()
+            exports.write_data(buffer, exportables[name].data())
+            expected[name + '.csv'] = buffer.getvalue()
+            assert len(expected[name + '.csv'].splitlines()) == \
+                committed_visits + 1
+
+        tasks.app.settings['studies.export.workers'] = 2
+        tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        with ZipFile(export.path, 'r') as zfp:
+            for file_name, data in expected.items():
+                assert zfp.read(file_name) == data
+
+    def test_zip_compression(self):
+        """
+        It should compress archive entries with the configured codec
+        """
+        from zipfile import ZipFile, ZIP_STORED
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        tasks.app.settings['studies.export.compression'] = 'stored'
+        tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        with ZipFile(export.path, 'r') as zfp:
+            infos = zfp.infolist()
+            assert zfp.testzip() is None
+
+        assert sorted(['pid.csv', 'codebook.csv']) == \
+            sorted(i.filename for i in infos)
+        assert all(i.compress_type == ZIP_STORED for i in infos)
+
+    def test_resume_checkpoint(self):
+        """
+        It should reuse data files completed by a previous attempt
+        """
+        import os
+        from zipfile import ZipFile
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[
+                {'name': 'pid', 'title': 'PID', 'versions': []},
+                {'name': 'visit', 'title': 'Visits', 'versions': []}],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        parts_dir = export.path + '.parts'
+        os.makedirs(parts_dir)
+        with open(os.path.join(parts_dir, 'pid.csv'), 'wb') as fp:
+            fp.write(b'checkpointed')
+
+        tasks.app.settings['studies.export.checkpoint'] = True
+        tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        with ZipFile(export.path, 'r') as zfp:
+            file_names = zfp.namelist()
+            assert zfp.read('pid.csv') == b'checkpointed'
+
+        assert sorted(['pid.csv', 'visit.csv', 'codebook.csv']) == \
+            sorted(file_names)
+        assert not os.path.exists(parts_dir)
+
+    def test_skip_not_pending(self):
+        """
+        It should skip exports that are no longer pending
+        """
+        import os
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            status='complete')
+        Session.add(export)
+        Session.flush()
+
+        tasks.make_export(export.name)
+
+        export = Session.merge(export)
+        assert not os.path.exists(export.path)
+
+    def test_locked(self):
+        """
+        It should wait while another worker is generating the export
+        """
+        import os
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'pid', 'title': 'PID', 'versions': []}],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        lock = tasks.app.redis.lock(export.redis_key + ':lock', timeout=10)
+        assert lock.acquire(blocking=False)
+
+        try:
+            with mock.patch.object(tasks.make_export, 'retry',
+                                   return_value=RuntimeError()) as retry:
+                with pytest.raises(RuntimeError):
+                    tasks.make_export(export.name)
+        finally:
+            lock.release()
+
+        retry.assert_called_with(countdown=tasks.LOCK_TIMEOUT)
+        export = Session.merge(export)
+        assert not os.path.exists(export.path)
+
+    def test_failed_plan_lookup(self):
+        """
+        It should mark exports failed and notify the owner even if the task
+        fails before it starts generating
+        """
+        import json
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        # i.e. the form was retracted after the export was requested
+        export = models.Export(
+            owner_user=owner,
+            contents=[{'name': 'retracted', 'title': 'Gone', 'versions': []}],
+            status='pending')
+        Session.add(export)
+        Session.flush()
+
+        redis = tasks.app.redis
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(tasks.PROGRESS_CHANNEL + 'joe')
+
+        # Keep the test data between the task and its failure handler
+        with mock.patch('occams.tasks.Session.rollback'), \
+                mock.patch('occams.tasks.Session.remove'):
+            with pytest.raises(KeyError) as excinfo:
+                tasks.make_export(export.name)
+
+            assert redis.hget(export.redis_key, 'owner_user') == b'joe'
+
+            # Even if the progress hash is lost
+            redis.delete(export.redis_key)
+            tasks.make_export.on_failure(
+                excinfo.value, export.name, [export.name], {}, None)
+
+        assert export.status == u'failed'
+
+        # The subscription confirmation is read (and ignored) first
+        message = pubsub.get_message(timeout=1) \
+            or pubsub.get_message(timeout=1)
+        pubsub.close()
+        data = json.loads(message['data'].decode('utf-8'))
+        assert data['status'] == 'failed'
+        assert int(data['export_id']) == export.id
+
+    def test_follow_identical(self):
+        """
+        It should wait on an identical export without recomputing its
+        fingerprint
+        """
+        import mock
+        from occams.celery import Session
+        from occams import exports, models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        contents = [{'name': 'pid', 'title': 'PID', 'versions': []}]
+        options = {
+            'use_choice_labels': False,
+            'expand_collections': False,
+            'modified_since': None}
+        leader = models.Export(
+            owner_user=owner,
+            contents=contents,
+            status='pending',
+            fingerprint=exports.fingerprint(
+                [exports.list_all(Session)['pid']], **options),
+            **options)
+        follower = models.Export(
+            owner_user=owner, contents=contents, status='pending', **options)
+        Session.add_all([leader, follower])
+        Session.flush()
+
+        # Keep the session between attempts
+        with mock.patch('occams.tasks.Session.remove'):
+            with mock.patch.object(tasks.make_export, 'retry') as retry:
+                tasks.make_export(follower.name)
+            retry.assert_called_with(
+                countdown=tasks.FOLLOW_INTERVAL, throw=False)
+
+            redis = tasks.app.redis
+            assert redis.sismember(
+                leader.redis_key + ':followers', follower.redis_key)
+            assert redis.hexists(follower.redis_key, 'followed_at')
+            assert follower.fingerprint == leader.fingerprint
+
+            with mock.patch.object(tasks.make_export, 'retry') as retry, \
+                    mock.patch('occams.exports.list_all') as list_all:
+                tasks.make_export(follower.name)
+            assert retry.called
+            assert not list_all.called
+
+    def test_wake_followers(self):
+        """
+        It should queue the exports waiting on an export once it completes
+        """
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        contents = [{'name': 'pid', 'title': 'PID', 'versions': []}]
+        leader = models.Export(
+            owner_user=owner, contents=contents, status='pending')
+        follower = models.Export(
+            owner_user=owner, contents=contents, status='pending')
+        Session.add_all([leader, follower])
+        Session.flush()
+
+        redis = tasks.app.redis
+        followers_key = leader.redis_key + ':followers'
+        redis.sadd(followers_key, follower.redis_key)
+
+        with mock.patch.object(tasks.make_export, 'apply_async') as apply:
+            tasks.make_export(leader.name)
+
+        apply.assert_called_once_with(
+            args=[follower.name], task_id=follower.name,
+            queue=tasks.EXPORT_QUEUE)
+        assert not redis.exists(followers_key)
+
+    def test_wake_followers_failed(self):
+        """
+        It should not queue the exports waiting on a failed export, nor
+        leave them to be queued by the next commit of the session
+        """
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        contents = [{'name': 'pid', 'title': 'PID', 'versions': []}]
+        leader = models.Export(
+            owner_user=owner, contents=contents, status='pending')
+        follower = models.Export(
+            owner_user=owner, contents=contents, status='pending')
+        Session.add_all([leader, follower])
+        Session.flush()
+
+        redis = tasks.app.redis
+        followers_key = leader.redis_key + ':followers'
+        redis.sadd(followers_key, follower.redis_key)
+
+        with mock.patch('occams.tasks.Session.rollback'), \
+                mock.patch('occams.tasks.Session.remove'), \
+                mock.patch.object(tasks.make_export, 'apply_async') as apply:
+            with mock.patch('occams.tasks._open_archive',
+                            side_effect=IOError):
+                with pytest.raises(IOError):
+                    tasks.make_export(leader.name)
+
+        assert not apply.called
+        assert not list(Session().dispatch.after_commit)
+        assert redis.sismember(followers_key, follower.redis_key)
+        redis.delete(followers_key)
+
+
+@pytest.mark.usefixtures('celery')
+class TestStartScheduledExports:
+
+    def test_due(self):
+        """
+        It should queue pending exports whose scheduled time has passed
+        """
+        from datetime import datetime, timedelta
+        import mock
+        from occams.celery import Session, LARGE_EXPORT_QUEUE
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        now = datetime.now()
+        due = models.Export(
+            owner_user=owner, contents=[], status=u'pending',
+            scheduled_at=now - timedelta(minutes=1))
+        later = models.Export(
+            owner_user=owner, contents=[], status=u'pending',
+            scheduled_at=now + timedelta(hours=1))
+        failed = models.Export(
+            owner_user=owner, contents=[], status=u'failed',
+            scheduled_at=now - timedelta(minutes=1))
+        Session.add_all([due, later, failed])
+        Session.flush()
+
+        with mock.patch.object(tasks.make_export, 'apply_async') as apply:
+            assert tasks.start_scheduled_exports() == 1
+
+        apply.assert_called_once_with(
+            args=[due.name], task_id=due.name, queue=LARGE_EXPORT_QUEUE)
+        assert due.scheduled_at is None
+
+
+@pytest.mark.usefixtures('celery')
+class TestGcExports:
+
+    def test_gc(self):
+        """
+        It should remove expired exports, orphaned files and stale hashes
+        """
+        import os
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        export = models.Export(
+            owner_user=owner, contents=[], status='complete')
+        Session.add(export)
+        Session.flush()
+
+        export_dir = tasks.app.settings['studies.export.dir']
+        with open(export.path, 'wb') as fp:
+            fp.write(b'x' * 10)
+        orphan_path = os.path.join(export_dir, 'orphan')
+        with open(orphan_path, 'wb') as fp:
+            fp.write(b'x' * 5)
+        os.utime(orphan_path, (0, 0))
+        os.makedirs(os.path.join(export_dir, 'cache'))
+        os.utime(os.path.join(export_dir, 'cache'), (0, 0))
+        tasks.app.redis.hset('export:orphan', 'status', 'pending')
+
+        tasks.app.settings['studies.export.expire'] = 0
+        assert tasks.gc_exports() == 15
+
+        assert os.listdir(export_dir) == ['cache']
+        assert not tasks.app.redis.exists('export:orphan')
+
+    def test_gc_pending(self):
+        """
+        It should keep expired exports that are still to be made
+        """
+        import os
+        from datetime import datetime, timedelta
+        import mock
+        from occams.celery import Session
+        from occams import models, tasks
+
+        owner = models.User(key=u'joe')
+        Session.info['blame'] = owner
+        Session.add(owner)
+        Session.flush()
+
+        pending = models.Export(
+            owner_user=owner, contents=[], status='pending')
+        scheduled = models.Export(
+            owner_user=owner, contents=[], status='complete',
+            scheduled_at=datetime.now() + timedelta(1))
+        Session.add_all([pending, scheduled])
+        Session.flush()
+
+        pending_path = pending.path
+        with open(pending_path, 'wb') as fp:
+            fp.write(b'x' * 10)
+
+        tasks.app.settings['studies.export.expire'] = 0
+        with mock.patch('occams.tasks.Session.remove'):
+            assert tasks.gc_exports() == 0
+
+        assert os.path.exists(pending_path)
+        assert Session.query(models.Export).count() == 2
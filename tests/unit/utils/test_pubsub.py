@@ -0,0 +1,72 @@
+class TestFanOut:
+
+    def _create_one(self, *args, **kw):
+        from occams.utils.pubsub import FanOut
+        return FanOut(*args, **kw)
+
+    def test_ignore_nonmessages(self):
+        """
+        It should not hand out other types of pubsub broadcasts
+        """
+        import mock
+
+        hub = self._create_one(mock.Mock(), 'export.')
+        hub._thread = mock.Mock()  # Don't subscribe
+        listener = hub.listen('jane')
+
+        hub.dispatch({
+            'type': 'psubscribe',
+            'pattern': None,
+            'channel': 'export.*',
+            'data': 1})
+
+        assert listener.empty()
+
+    def test_ignore_nonowner(self):
+        """
+        It should only hand out messages to listeners of the channel's key
+        """
+        import mock
+
+        hub = self._create_one(mock.Mock(), 'export.')
+        hub._thread = mock.Mock()  # Don't subscribe
+        jane = hub.listen('jane')
+        joe = hub.listen('joe')
+
+        hub.dispatch({
+            'type': 'pmessage',
+            'pattern': 'export.*',
+            'channel': b'export.jane',
+            'data': 'progress'})
+
+        assert jane.get_nowait() == 'progress'
+        assert joe.empty()
+
+        hub.unlisten('jane', jane)
+        hub.dispatch({
+            'type': 'pmessage',
+            'pattern': 'export.*',
+            'channel': 'export.jane',
+            'data': 'progress'})
+
+        assert jane.empty()
+
+    def test_slow_listener(self):
+        """
+        It should drop messages for listeners that fall too far behind
+        """
+        import mock
+
+        hub = self._create_one(mock.Mock(), 'export.', maxsize=1)
+        hub._thread = mock.Mock()  # Don't subscribe
+        listener = hub.listen('jane')
+
+        for data in ('first', 'second'):
+            hub.dispatch({
+                'type': 'pmessage',
+                'pattern': 'export.*',
+                'channel': 'export.jane',
+                'data': data})
+
+        assert listener.get_nowait() == 'first'
+        assert listener.empty()
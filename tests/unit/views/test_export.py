@@ -104,6 +104,143 @@ class TestAdd:
         export = dbsession.query(models.Export).one()
         assert export.owner_user.key == 'joe'
 
+    def test_reuse_identical(
+            self, req, dbsession, config, check_csrf_token, tmpdir):
+        """
+        It should share the archive of an identical complete export
+        """
+        from datetime import date
+        import os
+        import mock
+        from webob.multidict import MultiDict
+        from occams import models, exports
+        from occams.exports.schema import SchemaPlan
+
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
+        req.registry.settings['studies.export.plans'] = [SchemaPlan.list_all]
+
+        blame = models.User(key=u'joe')
+        dbsession.add(blame)
+        dbsession.flush()
+        dbsession.info['blame'] = blame
+
+        schema = models.Schema(
+            name=u'vitals', title=u'Vitals', publish_date=date.today())
+        dbsession.add(schema)
+        dbsession.flush()
+
+        plans = [exports.list_all(dbsession)['vitals']]
+        previous_export = models.Export(
+            owner_user=blame,
+            contents=[p.to_json() for p in plans],
+            status=u'complete',
+            fingerprint=exports.fingerprint(
+                plans,
+                use_choice_labels=False,
+                expand_collections=False,
+                modified_since=None))
+        dbsession.add(previous_export)
+        dbsession.flush()
+        tmpdir.join(previous_export.name).write('data')
+
+        config.testing_securitypolicy(userid='joe')
+        req.method = 'POST'
+        req.POST = MultiDict([('contents', str('vitals'))])
+
+        with mock.patch('occams.tasks.make_export') as make_export:
+            self._call_fut(models.ExportFactory(req), req)
+
+        assert not make_export.apply_async.called
+        export = (
+            dbsession.query(models.Export)
+            .filter(models.Export.id != previous_export.id)
+            .one())
+        assert export.status == u'complete'
+        assert os.path.samefile(export.path, previous_export.path)
+
+    @pytest.mark.parametrize('off_hours', [None, 22])
+    def test_over_budget(
+            self, req, dbsession, config, check_csrf_token, off_hours):
+        """
+        It should refuse exports over budget, or defer them to off hours
+        """
+        from datetime import date
+        import mock
+        from pyramid.httpexceptions import HTTPFound
+        from webob.multidict import MultiDict
+        from occams import models
+        from occams.exports.schema import SchemaPlan
+
+        req.registry.settings['studies.export.plans'] = [SchemaPlan.list_all]
+        # As parsed by occams.tasks.includeme
+        req.registry.settings['studies.export.byte_budget'] = -1
+        if off_hours is not None:
+            req.registry.settings['studies.export.off_hours'] = off_hours
+
+        blame = models.User(key=u'joe')
+        dbsession.add(blame)
+        dbsession.flush()
+        dbsession.info['blame'] = blame
+
+        schema = models.Schema(
+            name=u'vitals', title=u'Vitals', publish_date=date.today())
+        dbsession.add(schema)
+        dbsession.flush()
+
+        config.testing_securitypolicy(userid='joe')
+        req.method = 'POST'
+        req.POST = MultiDict([('contents', str('vitals'))])
+
+        with mock.patch('occams.tasks.make_export') as make_export:
+            res = self._call_fut(models.ExportFactory(req), req)
+
+        if off_hours is None:
+            assert 'contents' in res['errors']
+            assert dbsession.query(models.Export).count() == 0
+        else:
+            assert isinstance(res, HTTPFound)
+            export = dbsession.query(models.Export).one()
+            assert export.scheduled_at.hour == 22
+            # Queued by the scheduler
+            assert not make_export.apply_async.called
+
+    def test_busy(self, req, dbsession, config):
+        """
+        It should not let the user exceed their concurrent export limit
+        """
+        from datetime import datetime, timedelta
+        from occams import models
+
+        # As parsed by occams.tasks.includeme
+        config.registry.settings['studies.export.user_concurrency'] = 1
+
+        blame = models.User(key=u'joe')
+        dbsession.add(blame)
+        dbsession.flush()
+        dbsession.info['blame'] = blame
+
+        running_export = models.Export(
+            owner_user=blame, contents=[], status=u'pending')
+        dbsession.add(running_export)
+        dbsession.flush()
+
+        config.testing_securitypolicy(userid='joe')
+        res = self._call_fut(models.ExportFactory(req), req)
+        assert res['busy']
+
+        # Exports scheduled for off hours are not running yet
+        running_export.scheduled_at = datetime.now() + timedelta(hours=1)
+        dbsession.flush()
+        res = self._call_fut(models.ExportFactory(req), req)
+        assert not res['busy']
+
+        # Finished exports no longer count
+        running_export.scheduled_at = None
+        running_export.status = u'complete'
+        dbsession.flush()
+        res = self._call_fut(models.ExportFactory(req), req)
+        assert not res['busy']
+
     def test_exceed_limit(self, req, dbsession, config):
         """
         It should not let the user exceed their allocated export limit
@@ -145,6 +282,57 @@ class TestAdd:
         assert res['exceeded']
 
 
+class TestWatermark:
+
+    def _call_fut(self, *args, **kw):
+        from occams.views.export import watermark
+        return watermark(*args, **kw)
+
+    def test_per_plan(self, dbsession):
+        """
+        It should only use exports that contained each plan with the same
+        options
+        """
+        from occams import models, exports
+
+        owner = models.User(key=u'joe')
+        dbsession.add(owner)
+        dbsession.flush()
+
+        exportables = exports.list_all(dbsession)
+        pid, visit = exportables['pid'], exportables['visit']
+        options = {'use_choice_labels': False, 'expand_collections': False}
+
+        # An export of other contents does not count
+        dbsession.add(models.Export(
+            owner_user=owner, contents=[visit.to_json()], status=u'complete',
+            **options))
+        # Nor does one with different options
+        dbsession.add(models.Export(
+            owner_user=owner, contents=[pid.to_json()], status=u'complete',
+            use_choice_labels=True, expand_collections=False))
+        # Nor one that did not complete
+        dbsession.add(models.Export(
+            owner_user=owner, contents=[pid.to_json()], status=u'failed',
+            **options))
+        dbsession.flush()
+
+        assert self._call_fut(dbsession, owner, [pid], **options) is None
+        assert self._call_fut(
+            dbsession, owner, [pid, visit], **options) is None
+
+        export = models.Export(
+            owner_user=owner, contents=[pid.to_json()], status=u'complete',
+            **options)
+        dbsession.add(export)
+        dbsession.flush()
+        # Creation times may be set by the database
+        dbsession.refresh(export)
+
+        assert self._call_fut(dbsession, owner, [pid], **options) == \
+            export.created_at
+
+
 class TestStatusJSON:
 
     def _call_fut(self, *args, **kw):
@@ -185,12 +373,18 @@ class TestStatusJSON:
 
         config.testing_securitypolicy(userid='joe')
         req.redis = mock.Mock()
+        req.redis.pipeline.return_value.execute.return_value = [
+            {'count': '1', 'total': '2'}]
         context = models.ExportFactory(req)
         export1.__parent__ = context
         export2.__parent__ = context
         res = self._call_fut(models.ExportFactory(req), req)
         exports = res['exports']
         assert len(exports) == 1
+        assert exports[0]['count'] == '1'
+        assert res['pager']['total_count'] == 1
+        # Progress is read in a single round trip
+        assert not req.redis.hgetall.called
 
     def test_ignore_expired(self, req, dbsession, config):
         """
@@ -241,6 +435,42 @@ class TestStatusJSON:
         exports = res['exports']
         assert len(exports) == 0
 
+    def test_file_size_unrecorded(self, req, dbsession, config, tmpdir):
+        """
+        It should read the size of archives completed before it was recorded
+        """
+        import mock
+        from occams import models
+
+        req.registry.settings['studies.export.dir'] = str(tmpdir)
+
+        blame = models.User(key=u'joe')
+        dbsession.add(blame)
+        dbsession.flush()
+        dbsession.info['blame'] = blame
+
+        export = models.Export(
+            owner_user=blame,
+            contents=[],
+            status='complete')
+        dbsession.add(export)
+        dbsession.flush()
+
+        config.testing_securitypolicy(userid='joe')
+        req.redis = mock.Mock()
+        context = models.ExportFactory(req)
+        export.__parent__ = context
+
+        res = self._call_fut(context, req)
+        assert res['exports'][0]['file_size'] is None
+
+        with open(export.path, 'wb') as fp:
+            fp.write(b'x' * 2048)
+
+        res = self._call_fut(context, req)
+        assert res['exports'][0]['file_size'] == '2.0 kB'
+        assert export.file_size is None
+
 
 class TestNotifications:
 
@@ -248,76 +478,86 @@ class TestNotifications:
         from occams.views.export import notifications
         return notifications(*args, **kw)
 
-    def test_ignore_nonmessages(self, req, dbsession, config):
+    def _listen(self, *messages):
+        import threading
+
+        def listen():
+            for message in messages:
+                yield message
+            threading.Event().wait()
+
+        return listen
+
+    def test_heartbeat(self, req, dbsession, config):
         """
-        It should not yield other types of pubsub broadcasts
+        It should send heartbeats while idle and end after the timeout
         """
         import mock
         from occams import models
 
-        def listen():
-            return [{
-                'type': 'misc',
-                'data': 'random data'
-            }]
-
-        req.redis = mock.Mock(pubsub=lambda: mock.Mock(listen=listen))
+        config.testing_securitypolicy(userid='jane')
+        req.registry.settings['studies.export.sse_heartbeat'] = 0.01
+        req.registry.settings['studies.export.sse_timeout'] = 0.025
+        req.redis = mock.Mock(
+            pubsub=lambda: mock.Mock(listen=self._listen()))
 
         res = self._call_fut(models.ExportFactory(req), req)
 
         notifications = list(res.app_iter)
 
-        assert not notifications
+        assert notifications == [':\n\n'] * 3
 
-    def test_ignore_nonowner(self, req, dbsession, config):
+    def test_yield_pubsub_owner_messages(self, req, dbsession, config):
         """
-        It should not yield pubsub "message" broadcasts if they
-        don't belong to the autheticated user.
+        It should yield messages published on the owner's channel
         """
         import json
         import mock
         from occams import models
 
-        config.testing_securitypolicy(userid='somoneelse')
-
-        def listen():
-            return [{
-                'type': 'message',
-                'data': json.dumps({'owner_user': 'jane', 'export_id': 123})
-            }]
+        config.testing_securitypolicy(userid='jane')
+        req.registry.settings['studies.export.sse_heartbeat'] = 15.0
+        req.registry.settings['studies.export.sse_timeout'] = 300.0
 
-        req.redis = mock.Mock(pubsub=lambda: mock.Mock(listen=listen))
+        req.redis = mock.Mock(pubsub=lambda: mock.Mock(listen=self._listen({
+            'type': 'pmessage',
+            'pattern': 'export.*',
+            'channel': 'export.jane',
+            'data': json.dumps({'owner_user': 'jane', 'export_id': 123})
+        })))
 
         res = self._call_fut(models.ExportFactory(req), req)
 
-        notifications = list(res.app_iter)
+        notification = next(res.app_iter)
+        res.app_iter.close()
 
-        assert not notifications
+        assert '"export_id": 123' in notification
 
-    def test_yield_pubsub_owner_messages(self, req, dbsession, config):
+    def test_ignore_nonowner(self, req, dbsession, config):
         """
-        It should only yield pubsub "message" broadcasts to the owner
+        It should not yield messages published on another user's channel
         """
         import json
         import mock
         from occams import models
 
-        config.testing_securitypolicy(userid='jane')
-
-        def listen():
-            return [{
-                'type': 'message',
-                'data': json.dumps({'owner_user': 'jane', 'export_id': 123})
-            }]
+        config.testing_securitypolicy(userid='somoneelse')
+        req.registry.settings['studies.export.sse_heartbeat'] = 0.01
+        req.registry.settings['studies.export.sse_timeout'] = 0.025
 
-        req.redis = mock.Mock(pubsub=lambda: mock.Mock(listen=listen))
+        req.redis = mock.Mock(pubsub=lambda: mock.Mock(listen=self._listen({
+            'type': 'pmessage',
+            'pattern': 'export.*',
+            'channel': 'export.jane',
+            'data': json.dumps({'owner_user': 'jane', 'export_id': 123})
+        })))
 
         res = self._call_fut(models.ExportFactory(req), req)
 
         notifications = list(res.app_iter)
 
-        assert notifications
-        assert '"export_id": 123' in notifications[0]
+        # Only heartbeats until the stream times out
+        assert notifications == [':\n\n'] * 3
 
 
 class TestCodebookJSON:
@@ -411,6 +651,59 @@ class TestCodebookDownload:
         os.remove(name)
 
 
+class TestPlanDownload:
+
+    def _call_fut(self, *args, **kw):
+        from occams.views.export import plan_download as view
+        return view(*args, **kw)
+
+    def test_not_found(self, req, dbsession):
+        """
+        It should return 404 if the data file does not exist
+        """
+        from pyramid.httpexceptions import HTTPNotFound
+        from occams import models
+        req.matchdict = {'plan': 'aform'}
+        with pytest.raises(HTTPNotFound):
+            self._call_fut(models.ExportFactory(req), req)
+
+    def test_stream(self, req, dbsession):
+        """
+        It should stream the data file directly
+        """
+        from occams import models
+        req.matchdict = {'plan': 'pid'}
+        req.registry.settings['studies.export.stream_limit'] = 100000
+        res = self._call_fut(models.ExportFactory(req), req)
+        assert res.content_type == 'text/csv'
+        assert 'pid.csv' in res.content_disposition
+        body = b''.join(res.app_iter)
+        assert body.splitlines()[0].startswith(b'id,')
+
+    def test_exceed_limit(self, req, dbsession):
+        """
+        It should redirect to checkout if the data file is too large
+        """
+        from pyramid.httpexceptions import HTTPFound
+        from occams import models
+        req.matchdict = {'plan': 'pid'}
+        req.registry.settings['studies.export.stream_limit'] = -1
+        res = self._call_fut(models.ExportFactory(req), req)
+        assert isinstance(res, HTTPFound)
+        assert 'contents=pid' in res.location
+
+    def test_batch_size(self, req, dbsession):
+        """
+        It should stream the data file in the configured batches
+        """
+        from occams import models
+        req.matchdict = {'plan': 'pid'}
+        req.registry.settings['studies.export.batch_size'] = 10
+        req.registry.settings['studies.export.stream_limit'] = 1000000
+        res = self._call_fut(models.ExportFactory(req), req)
+        assert b''.join(res.app_iter).startswith(b'id,')
+
+
 class TestDelete:
 
     def _call_fut(self, *args, **kw):
@@ -452,6 +745,52 @@ class TestDelete:
         revoke.assert_called_with(export_name)
 
 
+class TestResume:
+
+    def _call_fut(self, *args, **kw):
+        from occams.views.export import resume_json as view
+        return view(*args, **kw)
+
+    @pytest.mark.parametrize('status', ['pending', 'complete'])
+    def test_not_failed(self, req, dbsession, config, check_csrf_token,
+                        status):
+        """
+        It should only resume failed exports
+        """
+        from pyramid.httpexceptions import HTTPBadRequest
+        from occams import models
+
+        export = models.Export(
+            owner_user=dbsession.info['blame'],
+            contents=[],
+            status=status)
+        dbsession.add(export)
+        dbsession.flush()
+
+        with pytest.raises(HTTPBadRequest):
+            self._call_fut(export, req)
+
+    def test_resume(self, req, dbsession, config, check_csrf_token):
+        """
+        It should queue a failed export again
+        """
+        from pyramid.httpexceptions import HTTPOk
+        from occams import models
+
+        export = models.Export(
+            owner_user=dbsession.info['blame'],
+            contents=[],
+            status='failed')
+        dbsession.add(export)
+        dbsession.flush()
+
+        res = self._call_fut(export, req)
+
+        check_csrf_token.assert_called_with(req)
+        assert isinstance(res, HTTPOk)
+        assert export.status == 'pending'
+
+
 class TestDownload:
 
     def _call_fut(self, *args, **kw):